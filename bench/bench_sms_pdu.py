@@ -0,0 +1,112 @@
+"""Micro-benchmark of GSM 7-bit unpacking, semioctet conversion and PDU decoding.
+
+Compares the current implementation in sms_pdu with the previous one (loop/list based).
+
+ex) python3 bench_sms_pdu.py --number 2000
+"""
+import os
+import sys
+import argparse
+import binascii
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from sms_pdu import PDU, decode_many, unpack_septets  # noqa: E402
+
+SAMPLE_PDU_LIST = [
+    '0891180945123481F44012D04E2A15447C0E9FCD270008229072013503638B060804DCEB0301301030C930B330E2304B3089306E304A77E53089305B3011000D000A672C30E130FC30EB306F682A5F0F4F1A793E004E0054005430C930B330E2304B3089901A4FE16599712165993067914D4FE1305730663044307E30593002000D000A000D000A30C930B330E2304B3089306E91CD8981306A304A77E53089305B3084006430DD30A4',  # noqa
+    '0891180945123481F44012D04E2A15447C0E9FCD270008229072013503638B060804DCEB030230F330C830923054522975283044305F3060304F305F3081306B306F521D671F8A2D5B9A304C5FC589813068306A308A307E30593002000D000A4EE54E0B306E00550052004C306E51855BB9306B5F933063306630C930B330E230B530FC30D330B9306E8A2D5B9A3092304A985830443044305F3057307E30593002FF08901A4FE16599',  # noqa
+    '0891180945123481F44412D04E2A15447C0E9FCD2700082290720135036381060804DCEB030367096599FF09000D000A0068007400740070003A002F002F0073006500720076006900630065002E0073006D0074002E0064006F0063006F006D006F002E006E0065002E006A0070002F0073006900740065002F006D00610069006C002F007300720063002F00630063006E002E00680074006D006C000D000A',  # noqa
+    '0891180945123451F4040B800000000000F00000229082110255631BE13A1D5D76D3D3E3303DFD7683C66F72591193CD6835DB0D'
+]
+
+
+def legacy_convert_from_8bit_to_7bit(bs: bytes) -> bytearray:
+    """Previous implementation of PDU.convert_from_8bit_to_7bit
+    """
+    out = bytearray()
+    pc = 0  # previous carry
+    pc_len = 0  # pc length
+    i = 0
+    count = 0
+    while True:
+        s = i % 8 + 1  # 1 ~ 8
+
+        if s == 8:
+            c = 0
+            sept = 0
+        else:
+            octet = bs[count]
+            c = octet >> (8 - s)
+            sept = octet & (0xFF >> s)
+
+            count += 1
+
+        sept = (sept << pc_len) | pc
+        out.append(sept)
+
+        pc = c
+        pc_len = s % 8
+
+        i += 1
+
+        if count >= len(bs):
+            break
+    return out
+
+
+def legacy_semioctet(x: bytes) -> str:
+    """Previous implementation of PDU.semioctet
+    """
+    hex_str_list = list(binascii.hexlify(x).decode('utf-8'))
+    out = ''
+    while len(hex_str_list):
+        out += hex_str_list.pop(1)
+        out += hex_str_list.pop(0)
+    return out
+
+
+def run(name: str, stmt, number: int) -> float:
+    t = min(timeit.repeat(stmt, number=number, repeat=5)) / number
+    print(f'{name:40s} {t * 1e6:10.2f} us')
+    return t
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of sms_pdu')
+    parser.add_argument('--number', type=int, default=2000, help='Loops per measurement.')
+    args = parser.parse_args()
+
+    packed = bytes(range(1, 141))  # 140 octets = 160 septets
+    scts = binascii.unhexlify('22907201350363')
+    pdu_list = SAMPLE_PDU_LIST * 16  # 64 PDUs
+
+    print('--- 7-bit unpack (140 octets) ---')
+    legacy = run('legacy', lambda: legacy_convert_from_8bit_to_7bit(packed), args.number)
+    current = run('unpack_septets', lambda: unpack_septets(packed, 160), args.number)
+    print(f'{"speedup":40s} {legacy / current:10.2f} x')
+
+    print('--- semioctet (7 octets) ---')
+    legacy = run('legacy', lambda: legacy_semioctet(scts), args.number)
+    current = run('PDU.semioctet', lambda: PDU.semioctet(None, scts), args.number)
+    print(f'{"speedup":40s} {legacy / current:10.2f} x')
+
+    print(f'--- decode {len(pdu_list)} PDUs (parse + message + from_number + timestamp) ---')
+
+    def decode_each():
+        for line in pdu_list:
+            p = PDU(line)
+            p.message, p.from_number, p.timestamp
+
+    def decode_batch():
+        for p in decode_many(pdu_list):
+            p.message, p.from_number, p.timestamp
+
+    single = run('PDU(line) per PDU', decode_each, max(1, args.number // 20))
+    batch = run('decode_many', decode_batch, max(1, args.number // 20))
+    print(f'{"speedup":40s} {single / batch:10.2f} x')
+
+
+if __name__ == "__main__":
+    main()
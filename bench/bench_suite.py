@@ -0,0 +1,343 @@
+"""Benchmark suite of the forwarding pipeline.
+
+Cases:
+- PDU parse and decode (GSM 7-bit, UCS-2, concatenated)
+- SMSForwardingTask.decode_pdu_message on a full SIM +CMGL listing
+- SMSForwardingTask.create_sms_list_from_pdu_list with many interleaved concatenated messages
+- Exclusion list matching with 10k+ entries
+- Routing with hundreds of rules
+- Whole ModemWorker.send_sms_to_slack cycle against a fake serial port (fake_modem) and a stub Slack server (stub_slack)
+
+Everything runs in a temporary workspace (config, token, data), so the real ../data and ../config are not touched.
+Results are written as JSON. With --baseline, cases slower than baseline * threshold are reported and the exit code is 1.
+
+ex) python3 bench_suite.py --output result.json
+    python3 bench_suite.py --baseline result.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import configparser
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_modem  # noqa: E402
+from fake_modem import FakeModem, FakeSerial, make_message_pdus, make_pdu, wait_until  # noqa: E402
+from stub_slack import StubSlackServer  # noqa: E402
+
+fake_modem.install()
+
+from sms_pdu import PDU, decode_many  # noqa: E402
+from reassembly import ReassemblyBuffer  # noqa: E402
+from exclusion_list import ExclusionStore  # noqa: E402
+from routing import Router  # noqa: E402
+from forwarding_sms import SMSForwardingTask  # noqa: E402
+
+FAKE_PORT = 'fake0'
+
+CONFIG = f'''[setting]
+slack_channel = #bench
+polling_seconds = 30
+receive_mode = polling
+reassembly_timeout_seconds = 600
+
+[slack]
+rate_per_second = 1000
+burst = 1000
+
+[archive]
+flush_seconds = 1
+
+[serial]
+port = {FAKE_PORT}
+'''
+
+
+def create_workspace() -> str:
+    """Create a temporary copy of the runtime layout and chdir into its src
+
+    Returns:
+        str: Workspace directory
+    """
+    workspace = tempfile.mkdtemp(prefix='sms_bench_')
+    for d in ('src', 'config', 'data'):
+        os.makedirs(os.path.join(workspace, d))
+    shutil.copytree(os.path.join(ROOT_DIR, 'template'), os.path.join(workspace, 'template'))
+    with open(os.path.join(workspace, 'token.json'), 'w') as f:
+        json.dump(dict(bot_token='xoxb-stub', app_token='xapp-stub'), f)
+    with open(os.path.join(workspace, 'config', 'config.ini'), 'w') as f:
+        f.write(CONFIG)
+    with open(os.path.join(workspace, 'config', 'exclude_number.txt'), 'w') as f:
+        f.write('')
+    os.chdir(os.path.join(workspace, 'src'))
+    return workspace
+
+
+def measure(fn, number: int = 1, repeat: int = 5, ops: int = 1, setup=None) -> dict:
+    """Measure fn
+
+    Args:
+        fn (Callable): Function to measure (takes the value returned by setup if given)
+        number (int, optional): Calls per repetition. Defaults to 1.
+        repeat (int, optional): Repetitions. Defaults to 5.
+        ops (int, optional): Operations per call (results are per operation). Defaults to 1.
+        setup (Callable, optional): Called before each repetition (not measured). Defaults to None.
+
+    Returns:
+        dict: seconds (best), mean_seconds, ops_per_second, ops, repeat
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t = time.perf_counter()
+        for _ in range(number):
+            fn(arg) if setup is not None else fn()
+        times.append((time.perf_counter() - t) / (number * ops))
+    best = min(times)
+    return dict(seconds=best, mean_seconds=statistics.mean(times), ops_per_second=1 / best if best else None, ops=number * ops, repeat=repeat)
+
+
+def random_text(rnd: random.Random, length: int, ucs2: bool) -> str:
+    chars = 'あいうえおかきくけこ認証番号確認コード送信受付０１２３' if ucs2 else 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 '
+    return ''.join(rnd.choice(chars) for _ in range(length))
+
+
+def random_sender(rnd: random.Random) -> str:
+    if rnd.random() < 0.3:
+        return rnd.choice(['Amazon', 'NTT DOCOMO', 'Rakuten', 'LINE', 'Google'])
+    return '0' + rnd.choice(['90', '80', '70', '120', '50']) + ''.join(rnd.choice('0123456789') for _ in range(8))
+
+
+def bench_pdu(rnd: random.Random, n: int) -> dict:
+    gsm7 = [make_pdu(random_sender(rnd), random_text(rnd, 120, False)) for _ in range(n)]
+    ucs2 = [make_pdu(random_sender(rnd), random_text(rnd, 60, True), ucs2=True) for _ in range(n)]
+    concat = []
+    while len(concat) < n:
+        concat += make_message_pdus(random_sender(rnd), random_text(rnd, 300, True), ucs2=True, reference=rnd.randrange(256))
+
+    def decode(lines):
+        for line in lines:
+            p = PDU(line)
+            p.message, p.from_number, p.timestamp, p.concat
+
+    return {
+        'pdu.decode.gsm7': measure(lambda: decode(gsm7), ops=len(gsm7)),
+        'pdu.decode.ucs2': measure(lambda: decode(ucs2), ops=len(ucs2)),
+        'pdu.decode.concat': measure(lambda: decode(concat), ops=len(concat)),
+        'pdu.decode_many.mixed': measure(lambda: [(p.message, p.from_number) for p in decode_many(gsm7 + ucs2 + concat)], ops=3 * n),
+    }
+
+
+def bench_decode_pdu_message(task: SMSForwardingTask, rnd: random.Random, sim_size: int) -> dict:
+    modem = FakeModem(capacity=sim_size)
+    modem.handle('ATE0')
+    while len(modem.store) < sim_size:
+        ucs2 = rnd.random() < 0.5
+        for pdu in make_message_pdus(random_sender(rnd), random_text(rnd, rnd.choice([40, 200]), ucs2), ucs2=ucs2, reference=rnd.randrange(256)):
+            modem.deliver(pdu)
+    listing = modem.handle('AT+CMGL=4')
+
+    return {
+        'decode_pdu_message.full_sim': dict(measure(lambda: task.decode_pdu_message(listing), number=20), messages=len(modem.store)),
+    }
+
+
+def bench_reassembly(task: SMSForwardingTask, rnd: random.Random, messages: int) -> dict:
+    lines = []
+    for i in range(messages):
+        parts = make_message_pdus(random_sender(rnd), random_text(rnd, 300, True), ucs2=True, reference=i % 256)
+        lines += parts
+    rnd.shuffle(lines)  # 部品が互いに入り混じって届く
+    checkpoint = os.path.join('..', 'data', 'bench_reassembly.json')
+
+    def setup():
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        task.reassembly = ReassemblyBuffer(checkpoint_filename=checkpoint, log_level=logging.WARNING)
+        return decode_many(lines)
+
+    def run(pdu_list):
+        # 1回の+CMGLで届いた分ずつ処理する
+        for i in range(0, len(pdu_list), 30):
+            task.create_sms_list_from_pdu_list(pdu_list[i:i + 30])
+
+    return {
+        'reassembly.interleaved': dict(measure(run, ops=len(lines), setup=setup), messages=messages, parts=len(lines)),
+    }
+
+
+def bench_exclusion(rnd: random.Random, entries: int) -> dict:
+    filename = os.path.join('..', 'config', 'bench_exclude_number.txt')
+    numbers = ['0{}{:08d}'.format(rnd.choice(['90', '80', '70']), rnd.randrange(10 ** 8)) for _ in range(entries)]
+    prefixes = ['0{}*'.format(rnd.randrange(10 ** 4, 10 ** 5)) for _ in range(entries // 20)]
+    with open(filename, 'w') as f:
+        f.write('\n'.join(numbers + prefixes) + '\n')
+
+    queries = [rnd.choice(numbers) if rnd.random() < 0.5 else '0{}{:08d}'.format(rnd.choice(['90', '80', '70']), rnd.randrange(10 ** 8))
+               for _ in range(1000)]
+
+    def load():
+        store = ExclusionStore(filename=filename, journal_filename=filename + '.journal')
+        store.reload_if_changed()
+        return store
+
+    store = load()
+    return {
+        'exclusion.load': dict(measure(load), entries=len(numbers) + len(prefixes)),
+        'exclusion.match': dict(measure(lambda: [store.match(q) for q in queries], ops=len(queries)), entries=len(numbers) + len(prefixes)),
+    }
+
+
+def bench_routing(rnd: random.Random, rules: int) -> dict:
+    config = configparser.ConfigParser()
+    config.read_string('[setting]\nslack_channel = #bench\n')
+    for i in range(rules):
+        section = 'route:r{}'.format(i)
+        config.add_section(section)
+        kind = i % 3
+        if kind == 0:
+            config[section]['sender'] = '0120{:06d}'.format(i)
+        elif kind == 1:
+            config[section]['prefix'] = '0{}'.format(500 + i)
+        else:
+            config[section]['prefix'] = '0120'
+            config[section]['regex'] = 'service{} code [0-9]+'.format(i)
+        config[section]['channel'] = '#r{}'.format(i)
+    router = Router.from_config(config, log_level=logging.WARNING)
+
+    sms_list = [dict(from_number=rnd.choice(['0120{:06d}'.format(rnd.randrange(rules)), '0{}1234'.format(500 + rnd.randrange(rules)), '09012345678']),
+                     message='service{} code 1234'.format(rnd.randrange(rules)), modem='') for _ in range(1000)]
+    return {
+        'routing.route': dict(measure(lambda: [router.route(sms) for sms in sms_list], ops=len(sms_list)), rules=rules),
+    }
+
+
+def bench_end_to_end(task: SMSForwardingTask, stub: StubSlackServer, rnd: random.Random, messages: int) -> dict:
+    worker = task.workers[0]
+    modem = FakeSerial.modems.setdefault(FAKE_PORT, FakeModem())
+    modem.capacity = max(modem.capacity, messages * 3)
+    cycle_times, total_times = [], []
+    posted = 0
+
+    for _ in range(5):
+        reference = rnd.randrange(256)
+        for i in range(messages):
+            long = i % 5 == 0
+            for pdu in make_message_pdus(random_sender(rnd), random_text(rnd, 300 if long else 60, i % 2 == 0), ucs2=i % 2 == 0,
+                                         reference=(reference + i) % 256):
+                modem.deliver(pdu)
+
+        count = stub.count
+        t = time.perf_counter()
+        worker.send_sms_to_slack()
+        cycle_times.append(time.perf_counter() - t)
+        if not wait_until(lambda: task.outbox.depth() == 0 and stub.count > count, timeout=60):
+            raise RuntimeError('Outbox was not drained')
+        total_times.append(time.perf_counter() - t)
+        posted += stub.count - count
+
+    return {
+        'e2e.send_sms_to_slack.cycle': dict(seconds=min(cycle_times), mean_seconds=statistics.mean(cycle_times), messages=messages, repeat=5),
+        'e2e.send_sms_to_slack.total': dict(seconds=min(total_times), mean_seconds=statistics.mean(total_times), messages=messages, repeat=5,
+                                            posts=posted),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Cases slower than baseline * threshold
+
+    Returns:
+        list: (name, baseline seconds, current seconds, ratio)
+    """
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get('results', {}).get(name)
+        if b is None or not b.get('seconds'):
+            continue
+        ratio = r['seconds'] / b['seconds']
+        print(f'{name:36s} {b["seconds"] * 1e6:12.2f} us -> {r["seconds"] * 1e6:12.2f} us  x{ratio:.2f}', file=sys.stderr)
+        if ratio > threshold:
+            regressions.append((name, b['seconds'], r['seconds'], ratio))
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of SMS Forwarding Bot')
+    parser.add_argument('--output', help='Write JSON result to this file (default: stdout).')
+    parser.add_argument('--baseline', help='Compare with this JSON result.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Regression if slower than baseline * threshold.')
+    parser.add_argument('--quick', action='store_true', help='Smaller inputs.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of generated SMS.')
+    args = parser.parse_args()
+
+    scale = 0.1 if args.quick else 1
+    rnd = random.Random(args.seed)
+
+    workspace = create_workspace()
+    stub = StubSlackServer().start()
+    task = None
+    try:
+        task = SMSForwardingTask(log_level=logging.WARNING)
+        task.client.base_url = stub.base_url
+        task.slack_sender.start()
+        task.archive.start()
+
+        results = {}
+        results.update(bench_pdu(rnd, int(500 * scale) or 1))
+        results.update(bench_decode_pdu_message(task, rnd, 50))
+        results.update(bench_reassembly(task, rnd, int(1000 * scale) or 1))
+        results.update(bench_exclusion(rnd, int(10000 * scale) or 1))
+        results.update(bench_routing(rnd, int(300 * scale) or 1))
+        results.update(bench_end_to_end(task, stub, rnd, 30))
+    finally:
+        if task is not None:
+            task.slack_sender.stop()
+            task.archive.stop()
+        stub.stop()
+        os.chdir(ROOT_DIR)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    out = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), revision=git_revision(), python=platform.python_version(),
+                         machine=platform.machine(), platform=platform.platform(), quick=args.quick, seed=args.seed),
+               results=results)
+
+    text = json.dumps(out, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('quick') != args.quick:
+            print('WARNING: baseline was run with a different input size (--quick)', file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for name, b, r, ratio in regressions:
+            print(f'REGRESSION {name}: x{ratio:.2f}', file=sys.stderr)
+        if len(regressions):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
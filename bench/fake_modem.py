@@ -0,0 +1,314 @@
+"""In-process fake of the USB modem for benchmarks and offline tests.
+
+- make_pdu() / make_message_pdus() build SMS-DELIVER PDUs (GSM 7-bit, UCS-2, concatenated, alphanumeric sender)
+- FakeModem answers the AT commands used by at.AT from an in-memory message storage
+- FakeSerial is a minimal pyserial.Serial replacement backed by a FakeModem (see install())
+"""
+import re
+import time
+import datetime
+import threading
+import collections
+from typing import Dict, List, Tuple, Union
+
+import serial
+import gsm0338  # noqa  # 'gsm03.38' codec
+
+DEFAULT_SMSC = '819054800000'
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+SEGMENT_SEPTETS = 153  # 分割SMS1通あたりの文字数(GSM 7-bit, UDHあり)
+SEGMENT_UCS2_CHARS = 67  # 分割SMS1通あたりの文字数(UCS-2, UDHあり)
+
+
+def _semioctet(digits: str) -> bytes:
+    if len(digits) % 2:
+        digits += 'F'
+    return bytes.fromhex(''.join([digits[i + 1] + digits[i] for i in range(0, len(digits), 2)]))
+
+
+def _pack_septets(septets: bytes, skip: int = 0, header: bytes = b'') -> bytes:
+    value = int.from_bytes(header, 'little')
+    for i, s in enumerate(septets):
+        value |= s << (7 * (skip + i))
+    return value.to_bytes(((skip + len(septets)) * 7 + 7) // 8, 'little')
+
+
+def _address(sender: str) -> bytes:
+    if re.fullmatch(r'\+?[0-9]+', sender):
+        toa = 0x91 if sender.startswith('+') else 0x81
+        digits = sender.lstrip('+')
+        return bytes([len(digits), toa]) + _semioctet(digits)
+
+    septets = sender.encode('gsm03.38')
+    packed = _pack_septets(septets)
+    return bytes([(len(septets) * 7 + 3) // 4, 0xD0]) + packed  # 英数字の送信元
+
+
+def _scts(timestamp: datetime.datetime) -> bytes:
+    offset = int(timestamp.utcoffset().total_seconds() // 900) if timestamp.utcoffset() is not None else 0
+    tz = '{:02d}'.format(abs(offset))
+    scts = _semioctet(timestamp.strftime('%y%m%d%H%M%S') + tz)
+    if offset < 0:
+        scts = scts[:-1] + bytes([scts[-1] | 0x08])
+    return scts
+
+
+def make_pdu(sender: str, text: str, ucs2: bool = False, concat: Union[Tuple[int, int, int], None] = None,
+             timestamp: Union[datetime.datetime, None] = None, smsc: str = DEFAULT_SMSC) -> str:
+    """Build SMS-DELIVER PDU
+
+    Args:
+        sender (str): Sender number (ex. '+819012345678', '0120123456') or alphanumeric name
+        text (str): Message
+        ucs2 (bool, optional): UCS-2 (otherwise GSM 7-bit). Defaults to False.
+        concat (Union[Tuple[int, int, int], None], optional): (reference number, maximum number, sequence number). Defaults to None.
+        timestamp (Union[datetime.datetime, None], optional): Service centre time stamp. Defaults to None (now).
+        smsc (str, optional): SMSC number. Defaults to DEFAULT_SMSC.
+
+    Returns:
+        str: PDU hex string (as listed by AT+CMGL)
+    """
+    timestamp = timestamp or datetime.datetime.now(JST)
+
+    smsc_bytes = bytes([0x91]) + _semioctet(smsc)
+    header = b'' if concat is None else bytes([0x05, 0x00, 0x03, concat[0] & 0xFF, concat[1], concat[2]])
+    first_octet = 0x04 | (0x40 if len(header) else 0)  # MMS(後続なし), UDHI
+
+    if ucs2:
+        ud = header + text.encode('utf-16-be')
+        udl = len(ud)
+        dcs = 0x08
+    else:
+        septets = text.encode('gsm03.38')
+        skip = (len(header) * 8 + 6) // 7
+        ud = _pack_septets(septets, skip, header)
+        udl = skip + len(septets)
+        dcs = 0x00
+
+    data = bytes([len(smsc_bytes)]) + smsc_bytes + bytes([first_octet]) + _address(sender) + bytes([0x00, dcs]) + _scts(timestamp) + bytes([udl]) + ud
+    return data.hex().upper()
+
+
+def make_message_pdus(sender: str, text: str, ucs2: bool = False, reference: int = 0,
+                      timestamp: Union[datetime.datetime, None] = None) -> List[str]:
+    """Build PDUs of a message (split into concatenated parts if needed)
+
+    Args:
+        sender (str): Sender number or alphanumeric name
+        text (str): Message
+        ucs2 (bool, optional): UCS-2 (otherwise GSM 7-bit). Defaults to False.
+        reference (int, optional): Concatenated short message reference number. Defaults to 0.
+        timestamp (Union[datetime.datetime, None], optional): Service centre time stamp. Defaults to None (now).
+
+    Returns:
+        List[str]: PDU hex strings
+    """
+    limit = 70 if ucs2 else 160
+    if len(text) <= limit:
+        return [make_pdu(sender, text, ucs2, timestamp=timestamp)]
+
+    size = SEGMENT_UCS2_CHARS if ucs2 else SEGMENT_SEPTETS
+    parts = [text[i:i + size] for i in range(0, len(text), size)]
+    return [make_pdu(sender, part, ucs2, concat=(reference, len(parts), i + 1), timestamp=timestamp) for i, part in enumerate(parts)]
+
+
+class FakeModem():
+    """AT command responder with an in-memory message storage
+    at.ATが使うコマンド(ATE, +CMGF, +CMGL, +CMGR, +CMGD, +CPMS, +CNMI)に応答する
+    """
+
+    def __init__(self, capacity: int = 50, storage: str = 'SM') -> None:
+        """Initialize
+
+        Args:
+            capacity (int, optional): Message storage size. Defaults to 50.
+            storage (str, optional): Message storage name. Defaults to 'SM'.
+        """
+        self.capacity = capacity
+        self.storage = storage
+        self.echo = True
+        self.message_format = 0
+        self.cnmi = (0, 0)
+        self.store: Dict[int, Tuple[int, str]] = {}  # index: (stat, PDU)
+        self.commands = collections.Counter()
+        self._lock = threading.Lock()
+
+    def deliver(self, pdu: str) -> Union[str, None]:
+        """Store a received message
+
+        Args:
+            pdu (str): PDU hex string
+
+        Returns:
+            Union[str, None]: URC to send (+CMTI / +CMT) or None. None also if the storage is full (message is dropped).
+        """
+        mode, mt = self.cnmi
+        if mode != 0 and mt == 2:
+            return '\r\n+CMT: ,{}\r\n{}\r\n'.format(len(pdu) // 2 - 1 - int(pdu[:2], 16), pdu)
+
+        with self._lock:
+            index = next((i for i in range(1, self.capacity + 1) if i not in self.store), None)
+            if index is None:
+                return None
+            self.store[index] = (0, pdu)
+
+        if mode != 0 and mt == 1:
+            return '\r\n+CMTI: "{}",{}\r\n'.format(self.storage, index)
+        return None
+
+    def handle(self, line: str) -> str:
+        """Response to one command line (may contain ';'-concatenated commands)
+
+        Args:
+            line (str): Command line without <CR>
+
+        Returns:
+            str: Response bytes as str
+        """
+        out = line + '\r' if self.echo else ''
+        if not line.upper().startswith('AT'):
+            return out + '\r\nERROR\r\n'
+
+        for cmd in line[2:].split(';'):
+            if len(cmd) == 0 and len(line) > 2:
+                continue
+            self.commands[cmd.split('=')[0].split('?')[0]] += 1
+            result = self._handle_one(cmd)
+            if result is None:
+                return out + '\r\nERROR\r\n'
+            out += result
+        return out + '\r\nOK\r\n'
+
+    def _handle_one(self, cmd: str) -> Union[str, None]:
+        upper = cmd.upper()
+        if upper == '':
+            return ''
+        if upper in ('E0', 'E1'):
+            self.echo = upper == 'E1'
+            return ''
+        if upper.startswith('+CMGF='):
+            self.message_format = int(cmd[6:])
+            return ''
+        if upper.startswith('+CNMI='):
+            args = [int(a) if a else 0 for a in cmd[6:].split(',')]
+            self.cnmi = (args[0], args[1] if len(args) > 1 else 0)
+            return ''
+        if upper == '+CPMS?':
+            n = len(self.store)
+            return '\r\n+CPMS: "{0}",{1},{2},"{0}",{1},{2},"{0}",{1},{2}\r\n'.format(self.storage, n, self.capacity)
+        if upper.startswith('+CPMS='):
+            n = len(self.store)
+            return '\r\n+CPMS: {0},{1},{0},{1},{0},{1}\r\n'.format(n, self.capacity)
+        if upper.startswith('+CMGL'):
+            if self.message_format != 0:
+                return None
+            state = int(cmd.split('=')[1]) if '=' in cmd else 0
+            out = ''
+            with self._lock:
+                for index, (stat, pdu) in sorted(self.store.items()):
+                    if state == 4 or state == stat:
+                        out += '\r\n+CMGL: {},{},,{}\r\n{}'.format(index, stat, len(pdu) // 2 - 1 - int(pdu[:2], 16), pdu)
+                        self.store[index] = (1 if stat == 0 else stat, pdu)  # 既読にする
+            return out + ('\r\n' if out else '')
+        if upper.startswith('+CMGR='):
+            index = int(cmd[6:])
+            with self._lock:
+                if index not in self.store:
+                    return None
+                stat, pdu = self.store[index]
+                self.store[index] = (1 if stat == 0 else stat, pdu)
+            return '\r\n+CMGR: {},,{}\r\n{}\r\n'.format(stat, len(pdu) // 2 - 1 - int(pdu[:2], 16), pdu)
+        if upper.startswith('+CMGD='):
+            args = cmd[6:].split(',')
+            with self._lock:
+                if len(args) > 1 and args[1] not in ('', '0'):
+                    self.store.clear()
+                else:
+                    self.store.pop(int(args[0]), None)
+            return ''
+        if upper.startswith(('+CGMI', '+CGMM', '+CSQ', '+CFUN')):
+            return ''
+        return None
+
+
+class FakeSerial():
+    """Minimal pyserial.Serial replacement backed by FakeModem
+    ポート名ごとにFakeSerial.modemsのFakeModemにつながる
+    """
+
+    modems: Dict[str, FakeModem] = {}
+
+    def __init__(self, port: str, baudrate: int = 9600, timeout: Union[float, None] = None, **kwargs) -> None:
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.modem = self.modems.setdefault(port, FakeModem())
+        self.is_open = True
+        self._buffer = bytearray()
+        self._line = ''
+        self._cond = threading.Condition()
+
+    def close(self,) -> None:
+        self.is_open = False
+
+    def push(self, data: str) -> None:
+        """Send data from the modem (ex. URC)
+        """
+        with self._cond:
+            self._buffer += data.encode()
+            self._cond.notify_all()
+
+    def deliver(self, pdu: str) -> None:
+        """Receive a SMS on this port's modem
+        """
+        urc = self.modem.deliver(pdu)
+        if urc is not None:
+            self.push(urc)
+
+    def write(self, data: bytes) -> int:
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        self._line += data.decode()
+        while '\r' in self._line:
+            line, self._line = self._line.split('\r', 1)
+            self.push(self.modem.handle(line))
+        return len(data)
+
+    @property
+    def in_waiting(self,) -> int:
+        return len(self._buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        with self._cond:
+            if len(self._buffer) == 0 and self.timeout:
+                self._cond.wait(self.timeout)
+            out = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return out
+
+    def reset_input_buffer(self,) -> None:
+        with self._cond:
+            self._buffer.clear()
+
+
+def install() -> None:
+    """Replace serial.Serial with FakeSerial
+    """
+    serial.Serial = FakeSerial
+
+
+def wait_until(predicate, timeout: float = 30, interval: float = 0.001) -> bool:
+    """Wait until predicate() is true
+
+    Returns:
+        bool: False if timed out
+    """
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= end:
+            return False
+        time.sleep(interval)
+    return True
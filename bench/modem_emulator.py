@@ -0,0 +1,287 @@
+"""pty-backed emulator of the USB modem (AK-020) for load tests and reproducing field captures.
+
+Emulate mode: answers ATE0, +CMGF, +CMGL, +CMGR, +CMGD, +CPMS, +CNMI (with +CMTI/+CMT URCs) from an in-memory storage,
+and generates SMS at --rate per hour with the given --mix of concatenated / UCS-2 / alphanumeric sender messages.
+Replay mode: plays back a capture recorded by at.AT (config.ini capture = ...) with its original timing.
+
+Point the bot at the emulator with config.ini [serial] port = /tmp/ttySMS0 (the --link path).
+
+ex) python3 modem_emulator.py --link /tmp/ttySMS0 --rate 3600 --mix concat=0.2,ucs2=0.5,alpha=0.3 --error-rate 0.01
+    python3 modem_emulator.py --link /tmp/ttySMS0 --replay ../data/capture.jsonl --speed 2
+"""
+import os
+import sys
+import tty
+import json
+import time
+import queue
+import random
+import select
+import argparse
+import threading
+from typing import Dict, List, Union
+
+from fake_modem import FakeModem, make_message_pdus
+
+
+class PtyModem():
+    """Serial port emulated by a pseudo terminal
+    マスター側で受け取ったコマンド行をhandlerに渡し、返り値をスレーブ側(ボット)に返す
+    """
+
+    def __init__(self, handler) -> None:
+        """Initialize
+
+        Args:
+            handler (Callable[[str], Union[str, None]]): Command line (without CR) -> response (None: no response)
+        """
+        self.handler = handler
+        self.master, self._slave = os.openpty()  # スレーブ側を開いたままにして、ボットが閉じてもEIOにしない
+        tty.setraw(self._slave)  # CR/LFの変換・エコーをしない
+        self.port = os.ttyname(self._slave)
+        self.link = None
+
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def create_link(self, link: str) -> None:
+        """Create a symbolic link to the pty (ex. /tmp/ttySMS0)
+        """
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(self.port, link)
+        self.link = link
+
+    def close(self,) -> None:
+        self._stop.set()
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def write(self, data: str) -> None:
+        """Send data to the bot
+        """
+        with self._write_lock:
+            os.write(self.master, data.encode('latin-1'))
+
+    def serve(self,) -> None:
+        """Read command lines and answer them until close()
+        """
+        line = b''
+        while not self._stop.is_set():
+            r, _, _ = select.select([self.master], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            line += data
+            while b'\r' in line:
+                cmd, line = line.split(b'\r', 1)
+                response = self.handler(cmd.decode('latin-1').strip('\n'))
+                if response:
+                    self.write(response)
+
+
+class Emulator():
+    """AT modem emulator
+    FakeModemに応答させ、一定の確率でエラーを返す
+    """
+
+    def __init__(self, modem: FakeModem, error_rate: float = 0, seed: int = 0) -> None:
+        """Initialize
+
+        Args:
+            modem (FakeModem): Modem
+            error_rate (float, optional): Probability of answering ERROR / +CMS ERROR. Defaults to 0.
+            seed (int, optional): Random seed. Defaults to 0.
+        """
+        self.modem = modem
+        self.error_rate = error_rate
+        self.pty = PtyModem(self.handle)
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def handle(self, line: str) -> Union[str, None]:
+        if self.error_rate and line.upper().startswith('AT+') and self._random.random() < self.error_rate:
+            self.errors += 1
+            echo = line + '\r' if self.modem.echo else ''
+            return echo + self._random.choice(['\r\nERROR\r\n', '\r\n+CMS ERROR: 500\r\n', '\r\n+CME ERROR: 100\r\n'])
+        return self.modem.handle(line)
+
+    def deliver(self, pdu: str) -> bool:
+        """Receive a SMS
+
+        Returns:
+            bool: False if the storage is full (message is dropped)
+        """
+        stored = self.modem.cnmi[1] == 2 or len(self.modem.store) < self.modem.capacity  # +CMTはストレージを使わない
+        urc = self.modem.deliver(pdu)
+        if urc is not None:
+            self.pty.write(urc)
+        return stored
+
+
+class LoadGenerator():
+    """Synthetic SMS load
+    rate件/時でSMSを生成する(到着間隔は指数分布)
+    """
+
+    SENDERS = ['0120123456', '0800123456', '09012345678', '08098765432', '05012345678']
+    ALPHA_SENDERS = ['Amazon', 'NTT DOCOMO', 'Rakuten', 'LINE', 'Google']
+
+    def __init__(self, emulator: Emulator, rate: float, mix: Dict[str, float], seed: int = 0) -> None:
+        """Initialize
+
+        Args:
+            emulator (Emulator): Emulator
+            rate (float): Messages per hour
+            mix (Dict[str, float]): Probability of each kind. {concat, ucs2, alpha}
+            seed (int, optional): Random seed. Defaults to 0.
+        """
+        self.emulator = emulator
+        self.rate = rate
+        self.mix = mix
+        self.messages = 0
+        self.parts = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._reference = 0
+
+    def generate(self,) -> List[str]:
+        """PDUs of one message
+        """
+        rnd = self._random
+        ucs2 = rnd.random() < self.mix.get('ucs2', 0)
+        concat = rnd.random() < self.mix.get('concat', 0)
+        sender = rnd.choice(self.ALPHA_SENDERS if rnd.random() < self.mix.get('alpha', 0) else self.SENDERS)
+
+        code = '{:06d}'.format(rnd.randrange(10 ** 6))
+        if ucs2:
+            text = '認証コードは{}です。'.format(code) + ('このコードを他人に教えないでください。' * (12 if concat else 1))
+        else:
+            text = 'Your verification code is {}. '.format(code) + ('Do not share this code with anyone. ' * (8 if concat else 1))
+
+        self._reference = (self._reference + 1) % 256
+        return make_message_pdus(sender, text, ucs2=ucs2, reference=self._reference)
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.wait(self._random.expovariate(self.rate / 3600)):
+            pdus = self.generate()
+            self.messages += 1
+            for pdu in pdus:
+                self.parts += 1
+                if not self.emulator.deliver(pdu):
+                    self.dropped += 1
+
+
+class Replayer():
+    """Replay of a capture recorded by at.AT
+    ボットからのコマンド(tx)を待ち、モデムからの受信データ(rx)を記録時と同じ間隔(直前のtxからの経過時間)で返す
+    """
+
+    TX_TIMEOUT_SECONDS = 60
+
+    def __init__(self, records: List[dict], speed: float = 1) -> None:
+        """Initialize
+
+        Args:
+            records (List[dict]): Capture records (JSONL lines)
+            speed (float, optional): Playback speed. Defaults to 1.
+        """
+        self.records = records
+        self.speed = speed
+        self.pty = PtyModem(self.handle)
+        self.mismatches = 0
+        self._tx = queue.Queue()
+
+    def handle(self, line: str) -> None:
+        self._tx.put(line)
+        return None
+
+    def run(self, stop: threading.Event) -> None:
+        anchor_real, anchor_t = time.monotonic(), 0.0
+        for record in self.records:
+            if stop.is_set():
+                return
+
+            if record['dir'] == 'open':
+                anchor_real, anchor_t = time.monotonic(), 0.0
+            elif record['dir'] == 'tx':
+                for expected in [c for c in record['data'].split('\r') if len(c)]:
+                    try:
+                        line = self._tx.get(timeout=self.TX_TIMEOUT_SECONDS)
+                    except queue.Empty:
+                        print('timeout waiting for {!r}'.format(expected), file=sys.stderr)
+                        return
+                    if line != expected:
+                        self.mismatches += 1
+                        print('mismatch: expected {!r}, got {!r}'.format(expected, line), file=sys.stderr)
+                anchor_real, anchor_t = time.monotonic(), record['t']
+            elif record['dir'] == 'rx':
+                delay = anchor_real + (record['t'] - anchor_t) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.pty.write(record['data'])
+        print('replay finished', file=sys.stderr)
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for item in text.split(','):
+        if item:
+            k, v = item.split('=')
+            mix[k.strip()] = float(v)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pty-backed AT modem emulator')
+    parser.add_argument('--link', default='/tmp/ttySMS0', help='Symbolic link to the emulated serial port.')
+    parser.add_argument('--rate', type=float, default=60, help='Generated SMS per hour (0: none).')
+    parser.add_argument('--mix', default='concat=0.2,ucs2=0.5,alpha=0.3', help='Probability of concatenated / UCS-2 / alphanumeric sender.')
+    parser.add_argument('--capacity', type=int, default=50, help='Message storage size.')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0, help='Probability of an error reply to AT+ commands.')
+    parser.add_argument('--replay', help='Replay a capture (JSONL) instead of emulating.')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    if args.replay:
+        with open(args.replay, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        target = Replayer(records, speed=args.speed)
+        runner = target.run
+    else:
+        target = Emulator(FakeModem(capacity=args.capacity), error_rate=args.error_rate, seed=args.seed)
+        generator = LoadGenerator(target, args.rate, parse_mix(args.mix), seed=args.seed)
+        runner = generator.run if args.rate > 0 else stop.wait
+
+    pty = target.pty
+    if args.link:
+        pty.create_link(args.link)
+    print('serial port: {}{}'.format(pty.port, ' -> {}'.format(args.link) if args.link else ''), file=sys.stderr)
+
+    threading.Thread(target=runner, args=(stop,), name='generator', daemon=True).start()
+    threading.Thread(target=pty.serve, name='pty', daemon=True).start()
+    try:
+        while True:
+            time.sleep(10)
+            if args.replay:
+                print('mismatches={}'.format(target.mismatches), file=sys.stderr)
+            else:
+                print('messages={} parts={} dropped={} stored={} errors={} commands={}'.format(
+                    generator.messages, generator.parts, generator.dropped, len(target.modem.store), target.errors,
+                    dict(target.modem.commands)), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        pty.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Stub of the Slack Web API for benchmarks and offline tests.
+
+ex) client = WebClient(token='xoxb-stub', base_url=StubSlackServer().start().base_url)
+"""
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+
+class StubSlackServer():
+    """Stub of the Slack Web API
+    全てのメソッドに{"ok": true}を返し、受け取ったリクエストを記録する
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0) -> None:
+        """Initialize
+
+        Args:
+            host (str, optional): Listen address. Defaults to '127.0.0.1'.
+            port (int, optional): Listen port. Defaults to 0 (any free port).
+            latency (float, optional): Seconds to wait before each response. Defaults to 0.
+        """
+        self.latency = latency
+        self.requests: List[dict] = []
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+                with stub._lock:
+                    stub.requests.append(dict(method=self.path.rsplit('/', 1)[-1], params=params))
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                data = json.dumps(dict(ok=True, channel=params.get('channel', 'C0000000000'), ts='{:.6f}'.format(time.time()))).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def base_url(self,) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/api/'.format(host, port)
+
+    @property
+    def count(self,) -> int:
+        with self._lock:
+            return len(self.requests)
+
+    def start(self,) -> 'StubSlackServer':
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stub_slack', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self,) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,174 @@
+"""Archive of received SMS."""
+import os
+import glob
+import gzip
+import shutil
+import sqlite3
+import datetime
+import threading
+import logging
+from typing import List
+
+from common.log import Logger
+
+
+class SMSArchive():
+    """Archive of received SMS
+    日ごとのテキストファイル(receive_sms_YYYYMMDD.txt)に追記し、SQLiteの全文検索インデックスにも登録する。
+    ファイルは開いたままにして、flush_seconds毎にまとめてfsync・コミットする。前日以前のファイルはgzip圧縮する。
+    """
+
+    SEGMENT_PREFIX = 'receive_sms_'
+
+    def __init__(self, data_dir: str = '../data', flush_seconds: float = 10, compress: bool = True, log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            data_dir (str, optional): Directory to save. Defaults to '../data'.
+            flush_seconds (float, optional): Interval to flush and fsync. Defaults to 10.
+            compress (bool, optional): Compress old segments. Defaults to True.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.data_dir = data_dir
+        self.flush_seconds = flush_seconds
+        self.compress = compress
+
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._date = None
+        self._dirty = False
+
+        self._conn = sqlite3.connect(os.path.join(self.data_dir, 'archive.sqlite3'), check_same_thread=False)
+        self._fts = self._create_index()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        if self.compress:
+            self.compress_old_segments()
+
+    def _create_index(self,) -> bool:
+        """Create index table
+
+        Returns:
+            bool: True if full-text search (FTS5 trigram) is available
+        """
+        try:
+            # trigramは日本語のように単語区切りのない文字列も部分一致で検索できる
+            self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS sms_fts USING fts5(from_number, timestamp, message, tokenize="trigram")')
+            self._conn.commit()
+            return True
+        except sqlite3.OperationalError as e:
+            self._logger.warn('FTS5 is not available, fall back to LIKE search: {}'.format(e))
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sms (from_number TEXT, timestamp TEXT, message TEXT)')
+            self._conn.commit()
+            return False
+
+    def start(self,) -> None:
+        """Start flush thread
+        """
+        self._thread = threading.Thread(target=self.run, name='sms_archive', daemon=True)
+        self._thread.start()
+
+    def stop(self,) -> None:
+        """Stop flush thread and flush
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def run(self,) -> None:
+        """Flush loop
+        """
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                self._logger.error('Failed to flush archive: {}'.format(e))
+
+    def segment_filename(self, date: datetime.date) -> str:
+        return os.path.join(self.data_dir, '{}{}.txt'.format(self.SEGMENT_PREFIX, date.strftime('%Y%m%d')))
+
+    def _rotate(self, today: datetime.date) -> None:
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._file = open(self.segment_filename(today), 'a')
+        self._date = today
+
+        if self.compress:
+            self.compress_old_segments()
+
+    def compress_old_segments(self,) -> None:
+        """Compress segments other than today's
+        """
+        today_filename = self.segment_filename(datetime.date.today())
+        for filename in glob.glob(os.path.join(self.data_dir, self.SEGMENT_PREFIX + '*.txt')):
+            if filename == today_filename:
+                continue
+            with open(filename, 'rb') as f_in, gzip.open(filename + '.gz', 'ab') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(filename)
+            self._logger.debug('Compressed %s', filename)
+
+    def write(self, sms: dict, text: str) -> None:
+        """Append SMS (written to disk at the next flush)
+
+        Args:
+            sms (dict): SMS
+            text (str): Rendered message
+        """
+        with self._lock:
+            today = datetime.date.today()
+            if today != self._date:
+                self._rotate(today)
+            self._file.write(text + '\n')
+
+            table = 'sms_fts' if self._fts else 'sms'
+            self._conn.execute(f'INSERT INTO {table} (from_number, timestamp, message) VALUES (?, ?, ?)',
+                               (sms['from_number'], sms['timestamp'], sms['message']))
+            self._dirty = True
+
+    def flush(self,) -> None:
+        """Flush buffered writes to disk
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._conn.commit()
+            self._dirty = False
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        """Search SMS (newest first)
+
+        Args:
+            query (str): Search words (all words must match)
+            limit (int, optional): Maximum number of results. Defaults to 10.
+
+        Returns:
+            List[dict]: SMS (from_number, timestamp, message)
+        """
+        words = query.split()
+        if len(words) == 0:
+            return []
+
+        with self._lock:
+            if self._fts and all([len(w) >= 3 for w in words]):  # trigramは3文字以上
+                match = ' AND '.join(['"{}"'.format(w.replace('"', '""')) for w in words])
+                rows = self._conn.execute('SELECT from_number, timestamp, message FROM sms_fts WHERE sms_fts MATCH ? '
+                                          'ORDER BY timestamp DESC LIMIT ?', (match, limit)).fetchall()
+            else:
+                table = 'sms_fts' if self._fts else 'sms'
+                where = ' AND '.join(["(from_number || ' ' || message) LIKE ?"] * len(words))
+                rows = self._conn.execute(f'SELECT from_number, timestamp, message FROM {table} WHERE {where} '
+                                          'ORDER BY timestamp DESC LIMIT ?', ['%{}%'.format(w) for w in words] + [limit]).fetchall()
+        return [dict(from_number=r[0], timestamp=r[1], message=r[2]) for r in rows]
@@ -0,0 +1,260 @@
+"""asyncio runtime of the forwarding pipeline and the Slack socket."""
+import time
+import signal
+import asyncio
+import functools
+import concurrent.futures
+import logging
+from typing import Callable, List
+
+import aiohttp
+from slack_sdk.errors import SlackApiError
+
+from slack_sender import SlackSender
+from modem_worker import ModemWorker
+
+from common.log import Logger
+
+
+class AsyncSlackSender(SlackSender):
+    """Slack sender coroutine
+    SlackSenderと同じレート制限・まとめ送信・再送をAsyncWebClientでイベントループ上で行う。
+    notify()はモデムのスレッド(executor)から呼ばれるので、call_soon_threadsafeでイベントループに渡す。
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        self._loop = None
+        self._async_wakeup = None
+
+    def notify(self,) -> None:
+        """Notify that messages were added to the outbox (thread safe)
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    def start(self,) -> None:
+        raise RuntimeError('AsyncSlackSender runs as a coroutine (run_async)')
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop sender loop
+        """
+        self._stop.set()
+        self.notify()
+
+    async def run_async(self,) -> None:
+        """Sender loop
+        """
+        self._loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+
+        while not self._stop.is_set():
+            try:
+                await self.send_once_async()
+            except Exception as e:  # noqa
+                self._logger.error('Slack sender error: {}'.format(e))
+
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), self.next_wait())
+            except asyncio.TimeoutError:
+                pass
+            self._async_wakeup.clear()
+
+    async def send_once_async(self,) -> int:
+        """Send the head messages of each channel that is due and not rate limited
+
+        Returns:
+            int: Number of sent SMS
+        """
+        sent = 0
+        while True:
+            progressed = False
+
+            for channel, bucket, rows in self.due_batches():
+                if await self.post_async(channel, rows):
+                    sent += len(rows)
+                    progressed = True
+                else:
+                    bucket.drain()
+
+            if not progressed:
+                break
+        return sent
+
+    async def post_async(self, channel: str, rows: list) -> bool:
+        """Post messages (merged into Block Kit sections if more than one)
+
+        Args:
+            channel (str): Slack channel
+            rows (list): Outbox messages (sqlite3.Row)
+
+        Returns:
+            bool: True if sent
+        """
+        started_at = time.monotonic()
+        try:
+            await self.client.chat_postMessage(**self.create_message(channel, rows))
+        except (SlackApiError, OSError, aiohttp.ClientError) as e:
+            self.failed(rows, e, started_at)
+            return False
+
+        self.sent(rows, started_at)
+        return True
+
+    async def flush(self, timeout: float) -> int:
+        """Send what is left in the outbox before shutdown
+        レート制限・再送待ちでtimeout以内に送れないものはOutboxに残し、次回起動時に送る
+
+        Args:
+            timeout (float): Seconds to give up
+
+        Returns:
+            int: Number of messages left in the outbox
+        """
+        deadline = time.monotonic() + timeout
+        while self.outbox.depth() > 0:
+            await self.send_once_async()
+            wait = self.next_wait()
+            if self.outbox.depth() == 0 or time.monotonic() + wait > deadline:
+                break
+            await asyncio.sleep(wait)
+        return self.outbox.depth()
+
+
+class AsyncRuntime():
+    """Run the forwarding pipeline and the Slack socket on one event loop
+    Slackのソケット(Bolt)と送信はイベントループ上で、シリアル通信はモデムごとに1スレッドのexecutorで行う。
+    どれかのタスクが例外で終了したら全体を止める(systemdで再起動させる)。
+    SIGTERM/SIGINTで新しい受信を止め、送信キューを送ってから終了する。
+    """
+
+    URC_WAIT_SECONDS = 5  # 新着通知を待つ最大時間(終了要求への応答時間)
+    FLUSH_TIMEOUT_SECONDS = 10  # 終了時に送信キューを送る最大時間
+
+    def __init__(self, task, socket_handler=None, system_monitor=None, log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            task (SMSForwardingTask): Forwarding pipeline (created with runtime='asyncio')
+            socket_handler (AsyncSocketModeHandler, optional): Bolt socket mode handler. Defaults to None.
+            system_monitor (SystemMonitor, optional): System monitor sampled on the event loop. Defaults to None.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.task = task
+        self.socket_handler = socket_handler
+        self.system_monitor = system_monitor
+
+        self._stop = None
+
+    def stop(self,) -> None:
+        """Request shutdown (call on the event loop)
+        """
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self,) -> bool:
+        """Run until SIGTERM/SIGINT or a task fails
+
+        Returns:
+            bool: False if stopped by a failed task
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        workers = self.task.workers
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(workers), thread_name_prefix='modem')
+
+        tasks = [asyncio.create_task(self.task.slack_sender.run_async(), name='slack_sender'),
+                 asyncio.create_task(self.every(self.task.archive.flush_seconds, self.task.archive.flush), name='sms_archive')]
+        if self.system_monitor is not None:
+            tasks.append(asyncio.create_task(self.every(self.system_monitor.sample_seconds, self.system_monitor.sample), name='system_monitor'))
+        for worker in workers:
+            tasks.append(asyncio.create_task(self.run_worker(worker, executor), name='modem:{}'.format(worker.name or worker.port)))
+        if self.task.metrics_server is not None:
+            self.task.metrics_server.start()
+        if self.socket_handler is not None:
+            await self.socket_handler.connect_async()
+
+        stop_task = asyncio.create_task(self._stop.wait())
+        done, _ = await asyncio.wait(tasks + [stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+        ok = True
+        for t in done:
+            if t is stop_task:
+                continue
+            ok = False
+            if not t.cancelled() and t.exception() is not None:
+                self._logger.critical('{} failed: {}: {}'.format(t.get_name(), type(t.exception()).__name__, t.exception()))
+            else:
+                self._logger.critical('{} stopped'.format(t.get_name()))
+
+        await self.shutdown(tasks + [stop_task], executor)
+        return ok
+
+    async def shutdown(self, tasks: List[asyncio.Task], executor: concurrent.futures.ThreadPoolExecutor) -> None:
+        """Stop receiving, then flush the outbox and the archive
+
+        Args:
+            tasks (List[asyncio.Task]): Running tasks
+            executor (concurrent.futures.ThreadPoolExecutor): Executor of serial I/O
+        """
+        self._logger.info('Shutting down...')
+        loop = asyncio.get_running_loop()
+
+        if self.socket_handler is not None:
+            await self.socket_handler.close_async()
+
+        for worker in self.task.workers:
+            worker.stop()
+        self.task.slack_sender.stop()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await loop.run_in_executor(None, executor.shutdown)  # 実行中のシリアル通信の終了を待つ
+
+        left = await self.task.slack_sender.flush(self.FLUSH_TIMEOUT_SECONDS)
+        if left:
+            self._logger.warn('{} messages are left in the outbox'.format(left))
+        self.task.archive.flush()
+        for worker in self.task.workers:
+            worker.close()
+        if self.task.metrics_server is not None:
+            self.task.metrics_server.stop()
+
+    async def run_worker(self, worker: ModemWorker, executor: concurrent.futures.Executor) -> None:
+        """Worker loop of a modem (serial I/O runs in the executor)
+
+        Args:
+            worker (ModemWorker): Worker
+            executor (concurrent.futures.Executor): Executor of serial I/O
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(executor, worker.step)
+
+            if worker.receive_mode == 'urc' and not worker.watchdog.is_down:
+                # 次のポーリングまで新着通知を待つ
+                timeout = min(worker.next_wait(), self.URC_WAIT_SECONDS)
+                await loop.run_in_executor(executor, functools.partial(worker.run_safely, worker.wait_new_message, timeout=timeout))
+            else:
+                await asyncio.sleep(worker.next_wait())
+
+    async def every(self, seconds: float, func: Callable[[], None]) -> None:
+        """Run a blocking function periodically in the default executor
+
+        Args:
+            seconds (float): Interval
+            func (Callable[[], None]): Function
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, func)
+            except Exception as e:  # noqa
+                self._logger.error('{}: {}'.format(getattr(func, '__qualname__', func), e))
+            await asyncio.sleep(seconds)
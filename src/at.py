@@ -1,54 +1,351 @@
 import sys
 import time
+import json
 import logging
+import collections
+from typing import List, Optional, Tuple
 
 import serial
 
 from common.log import Logger
+from common import metrics
+
+_COMMAND_SECONDS = metrics.histogram('sms_at_command_seconds', 'AT command round-trip time until the final result code.', ('command',))
+_COMMAND_RESULTS = metrics.counter('sms_at_command_results_total', 'AT command final result codes.', ('command', 'result'))
+
+
+class ATError(Exception):
+    """AT command error
+    """
+    pass
+
+
+class ATTimeoutError(ATError):
+    """No final result code within the command deadline
+    """
+    pass
+
+
+class ATCommandError(ATError):
+    """Final result code other than OK
+    """
+
+    def __init__(self, response: 'ATResponse') -> None:
+        super().__init__('{} -> {}'.format(response.command, response.result))
+        self.response = response
+
+
+class ATResponse():
+    """AT command response
+    """
+
+    def __init__(self, command: str, result: str, lines: List[str]) -> None:
+        """Initialize
+
+        Args:
+            command (str): AT command
+            result (str): Final result code. ex) OK, ERROR, +CMS ERROR: 321
+            lines (List[str]): Information response lines (without final result code)
+        """
+        self.command = command
+        self.result = result
+        self.lines = lines
+
+    def __str__(self,) -> str:
+        return '\n'.join(self.lines + [self.result])
+
+    @property
+    def ok(self,) -> bool:
+        return self.result == 'OK'
+
+    @property
+    def error_code(self,) -> Optional[int]:
+        """Error code of +CME ERROR/+CMS ERROR (None if not available)
+        """
+        if self.result.startswith(('+CME ERROR:', '+CMS ERROR:')):
+            value = self.result.split(':', 1)[1].strip()
+            if value.isdigit():
+                return int(value)
+        return None
 
 
 class AT():
-    def __init__(self, port: str, baudrate: int = 460800, timeout: int = 3, log_level: int = logging.INFO) -> None:
+    MODE_SWITCH_WAIT_SECONDS = 0.5  # モード切替後の待ち時間
+    READ_POLL_SECONDS = 0.1  # シリアル読み込みの最大ブロック時間
+    LIST_TIMEOUT_SECONDS = 30  # +CMGLは件数に比例して時間がかかる
+    MAX_COMMAND_LINE_LENGTH = 256  # 1行にまとめるコマンドの最大長
+
+    # [5.1 General] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27007-a00.pdf
+    FINAL_RESULT_CODES = ('OK', 'ERROR', 'NO CARRIER', 'BUSY', 'NO ANSWER', 'NO DIALTONE')
+    FINAL_RESULT_PREFIXES = ('+CME ERROR:', '+CMS ERROR:')
+    URC_PREFIXES = ('+CMTI:', '+CMT:', '+CDSI:', '+CDS:', '+CBM:', 'RING', '+CREG:', '+CGREG:', '+CEREG:')
+    URC_WITH_PDU_PREFIXES = ('+CMT:', '+CDS:', '+CBM:')  # 次の行にPDUが続く
+
+    def __init__(self, port: str, baudrate: int = 460800, timeout: int = 3, capture_filename: Optional[str] = None,
+                 log_level: int = logging.INFO) -> None:
         """Initialize
 
         Args:
             port (str): Serial port
             baudrate (int, optional): Baudrate. Defaults to 460800.
-            timeout (int, optional): pyserial timeout. Defaults to 3.
+            timeout (int, optional): Default command timeout seconds. Defaults to 3.
+            capture_filename (Optional[str], optional): Record serial traffic to this file (JSONL). Defaults to None.
             log_level (int, optional): Level of logging. Defaults to logging.INFO.
         """
         self._logger = Logger(name=__name__, level=log_level)
 
-        self.serial = serial.Serial(port,
-                                    baudrate,
-                                    timeout=timeout)
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.capture_filename = capture_filename
 
-        self.send_cmd('ATE0')
-        resp = self.read_response()
-        self._logger.debug(resp)
+        self.serial = None
+        self._capture = None
+        self._capture_started_at = 0.0
+        self._rx_buffer = bytearray()
+        self.urc_queue = collections.deque()  # (URC line, PDU line or None)
+        self.reset_state()
+        self.open()
 
     def __del__(self,):
         """Deinitialize
         """
-        self.serial.close()
+        self.close()
+
+    def open(self,) -> None:
+        """Open serial port
+        """
+        self.serial = serial.Serial(self.port,
+                                    self.baudrate,
+                                    timeout=self.READ_POLL_SECONDS)
+        if self.capture_filename is not None:
+            self.open_capture()
+        self._rx_buffer.clear()
+        self.reset_state()
+        self.set_echo(False)
+
+    def close(self,) -> None:
+        """Close serial port
+        """
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            finally:
+                self.serial = None
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+        self.reset_state()
+
+    def open_capture(self,) -> None:
+        """Start recording serial traffic
+        送受信したデータをJSONLで追記する(1行1レコード, tはポートを開いてからの秒数)。bench/modem_emulator.pyで再生できる。
+        ex) {"t": 0.0, "dir": "open", "port": "/dev/ttyUSB1", "time": 1700000000.0}
+            {"t": 0.012, "dir": "tx", "data": "AT+CMGL=4\\r"}
+            {"t": 0.051, "dir": "rx", "data": "\\r\\n+CMGL: 1,0,,155\\r\\n..."}
+        """
+        self._capture = open(self.capture_filename, 'a', buffering=1)  # 行バッファリング
+        self._capture_started_at = time.monotonic()
+        self._capture.write(json.dumps(dict(t=0.0, dir='open', port=self.port, time=time.time())) + '\n')
+
+    def _record(self, direction: str, data: bytes) -> None:
+        t = round(time.monotonic() - self._capture_started_at, 6)
+        self._capture.write(json.dumps(dict(t=t, dir=direction, data=data.decode('latin-1'))) + '\n')
+
+    @property
+    def is_open(self,) -> bool:
+        return self.serial is not None and self.serial.is_open
+
+    def reset_state(self,) -> None:
+        """Forget cached modem state
+        ポートを開き直した場合などモデムの状態が不明になったときに呼ぶ
+        """
+        self.echo = None  # ATE
+        self.message_format = None  # +CMGF
+        self.message_storage = None  # +CPMS
+        self.storage_used = None  # +CPMSの<used1>(読み込み・削除するストレージの使用数)
+        self.storage_total = None  # +CPMSの<total1>
+        self.new_message_indication = None  # +CNMI
 
-    def read_response(self,) -> str:
-        """Read  AT response
+    def read_line(self, deadline: float) -> Optional[str]:
+        """Read one line (CR/LF framed)
+
+        Args:
+            deadline (float): time.monotonic() deadline
 
         Returns:
-            str: AT Response
+            Optional[str]: Line without CR/LF. None if deadline passed.
         """
-        response = ''
         while True:
-            line = self.serial.readline().decode('utf-8')
-            response += line
+            i = self._rx_buffer.find(b'\n')
+            if i >= 0:
+                line = bytes(self._rx_buffer[:i])
+                del self._rx_buffer[:i + 1]
+                return line.rstrip(b'\r').decode('utf-8', errors='replace')
+
+            if time.monotonic() >= deadline:
+                return None
+
+            data = self.serial.read(self.serial.in_waiting or 1)
+            if data:
+                self._rx_buffer += data
+                if self._capture is not None:
+                    self._record('rx', data)
+
+    def _read_urc_body(self, line: str, deadline: float) -> Tuple[str, Optional[str]]:
+        pdu = None
+        if line.startswith(self.URC_WITH_PDU_PREFIXES):
+            pdu = self.read_line(deadline)
+        return line, pdu
+
+    def command(self, cmd: str, timeout: Optional[float] = None, check: bool = True) -> ATResponse:
+        """Send command and read response until final result code
+        応答中に届いたURCはurc_queueに振り分ける
+
+        Args:
+            cmd (str): AT command
+            timeout (Optional[float], optional): Seconds to wait final result code. Defaults to self.timeout.
+            check (bool, optional): Raise ATCommandError if final result code is not OK. Defaults to True.
+
+        Raises:
+            ATTimeoutError: No final result code within timeout
+            ATCommandError: Final result code is not OK
 
-            if line.strip() == 'OK':
+        Returns:
+            ATResponse: Response
+        """
+        started_at = time.monotonic()
+        deadline = started_at + (self.timeout if timeout is None else timeout)
+        name = self.command_name(cmd)
+
+        self.send_cmd(cmd)
+
+        lines = []
+        while True:
+            line = self.read_line(deadline)
+            if line is None:
+                _COMMAND_RESULTS.labels(name, 'timeout').inc()
+                raise ATTimeoutError('{} -> timeout'.format(cmd))
+
+            if len(line) == 0 or line == cmd:  # 空行・エコー除外
+                continue
+
+            if line in self.FINAL_RESULT_CODES or line.startswith(self.FINAL_RESULT_PREFIXES):
+                response = ATResponse(cmd, line, lines)
                 break
-            # elif line.strip() == 'ERROR':  # TODO:
-            #     break
+
+            if line.startswith(self.URC_PREFIXES):
+                self.urc_queue.append(self._read_urc_body(line, deadline))
+                continue
+
+            lines.append(line)
+
+        _COMMAND_SECONDS.labels(name).observe(time.monotonic() - started_at)
+        _COMMAND_RESULTS.labels(name, response.result.split(':', 1)[0]).inc()
+
+        self._logger.debug(response)
+        if check and not response.ok:
+            raise ATCommandError(response)
         return response
 
+    @staticmethod
+    def command_name(cmd: str) -> str:
+        """Command name used as metrics label
+
+        ex) 'AT+CMGL=4' -> '+CMGL', 'AT+CMGD=1;+CMGD=2' -> '+CMGD', 'ATE0' -> 'E0', 'AT' -> 'AT'
+
+        Args:
+            cmd (str): AT command
+
+        Returns:
+            str: Command name
+        """
+        return cmd[2:].split(';', 1)[0].split('=', 1)[0].split('?', 1)[0] or 'AT'
+
+    def set_echo(self, enable: bool) -> None:
+        """Set command echo (skipped if already set)
+
+        Args:
+            enable (bool): Echo on/off
+        """
+        if self.echo == enable:
+            return
+        self.command('ATE1' if enable else 'ATE0')
+        self.echo = enable
+
+    def set_message_format(self, mode: int) -> None:
+        """Set message format (skipped if already set)
+
+        Args:
+            mode (int): {0(PDU Mode) | 1(Text Mode)}
+        """
+        if self.message_format == mode:
+            return
+        self.command(f'AT+CMGF={mode}')  # 0: PDU Mode, 1: Text Mode
+        self.message_format = mode
+
+        time.sleep(self.MODE_SWITCH_WAIT_SECONDS)
+
+    def set_message_storage(self, mem: str = 'SM') -> str:
+        """Set preferred message storage for reading, writing and receiving (skipped if already set)
+        SIM(SM)は30件程度しか保存できないので、モデムが対応していればME/MT(SIM+モデム)を使うと溢れにくい
+
+        [参]
+        - [3.2.2 Preferred Message Storage +CPMS] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27005-a00.pdf
+
+        Args:
+            mem (str, optional): {SM | ME | MT | ...}. Defaults to 'SM'.
+
+        Returns:
+            str: AT Response. Empty if skipped.
+        """
+        if self.message_storage == mem:
+            return ''
+        resp = self.command(f'AT+CPMS="{mem}","{mem}","{mem}"')
+        self.message_storage = mem
+        self.update_storage_count(resp)
+        return str(resp)
+
+    def set_new_message_indication(self, mode: int = 2, mt: int = 1) -> None:
+        """Set new message indication (skipped if already set)
+
+        [参]
+        - [3.4.1 New Message Indications to TE +CNMI] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27005-a00.pdf
+
+        Args:
+            mode (int, optional): {0 | 1 | 2 | 3}. Defaults to 2.
+            mt (int, optional): {0 | 1(+CMTI) | 2(+CMT) | 3}. Defaults to 1.
+        """
+        if self.new_message_indication == (mode, mt):
+            return
+        self.command(f'AT+CNMI={mode},{mt},0,0,0')
+        self.new_message_indication = (mode, mt)
+
+    def read_urc(self, timeout: float) -> Optional[Tuple[str, Optional[str]]]:
+        """Wait for an unsolicited result code
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            Optional[Tuple[str, Optional[str]]]: (URC line, PDU line of +CMT). None if timed out.
+        """
+        if len(self.urc_queue):
+            return self.urc_queue.popleft()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.read_line(deadline)
+            if line is None:
+                return None
+            if len(line) == 0:
+                continue
+
+            self._logger.debug(line)
+            if line.startswith(self.URC_PREFIXES):
+                return self._read_urc_body(line, deadline + self.timeout)
+            self._logger.debug('Discard unexpected line: %s', line)
+
     def get_sms_text_message(self, state: str = 'REC UNREAD') -> str:
         """Get SMS text message
 
@@ -58,17 +355,10 @@ class AT():
         Returns:
             str: Text message (+CMGL: <index>,<stat>,<oa>,[<alpha>],[<scts>]<CR><LF><data><CR><LF>)
         """
-        self.send_cmd('AT+CMGF=1')  # 0: PDU Mode, 1: Text Mode
-        resp = self.read_response()
-        self._logger.debug(resp)
-
-        time.sleep(0.5)
+        self.set_message_format(1)
 
-        self.send_cmd(f'AT+CMGL="{state}"')
-        resp = self.read_response()
-        self._logger.debug(resp)
-
-        return resp
+        resp = self.command(f'AT+CMGL="{state}"', timeout=self.LIST_TIMEOUT_SECONDS)
+        return str(resp)
 
     def get_sms_pdu(self, state: int = 0) -> str:
         """Get SMS PDU
@@ -82,17 +372,10 @@ class AT():
         Returns:
             str: PDU message (+CMGL: <index>,<stat>,[<alpha>],<length><CR><LF><pdu><CR><LF>)
         """
-        self.send_cmd('AT+CMGF=0')  # 0: PDU Mode, 1: Text Mode
-        resp = self.read_response()
-        self._logger.debug(resp)
-
-        time.sleep(0.5)
+        self.set_message_format(0)
 
-        self.send_cmd(f'AT+CMGL={state}')
-        resp = self.read_response()
-        self._logger.debug(resp)
-
-        return resp
+        resp = self.command(f'AT+CMGL={state}', timeout=self.LIST_TIMEOUT_SECONDS)
+        return str(resp)
 
     def delete_message(self, index: int = None, delflag: int = 1):
         """Delete message from message storage
@@ -106,20 +389,107 @@ class AT():
         """
         if index is None:
             index = 1
-        self.send_cmd(f'AT+CMGD={index},{delflag}')
-        resp = self.read_response()
-        self._logger.debug(resp)
+        self.command(f'AT+CMGD={index},{delflag}')
+
+    def delete_messages(self, indexes: List[int]) -> None:
+        """Delete messages at indexes
+        複数の+CMGDを1行のコマンドラインにまとめて送る
+        途中の+CMGDが失敗すると同じ行の残りは実行されないので、全ての行を送ってから例外を投げる(呼び出し元は次回全件取得して削除し直す)
+
+        Args:
+            indexes (List[int]): indexes
+
+        Raises:
+            ATCommandError: Some messages were not deleted
+        """
+        failed = None
+        cmd_list = [f'+CMGD={index}' for index in indexes]
+        while len(cmd_list):
+            line = 'AT' + cmd_list.pop(0)
+            while len(cmd_list) and len(line) + 1 + len(cmd_list[0]) <= self.MAX_COMMAND_LINE_LENGTH:
+                line += ';' + cmd_list.pop(0)
+            resp = self.command(line, check=False)
+            if not resp.ok:
+                self._logger.warn('Failed to delete message: {}: {}'.format(line, resp.result))
+                failed = failed or resp
+        if failed is not None:
+            raise ATCommandError(failed)
 
     def check_message_storage(self,):
-        """Check message storage
+        """Check message storage (read only)
+        選択中のストレージ(set_message_storage()でME/MTにしていればそのまま)と件数を確認する
 
         [参]
         - [3.2.2 Preferred Message Storage +CPMS] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27005-a00.pdf
         """
-        self.send_cmd('AT+CPMS="SM"')
-        resp = self.read_response()
-        self._logger.debug(resp)
-        return resp
+        resp = self.command('AT+CPMS?')
+        self.update_storage_count(resp)
+        return str(resp)
+
+    def ping(self, timeout: float = 1) -> None:
+        """Check that the modem answers (liveness probe)
+
+        Args:
+            timeout (float, optional): Seconds to wait OK. Defaults to 1.
+        """
+        self.command('AT', timeout=timeout)
+
+    def soft_reset(self,) -> None:
+        """Reset the modem (AT+CFUN=1,1)
+        モデムが再起動してUSBが再接続されるので、このポートはもう使えない(デバイスが現れるのを待って開き直す)
+
+        [参]
+        - [8.2 Set phone functionality +CFUN] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27007-a00.pdf
+        """
+        self.reset_state()
+        self.command('AT+CFUN=1,1', check=False)
+
+    def get_message_count(self,) -> Tuple[int, int]:
+        """Get used and total count of the message storage to read (<mem1>)
+        +CMGLより安価なので、一覧を取得する前に件数だけ確認するのに使う
+
+        [参]
+        - [3.2.2 Preferred Message Storage +CPMS] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_10/5_Appendix/Rel10/27/27005-a00.pdf
+
+        Returns:
+            Tuple[int, int]: (used, total) ex) +CPMS: "SM",3,30,"SM",3,30,"SM",3,30 -> (3, 30)
+        """
+        resp = self.command('AT+CPMS?')
+        if not self.update_storage_count(resp):
+            raise ATError('No +CPMS in response: {}'.format(resp))
+        return self.storage_used, self.storage_total
+
+    def update_storage_count(self, resp: ATResponse) -> bool:
+        """Update storage_used/storage_total from a +CPMS response
+
+        Args:
+            resp (ATResponse): Response of AT+CPMS? or AT+CPMS=
+
+        Returns:
+            bool: True if updated
+        """
+        for line in resp.lines:
+            if line.startswith('+CPMS:'):
+                counts = self.parse_storage_count(line)
+                if len(counts):
+                    self.storage_used, self.storage_total = counts[0]
+                    return True
+        return False
+
+    @staticmethod
+    def parse_storage_count(line: str) -> List[Tuple[int, int]]:
+        """Parse used/total counts of +CPMS
+        ex) '+CPMS: "SM",3,30,"SM",3,30,"ME",0,100' -> [(3, 30), (3, 30), (0, 100)]
+            '+CPMS: 3,30,3,30,0,100' -> [(3, 30), (3, 30), (0, 100)]
+
+        Args:
+            line (str): +CPMS line
+
+        Returns:
+            List[Tuple[int, int]]: (used, total) of <mem1>, <mem2>, <mem3>
+        """
+        numbers = [int(v) for v in (v.strip() for v in line[len('+CPMS:'):].split(',')) if v.isdigit()]
+        return [(numbers[i], numbers[i + 1]) for i in range(0, len(numbers) - 1, 2)]
 
     def send_cmd(self, cmd: str) -> None:
         """Send command
@@ -130,6 +500,72 @@ class AT():
         cmd = cmd + '\r'
         cmd = cmd.encode('utf-8')
         self.serial.write(cmd)
+        if self._capture is not None:
+            self._record('tx', cmd)
+
+
+class ModemSession():
+    """Long-lived modem session
+    シリアルポートを開いたままにし、障害を検知したときだけ開き直す
+    """
+
+    def __init__(self, port: str, baudrate: int = 460800, timeout: int = 3, capture_filename: Optional[str] = None,
+                 log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            port (str): Serial port
+            baudrate (int, optional): Baudrate. Defaults to 460800.
+            timeout (int, optional): Default command timeout seconds. Defaults to 3.
+            capture_filename (Optional[str], optional): Record serial traffic to this file (JSONL). Defaults to None.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.capture_filename = capture_filename
+        self.log_level = log_level
+
+        self._at = None
+
+    def __enter__(self,) -> AT:
+        return self.get()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        # 応答なしは状態不明のため開き直す(ERROR応答はポートに問題がないのでそのまま)
+        if exc_type is not None and issubclass(exc_type, (serial.SerialException, OSError, ATTimeoutError)):
+            self._logger.warn('Serial failure, reopen port on next use: {}'.format(exc_value))
+            self.invalidate()
+        return False
+
+    def get(self,) -> AT:
+        """Get AT instance, opening the port if needed
+
+        Returns:
+            AT: AT instance
+        """
+        if self._at is None or not self._at.is_open:
+            self._logger.debug('Open %s', self.port)
+            self._at = AT(port=self.port, baudrate=self.baudrate, timeout=self.timeout, capture_filename=self.capture_filename,
+                          log_level=self.log_level)
+        return self._at
+
+    def invalidate(self,) -> None:
+        """Close the port and forget modem state
+        """
+        if self._at is not None:
+            try:
+                self._at.close()
+            except Exception as e:  # noqa
+                self._logger.debug(e)
+        self._at = None
+
+    def close(self,) -> None:
+        """Close session
+        """
+        self.invalidate()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
+import queue
+import atexit
 import platform
+import threading
 import logging
 import logging.handlers
-from typing import Any, Union
+from typing import Any, Dict, Union
 
 # Check platform
 WINDOWS_OR_WSL = True if 'Windows' in platform.platform() or 'microsoft' in platform.platform() else False  # pragma: no cover
@@ -14,14 +17,32 @@ except ImportError:
     pass
 
 
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread
+    %形式の引数は呼び出し元のスレッドで展開する(後から変更される引数・例外を投げる__str__を出力スレッドで評価しないように)。
+    日時・例外のトレースバックの整形は出力スレッドで行う。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 class Logger():
     """Logger.
+    ハンドラはプロセスで1回だけ設定する(ルートロガーのQueueHandlerから出力スレッドのQueueListenerへ渡す)。
+    何度生成しても同じ名前のロガーにハンドラが増えることはなく、シリアル・Slackのスレッドが標準出力やjournaldの書き込みを待たない。
     """
 
     # LOGGING_FMT = '[%(asctime)s.%(msecs)-3d][%(levelname)8s] %(message)s'
     LOGGING_FMT = '[%(asctime)s.%(msecs)-3d][%(levelname)8s][%(name)20.20s] %(message)s'
     LOGGING_DATE_FMT = '%Y/%m/%d %H:%M:%S'
 
+    _lock = threading.Lock()
+    _listener: Union[logging.handlers.QueueListener, None] = None
+    _handlers: Dict[str, logging.Handler] = {}  # 出力先(stream, journal, ファイル名) -> ハンドラ
+
     def __init__(self, name: Union[str, None] = None, filename: Union[str, None] = None,
                  stream: bool = True, journal_output: bool = False, level: Union[str, None] = logging.INFO) -> None:
         """Initialize.
@@ -38,20 +59,49 @@ class Logger():
 
         self.level = level
 
-        fmt = logging.Formatter(fmt=self.LOGGING_FMT, datefmt=self.LOGGING_DATE_FMT)
-        if filename is not None:  # File
-            file_handler = logging.handlers.RotatingFileHandler(filename, encoding='utf-8', maxBytes=100000, backupCount=10)
-            file_handler.setFormatter(fmt)
-            self.logger.addHandler(file_handler)
-        if stream:  # Stream
-            stream_handler = logging.StreamHandler()
-            stream_handler.setFormatter(fmt)
-            self.logger.addHandler(stream_handler)
-        if not WINDOWS_OR_WSL and journal_output:  # pragma: no cover
-            self.logger.addHandler(journal.JournaldLogHandler())
-
-        # Coloring
-        self.coloring()
+        self.setup(filename=filename, stream=stream, journal_output=journal_output)
+
+    @classmethod
+    def setup(cls, filename: Union[str, None] = None, stream: bool = True, journal_output: bool = False) -> None:
+        """Set up handlers once per process (only outputs not yet configured are added)
+
+        Args:
+            filename (Union[str, None], optional): Filename to save log. Defaults to None.
+            stream (bool, optional): Output to stream. Defaults to True.
+            journal_output (bool, optional): Output to journal. Defaults to False.
+        """
+        with cls._lock:
+            fmt = logging.Formatter(fmt=cls.LOGGING_FMT, datefmt=cls.LOGGING_DATE_FMT)
+            handlers = {}
+            if filename is not None and filename not in cls._handlers:  # File
+                handlers[filename] = logging.handlers.RotatingFileHandler(filename, encoding='utf-8', maxBytes=100000, backupCount=10)
+                handlers[filename].setFormatter(fmt)
+            if stream and 'stream' not in cls._handlers:  # Stream
+                handlers['stream'] = logging.StreamHandler()
+                handlers['stream'].setFormatter(cls.coloring() or fmt)
+            if not WINDOWS_OR_WSL and journal_output and 'journal' not in cls._handlers:  # pragma: no cover
+                handlers['journal'] = journal.JournaldLogHandler()
+            if len(handlers) == 0:
+                return
+            cls._handlers.update(handlers)
+
+            if cls._listener is None:
+                q = queue.SimpleQueue()
+                cls._listener = logging.handlers.QueueListener(q, *cls._handlers.values(), respect_handler_level=True)
+                cls._listener.start()
+                logging.getLogger().addHandler(_QueueHandler(q))
+                atexit.register(cls.shutdown)
+            else:
+                cls._listener.handlers = tuple(cls._handlers.values())
+
+    @classmethod
+    def shutdown(cls,) -> None:
+        """Flush queued records and stop the listener thread
+        """
+        with cls._lock:
+            if cls._listener is not None:
+                cls._listener.stop()
+                cls._listener = None
 
     def set_level(self, level: int) -> None:
         """Set log level.
@@ -61,50 +111,67 @@ class Logger():
         """
         self.logger.setLevel(level)
 
-    def debug(self, message: Any) -> None:
+    def debug(self, message: Any, *args: Any) -> None:
         """Debug log.
 
         Args:
-            message (Any): Debug log message
+            message (Any): Debug log message (%-style format, formatted only when output)
+            args (Any): Arguments for message
         """
-        self.logger.debug(message)
+        self.logger.debug(message, *args)
 
-    def info(self, message: Any) -> None:
+    def info(self, message: Any, *args: Any) -> None:
         """Info log.
 
         Args:
             message (Any): Info log message
+            args (Any): Arguments for message
         """
-        self.logger.info(message)
+        self.logger.info(message, *args)
 
-    def warn(self, message: Any) -> None:
+    def warn(self, message: Any, *args: Any) -> None:
         """Warning log.
 
         Args:
             message (Any): Warning log message
+            args (Any): Arguments for message
         """
-        self.logger.warn(message)
+        self.logger.warning(message, *args)
 
-    def error(self, message: Any) -> None:
+    def error(self, message: Any, *args: Any) -> None:
         """Error log.
 
         Args:
             message (Any): Error log message
+            args (Any): Arguments for message
         """
-        self.logger.error(message)
+        self.logger.error(message, *args)
 
-    def critical(self, message: Any) -> None:
+    def critical(self, message: Any, *args: Any) -> None:
         """Critical log.
 
         Args:
             message (Any): Critical log message
+            args (Any): Arguments for message
         """
-        self.logger.critical(message)
+        self.logger.critical(message, *args)
 
     # --------------------------------------------------
 
-    def coloring(self,):
+    def is_enabled_for(self, level: int) -> bool:
+        """Check if the level is output (to skip building expensive messages)
+
+        Args:
+            level (int): Log level
+        """
+        return self.logger.isEnabledFor(level)
+
+    @classmethod
+    def coloring(cls,) -> Union[logging.Formatter, None]:
         """Coloring logs.
+
+        Returns:
+            Union[logging.Formatter, None]: Formatter for the stream (None if coloredlogs is not installed)
         """
         try:
             LEVEL_STYLES = dict(debug=dict(color='green'),
@@ -115,11 +182,9 @@ class Logger():
             FIELD_STYLES = dict(asctime=dict(color=''),
                                 levelname=dict(color='black', bold=True))
 
-            coloredlogs.install(logger=self.logger,
-                                level=self.level,
-                                fmt=self.LOGGING_FMT,
-                                datefmt=self.LOGGING_DATE_FMT,
-                                level_styles=LEVEL_STYLES,
-                                field_styles=FIELD_STYLES)
+            return coloredlogs.ColoredFormatter(fmt=cls.LOGGING_FMT,
+                                                datefmt=cls.LOGGING_DATE_FMT,
+                                                level_styles=LEVEL_STYLES,
+                                                field_styles=FIELD_STYLES)
         except (ImportError, NameError):
-            pass
+            return None
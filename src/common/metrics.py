@@ -0,0 +1,274 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format."""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+# 秒単位の処理時間用(ATコマンド・Slack API・デコードなど)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# SMSの受信からSlackへの送信完了まで・分割SMSの待ち時間用
+DELIVERY_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# 件数・サイズ用
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 20000, 100000)
+
+
+def _format_value(v: float) -> str:
+    if v == float('inf'):
+        return '+Inf'
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = '') -> str:
+    items = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in zip(labelnames, labelvalues)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if len(items) else ''
+
+
+class Counter():
+    """Monotonically increasing counter
+    記録はロックを取らない(GILの下で加算が稀に失われることは許容する)
+    """
+
+    def __init__(self,) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge():
+    """Value that can go up and down, or is read from a function at scrape time
+    """
+
+    def __init__(self,) -> None:
+        self.value = 0
+        self.function: Union[Callable[[], float], None] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the value from function when exposed (nothing to record on the hot path)
+        """
+        self.function = function
+
+    def get(self,) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram():
+    """Histogram with preallocated buckets
+    バケットは作成時に確保し、記録は二分探索と加算だけ(ロックなし)
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Approximate quantile (upper bound of the bucket)
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, c in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += c
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metric():
+    """Metric family with optional labels
+    ラベルの組ごとの子(Counter/Gauge/Histogram)は初回だけロックを取って作る
+    """
+
+    TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+    def __init__(self, name: str, documentation: str, type: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        """Initialize
+
+        Args:
+            name (str): Metric name
+            documentation (str): Help text
+            type (str): {counter | gauge | histogram}
+            labelnames (Sequence[str], optional): Label names. Defaults to ().
+            buckets (Sequence[float], optional): Histogram bucket upper bounds. Defaults to LATENCY_BUCKETS.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._children: Dict[Tuple[str, ...], Union[Counter, Gauge, Histogram]] = {}
+        self._lock = threading.Lock()
+        self._default = self._create() if len(self.labelnames) == 0 else None
+
+    def _create(self,) -> Union[Counter, Gauge, Histogram]:
+        return Histogram(self.buckets) if self.type == 'histogram' else self.TYPES[self.type]()
+
+    def labels(self, *labelvalues: str) -> Union[Counter, Gauge, Histogram]:
+        """Child for label values
+
+        Returns:
+            Union[Counter, Gauge, Histogram]: Child metric
+        """
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._create())
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.inc(amount)
+
+    def set(self, value: float) -> None:
+        self._default.set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._default.set_function(function)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+    def children(self,) -> List[Tuple[Tuple[str, ...], Union[Counter, Gauge, Histogram]]]:
+        if self._default is not None:
+            return [((), self._default)]
+        return list(self._children.items())
+
+    def expose(self,) -> List[str]:
+        """Prometheus text format lines
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        for labelvalues, child in self.children():
+            if self.type == 'histogram':
+                cumulative = 0
+                for bound, c in zip(child.buckets + (float('inf'),), list(child.counts)):
+                    cumulative += c
+                    le = 'le="{}"'.format(_format_value(bound))
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues, le), cumulative))
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(child.sum)))
+                lines.append('{}_count{} {}'.format(self.name, labels, child.count))
+            else:
+                value = child.get() if self.type == 'gauge' else child.value
+                lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues), _format_value(value)))
+        return lines
+
+
+class Registry():
+    """Collection of metrics
+    """
+
+    def __init__(self,) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, documentation: str, type: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Metric:
+        """Get metric, creating it on first call
+
+        Returns:
+            Metric: Metric
+        """
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = Metric(name, documentation, type, labelnames, buckets)
+                self._metrics[name] = metric
+            return metric
+
+    def metrics(self,) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def expose(self,) -> str:
+        """All metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics():
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+    def summary(self,) -> str:
+        """Human readable summary (count, mean, p50, p95 of histograms and counter values)
+        """
+        lines = []
+        for metric in self.metrics():
+            for labelvalues, child in metric.children():
+                name = metric.name + (_format_labels(metric.labelnames, labelvalues) if len(labelvalues) else '')
+                if metric.type == 'histogram':
+                    if child.count == 0:
+                        continue
+                    p50, p95 = _format_value(child.quantile(0.5)), _format_value(child.quantile(0.95))
+                    lines.append('{}: n={} avg={:.4g} p50<={} p95<={}'.format(name, child.count, child.sum / child.count, p50, p95))
+                else:
+                    value = child.get() if metric.type == 'gauge' else child.value
+                    lines.append('{}: {}'.format(name, _format_value(value)))
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Metric:
+    return REGISTRY.register(name, documentation, 'counter', labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Metric:
+    return REGISTRY.register(name, documentation, 'gauge', labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Metric:
+    return REGISTRY.register(name, documentation, 'histogram', labelnames, buckets)
+
+
+class MetricsServer():
+    """HTTP server exposing /metrics
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9108, registry: Registry = REGISTRY) -> None:
+        """Initialize
+
+        Args:
+            host (str, optional): Listen address. Defaults to '127.0.0.1'.
+            port (int, optional): Listen port. Defaults to 9108.
+            registry (Registry, optional): Metrics to expose. Defaults to REGISTRY.
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = registry.expose().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    def start(self,) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self,) -> None:
+        self.server.shutdown()
+        self.server.server_close()
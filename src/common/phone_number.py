@@ -0,0 +1,134 @@
+"""Phone number normalization and prefix matching."""
+import re
+from typing import Dict, List, Union
+
+DEFAULT_COUNTRY_CODE = '81'  # 日本
+
+_SEPARATOR_RE = re.compile(r'[\s\-().]')
+_NUMBER_RE = re.compile(r'\+?[0-9]+')
+
+
+def normalize_number(number: str, country_code: str = DEFAULT_COUNTRY_CODE) -> str:
+    """Normalize phone number to E.164
+    国内番号(先頭0)・国番号付き(+なし)を+付きのE.164に揃える。英数字の送信元や短縮番号はそのまま返す。
+
+    ex) '090-1234-5678' -> '+819012345678', '819012345678' -> '+819012345678', 'NTT DOCOMO' -> 'NTT DOCOMO'
+
+    Args:
+        number (str): Phone number
+        country_code (str, optional): Country code used for national numbers. Defaults to DEFAULT_COUNTRY_CODE.
+
+    Returns:
+        str: Normalized number
+    """
+    number = number.strip()
+    digits = _SEPARATOR_RE.sub('', number)
+    if not _NUMBER_RE.fullmatch(digits):
+        return number
+
+    if digits.startswith('+'):
+        return digits
+    if digits.startswith('0'):  # 国内プレフィックス
+        return '+' + country_code + digits[1:]
+    if digits.startswith(country_code) and len(digits) >= len(country_code) + 9:  # 国番号付き(+なし)
+        return '+' + digits
+    return digits
+
+
+class PrefixTrie():
+    """Prefix trie
+    登録されたプレフィックスのいずれかで始まるかを文字列長に比例する時間で判定する
+    """
+
+    _END = ''  # 終端を表すキー(1文字のキーとは衝突しない)
+
+    def __init__(self,) -> None:
+        """Initialize
+        """
+        self._root: Dict[str, dict] = {}
+        self._size = 0
+
+    def __len__(self,) -> int:
+        return self._size
+
+    def add(self, prefix: str, value=True) -> None:
+        """Add prefix
+
+        Args:
+            prefix (str): Prefix
+            value (Any, optional): Value returned by match(). Defaults to True.
+        """
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        if self._END not in node:
+            self._size += 1
+        node[self._END] = value
+
+    def remove(self, prefix: str) -> bool:
+        """Remove prefix
+
+        Args:
+            prefix (str): Prefix
+
+        Returns:
+            bool: False if prefix does not exist
+        """
+        path = [self._root]
+        for c in prefix:
+            node = path[-1].get(c)
+            if node is None:
+                return False
+            path.append(node)
+        if self._END not in path[-1]:
+            return False
+
+        del path[-1][self._END]
+        self._size -= 1
+        for i in range(len(prefix) - 1, -1, -1):  # 空になったノードを削除
+            if len(path[i + 1]):
+                break
+            del path[i][prefix[i]]
+        return True
+
+    def match(self, s: str) -> Union[object, None]:
+        """Find the longest prefix of s
+
+        Args:
+            s (str): String
+
+        Returns:
+            Union[object, None]: Value of the longest matching prefix. None if no prefix matches.
+        """
+        found = None
+        node = self._root
+        if self._END in node:
+            found = node[self._END]
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            if self._END in node:
+                found = node[self._END]
+        return found
+
+    def match_all(self, s: str) -> List[object]:
+        """Find all prefixes of s
+
+        Args:
+            s (str): String
+
+        Returns:
+            List[object]: Values of matching prefixes (shortest first)
+        """
+        found = []
+        node = self._root
+        if self._END in node:
+            found.append(node[self._END])
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            if self._END in node:
+                found.append(node[self._END])
+        return found
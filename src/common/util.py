@@ -1,33 +1,113 @@
 """Util."""
+import glob
+import shutil
 import subprocess
-import psutil
+from typing import Union
 
+VCGENCMD = shutil.which('vcgencmd')  # Raspberry Pi以外ではNone
 
-def get_raspberry_pi_info() -> dict:
-    """Get Raspberry Pi info.
+# get_throttledのビット
+# [参] https://www.raspberrypi.com/documentation/computers/os.html#get_throttled
+THROTTLED_FLAGS = {
+    0: 'under-voltage',
+    1: 'arm frequency capped',
+    2: 'throttled',
+    3: 'soft temperature limit',
+}
+THROTTLED_OCCURRED_SHIFT = 16  # 起動後に発生したことがあるもの
+
+
+def _vcgencmd(*args: str) -> Union[str, None]:
+    """Run vcgencmd
 
     Returns:
-        dict: Raspberry Pi info
+        Union[str, None]: Value after '=' (None if unavailable)
     """
-    info = {}
+    if VCGENCMD is None:
+        return None
+    try:
+        p = subprocess.run([VCGENCMD, *args], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if p.returncode != 0 or '=' not in p.stdout:
+        return None
+    return p.stdout.strip().split('=', 1)[1]
+
 
-    cpu_percent = psutil.cpu_percent()
-    mem = psutil.virtual_memory()
-    mem_percent = mem.used / mem.total * 100
-    dsk_percent = psutil.disk_usage('/').percent
+def _read_sysfs(path: str) -> Union[str, None]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
 
-    info['cpu'] = f'{cpu_percent}%'
-    info['mem'] = f'{mem_percent:.1f}%'
-    info['dsk'] = f'{dsk_percent:.1f}%'
 
-    cmd = ['vcgencmd', 'measure_temp']
-    p = subprocess.run(cmd, encoding='utf-8',
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    info['temp'] = p.stdout.strip().replace('temp=', '')
+def read_soc_temperature() -> Union[float, None]:
+    """SoC temperature in degrees Celsius
+    vcgencmdがなければsysfsのthermal zone(cpu-thermalを優先)から読む
+
+    Returns:
+        Union[float, None]: Temperature (None if unavailable)
+    """
+    value = _vcgencmd('measure_temp')  # 45.1'C
+    if value is not None:
+        try:
+            return float(value.rstrip("'C"))
+        except ValueError:
+            pass
 
-    cmd = ['vcgencmd', 'measure_volts']
-    p = subprocess.run(cmd, encoding='utf-8',
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    info['volt'] = p.stdout.strip().replace('volt=', '')
+    zones = sorted(glob.glob('/sys/class/thermal/thermal_zone*'))
+    zones.sort(key=lambda zone: _read_sysfs(zone + '/type') not in ('cpu-thermal', 'cpu_thermal', 'soc_thermal', 'x86_pkg_temp'))
+    for zone in zones:
+        value = _read_sysfs(zone + '/temp')  # ミリ度
+        if value is not None and value.lstrip('-').isdigit():
+            return int(value) / 1000
+    return None
+
+
+def read_core_volts() -> Union[float, None]:
+    """Core voltage
+
+    Returns:
+        Union[float, None]: Voltage (None if unavailable)
+    """
+    value = _vcgencmd('measure_volts')  # 0.8600V
+    try:
+        return float(value.rstrip('V')) if value is not None else None
+    except ValueError:
+        return None
 
-    return info
+
+def read_throttled() -> Union[int, None]:
+    """Throttled state bits (vcgencmd get_throttled)
+    vcgencmdがなければファームウェアのsysfs(Raspberry Pi OSのカーネル)から読む
+
+    Returns:
+        Union[int, None]: Bits (None if unavailable)
+    """
+    value = _vcgencmd('get_throttled')  # 0x50000
+    if value is None:
+        value = _read_sysfs('/sys/devices/platform/soc/soc:firmware/get_throttled')
+        if value is not None:
+            value = '0x' + value
+    try:
+        return int(value, 16) if value is not None else None
+    except ValueError:
+        return None
+
+
+def describe_throttled(bits: int) -> str:
+    """Human readable throttled state
+
+    Args:
+        bits (int): get_throttled bits
+
+    Returns:
+        str: ex) 'throttled (occurred: under-voltage)'
+    """
+    now = [name for bit, name in THROTTLED_FLAGS.items() if bits & (1 << bit)]
+    occurred = [name for bit, name in THROTTLED_FLAGS.items() if bits & (1 << (bit + THROTTLED_OCCURRED_SHIFT))]
+    text = ', '.join(now) or 'ok'
+    if len(occurred):
+        text += ' (occurred: {})'.format(', '.join(occurred))
+    return text
@@ -0,0 +1,132 @@
+"""Persistent index of forwarded SMS fingerprints."""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import collections
+import logging
+from typing import Union
+
+from common.log import Logger
+
+
+def fingerprint(sms: dict) -> str:
+    """Fingerprint of a SMS (or a reassembled concatenated SMS)
+    送信元・サービスセンタのタイムスタンプ・分割SMSの整理番号・本文から作る。同じSMSの再取得・再配信は同じ値になる。
+
+    Args:
+        sms (dict): SMS
+
+    Returns:
+        str: Fingerprint (hex)
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update('{}\x00{}\x00{}\x00{}\x00'.format(sms.get('modem', ''), sms['from_number'], sms.get('received_at'),
+                                               sms.get('reference')).encode('utf-8'))
+    h.update(hashlib.blake2b(sms['message'].encode('utf-8'), digest_size=16).digest())
+    return h.hexdigest()
+
+
+class DedupIndex():
+    """Bounded persistent index of forwarded SMS
+    転送済みのSMSの指紋を最大max_entries件、ttl_seconds間保持する。
+    判定はメモリ上のLRU(OrderedDict)だけで行い、SQLiteには再起動後に引き継ぐために書き込む(LRUから溢れたものは削除する)。
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS forwarded (
+        fingerprint TEXT PRIMARY KEY,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS forwarded_created_at ON forwarded (created_at);
+    '''
+
+    def __init__(self, filename: str = '../data/dedup.sqlite3', max_entries: int = 10000, ttl_seconds: float = 7 * 24 * 3600,
+                 log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            filename (str, optional): SQLite database filename. Defaults to '../data/dedup.sqlite3'.
+            max_entries (int, optional): Maximum fingerprints to keep. Defaults to 10000.
+            ttl_seconds (float, optional): Seconds to keep a fingerprint. Defaults to 7 days.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')  # 記録後はSIMから削除するので確実に書き込む
+        self._conn.executescript(self.SCHEMA)
+
+        self._entries = collections.OrderedDict()  # fingerprint -> created_at (古い順)
+        self.load()
+
+    def __len__(self,) -> int:
+        return len(self._entries)
+
+    def load(self,) -> None:
+        """Load fingerprints within TTL (newest max_entries)
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM forwarded WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+            rows = self._conn.execute('SELECT fingerprint, created_at FROM forwarded ORDER BY created_at DESC LIMIT ?',
+                                      (self.max_entries,)).fetchall()
+            self._entries.clear()
+            for fp, created_at in reversed(rows):
+                self._entries[fp] = created_at
+            if len(rows) == self.max_entries:
+                self._conn.execute('DELETE FROM forwarded WHERE created_at < ?', (rows[-1][1],))
+        self._logger.debug('Loaded %d fingerprints', len(self._entries))
+
+    def close(self,) -> None:
+        """Close database
+        """
+        with self._lock:
+            self._conn.close()
+
+    def seen(self, fp: str, now: Union[float, None] = None) -> bool:
+        """Check if already forwarded (memory only)
+
+        Args:
+            fp (str): Fingerprint
+            now (Union[float, None], optional): Current time (time.time()). Defaults to None.
+
+        Returns:
+            bool: True if forwarded within TTL
+        """
+        with self._lock:
+            created_at = self._entries.get(fp)
+            if created_at is None:
+                return False
+            if (time.time() if now is None else now) - created_at >= self.ttl_seconds:
+                return False
+            self._entries.move_to_end(fp)
+            return True
+
+    def add(self, fp: str, now: Union[float, None] = None) -> None:
+        """Record a forwarded SMS
+
+        Args:
+            fp (str): Fingerprint
+            now (Union[float, None], optional): Current time (time.time()). Defaults to None.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._entries[fp] = now
+            self._entries.move_to_end(fp)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+
+            self._conn.execute('INSERT OR REPLACE INTO forwarded (fingerprint, created_at) VALUES (?, ?)', (fp, now))
+            if len(evicted):
+                self._conn.executemany('DELETE FROM forwarded WHERE fingerprint = ?', [(e,) for e in evicted])
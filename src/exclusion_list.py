@@ -1,5 +1,239 @@
 """Processing related to telephone number exclusion lists."""
-from typing import List
+import os
+import re
+import threading
+from typing import Dict, List, Tuple, Union
+
+from common.phone_number import DEFAULT_COUNTRY_CODE, PrefixTrie, normalize_number
+
+EXCLUSION_LIST_FILENAME = '../config/exclude_number.txt'
+EXCLUSION_JOURNAL_FILENAME = '../config/exclude_number.journal'
+
+_SPLIT_RE = re.compile(r'[,\n]')
+
+
+class _View():
+    """In-memory view of the exclusion list
+    再読み込み時は新しいViewを作ってから差し替えるので、match()はロックなしで読める。
+    """
+
+    __slots__ = ('entries', 'numbers', 'prefix_counts', 'prefixes')
+
+    def __init__(self,) -> None:
+        self.entries: Dict[str, None] = {}  # 挿入順を保持する集合
+        self.numbers: Dict[str, int] = {}  # 正規化した番号: 参照数
+        self.prefix_counts: Dict[str, int] = {}  # 正規化したプレフィックス: 参照数
+        self.prefixes = PrefixTrie()
+
+
+class ExclusionStore():
+    """Exclusion list store shared by the forwarding thread and the slash command handlers.
+
+    Changes are appended to a journal and applied to the in-memory view immediately.
+    The list file (snapshot) is rewritten by temp-file-and-rename only when the journal is compacted.
+    The list file is reloaded when it is edited by hand.
+    Numbers are compared in E.164 form. Entries ending with '*' are prefixes (ex. 0120*).
+    """
+
+    COMPACT_JOURNAL_LINES = 1000  # ジャーナルがこの行数を超えたらスナップショットに書き戻す
+
+    def __init__(self, filename: str = EXCLUSION_LIST_FILENAME, journal_filename: str = EXCLUSION_JOURNAL_FILENAME,
+                 country_code: str = DEFAULT_COUNTRY_CODE) -> None:
+        """Initialize.
+
+        Args:
+            filename (str, optional): Exclusion list (snapshot) filename. Defaults to EXCLUSION_LIST_FILENAME.
+            journal_filename (str, optional): Journal filename. Defaults to EXCLUSION_JOURNAL_FILENAME.
+            country_code (str, optional): Country code used for national numbers. Defaults to DEFAULT_COUNTRY_CODE.
+        """
+        self.filename = filename
+        self.journal_filename = journal_filename
+        self.country_code = country_code
+
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._stamp: Union[Tuple[int, int], None] = None  # スナップショットの(mtime, size)
+        self._journal_lines = 0
+
+        self._view = _View()
+
+    @property
+    def entries(self,) -> List[str]:
+        """Exclusion list entries.
+        """
+        self.reload_if_changed()
+        with self._lock:
+            return list(self._view.entries)
+
+    def _stat(self,) -> Union[Tuple[int, int], None]:
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def reload_if_changed(self,) -> None:
+        """Reload snapshot and journal if the snapshot was modified outside this store.
+        """
+        stamp = self._stat()
+        if self._loaded and stamp == self._stamp:
+            return
+
+        with self._lock:
+            # 読み込み中の空の状態がmatch()から見えないように、組み立ててから1回の代入で差し替える
+            view = _View()
+
+            if stamp is not None:
+                with open(self.filename, 'r') as f:
+                    for item in _SPLIT_RE.split(f.read()):
+                        self._apply('+', item.strip(), view)
+
+            journal_lines = 0
+            if os.path.isfile(self.journal_filename):
+                with open(self.journal_filename, 'r') as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if len(line) > 1:
+                            self._apply(line[0], line[1:], view)
+                            journal_lines += 1
+
+            self._view = view
+            self._journal_lines = journal_lines
+            self._stamp = stamp
+            self._loaded = True
+
+            if self._journal_lines > self.COMPACT_JOURNAL_LINES:
+                self.compact()
+
+    def _apply(self, op: str, entry: str, view: Union[_View, None] = None) -> bool:
+        """Apply one change to the in-memory view.
+
+        Args:
+            op (str): '+' (add) or '-' (delete)
+            entry (str): Entry
+            view (Union[_View, None], optional): View to change. Defaults to None (current view).
+
+        Returns:
+            bool: False if nothing changed
+        """
+        view = self._view if view is None else view
+        if len(entry) == 0:
+            return False
+        if (op == '+') == (entry in view.entries):
+            return False
+
+        if entry.endswith('*'):
+            key = normalize_number(entry[:-1], self.country_code)
+            counts = view.prefix_counts
+        else:
+            key = normalize_number(entry, self.country_code)
+            counts = view.numbers
+
+        if op == '+':
+            view.entries[entry] = None
+            counts[key] = counts.get(key, 0) + 1
+            if counts is view.prefix_counts and counts[key] == 1:
+                view.prefixes.add(key)
+        else:
+            del view.entries[entry]
+            counts[key] -= 1
+            if counts[key] == 0:
+                del counts[key]
+                if counts is view.prefix_counts:
+                    view.prefixes.remove(key)
+        return True
+
+    def _write_journal(self, lines: List[str]) -> None:
+        with open(self.journal_filename, 'a') as f:
+            f.write(''.join([line + '\n' for line in lines]))
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_lines += len(lines)
+
+        if self._journal_lines > self.COMPACT_JOURNAL_LINES:
+            self.compact()
+
+    def add(self, entries: List[str]) -> int:
+        """Add entries.
+
+        Args:
+            entries (List[str]): Entries to be excluded
+
+        Returns:
+            int: Number of added entries (existing entries are skipped)
+        """
+        self.reload_if_changed()
+        with self._lock:
+            lines = []
+            for entry in entries:
+                entry = entry.strip()
+                if self._apply('+', entry):
+                    lines.append('+' + entry)
+            if len(lines):
+                self._write_journal(lines)
+            return len(lines)
+
+    def delete(self, entry: str) -> bool:
+        """Delete entry.
+
+        Args:
+            entry (str): Entry to be removed
+
+        Returns:
+            bool: False if entry does not exist
+        """
+        self.reload_if_changed()
+        with self._lock:
+            if not self._apply('-', entry):
+                return False
+            self._write_journal(['-' + entry])
+            return True
+
+    def compact(self,) -> None:
+        """Write the current list to the snapshot (temp file and rename) and clear the journal.
+        """
+        with self._lock:
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                f.write(''.join([entry + '\n' for entry in self._view.entries]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+            self._stamp = self._stat()
+
+            # スナップショットに反映済みなので空にする(途中で落ちても再適用して同じ結果になる)
+            with open(self.journal_filename, 'w') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_lines = 0
+
+    def match(self, number: str) -> bool:
+        """Check if number is excluded.
+
+        Args:
+            number (str): Sender number
+
+        Returns:
+            bool: True if excluded
+        """
+        self.reload_if_changed()
+
+        number = normalize_number(number, self.country_code)
+        view = self._view
+        return number in view.numbers or view.prefixes.match(number) is not None
+
+
+_store = ExclusionStore()
+
+
+def get_exclusion_store() -> ExclusionStore:
+    """Get exclusion list store shared in the process.
+
+    Returns:
+        ExclusionStore: Exclusion list store
+    """
+    return _store
+
 
 def get_exclusion_list() -> List[str]:
     """Get exclusion list.
@@ -7,11 +241,8 @@ def get_exclusion_list() -> List[str]:
     Returns:
         List[str]: Exclusion list
     """
-    with open('../config/exclude_number.txt', 'r') as f:
-        data = f.read()
-    data = data.strip().split('\n')
-    data = sum(list(map(lambda x: x.split(','), data)), [])  # flatten
-    return data
+    return _store.entries
+
 
 def add_exclusion_list(number: str) -> None:
     """Add exclusion list.
@@ -19,8 +250,19 @@ def add_exclusion_list(number: str) -> None:
     Args:
         number (str): Number to be excluded
     """
-    with open('../config/exclude_number.txt', 'a') as f:
-        f.write(str(number) + '\n')
+    _store.add([str(number)])
+
+
+def import_exclusion_list(numbers: List[str]) -> int:
+    """Add many numbers to exclusion list at once.
+
+    Args:
+        numbers (List[str]): Numbers to be excluded
+
+    Returns:
+        int: Number of added entries (existing entries are skipped)
+    """
+    return _store.add(numbers)
 
 
 def delete_exclusion_list(number: str) -> bool:
@@ -32,13 +274,4 @@ def delete_exclusion_list(number: str) -> bool:
     Returns:
         bool: False if number does not exist in exclusion list
     """
-    data = get_exclusion_list()
-    new_data = [d for d in data if d != number]
-
-    if number not in data:
-        return False
-
-    with open('../config/exclude_number.txt', 'w') as f:
-        for d in new_data:
-            f.write(str(d) + '\n')
-    return True
+    return _store.delete(number)
@@ -1,33 +1,43 @@
-import os
 import sys
-import time
 import configparser
 import json
-import datetime
+import time
+import threading
 import pprint  # noqa
 from typing import List
 import logging
 
-import schedule
-import jinja2
 from slack_sdk import WebClient
 
-from at import AT
-from sms_pdu import PDU
+from sms_pdu import PDU, decode_many
+from reassembly import ReassemblyBuffer
+from outbox import Outbox
+from archive import SMSArchive
+from dedup import DedupIndex, fingerprint
+from template_registry import TemplateRegistry
+from routing import Router
+from modem_worker import ModemWorker
+from slack_sender import SlackSender
 
-from exclusion_list import get_exclusion_list
+from exclusion_list import get_exclusion_store
 
 from common.log import Logger
+from common import metrics
+
+_DECODE_SECONDS = metrics.histogram('sms_decode_seconds', 'Time to decode one AT+CMGL listing into PDUs.')
+_RENDER_SECONDS = metrics.histogram('sms_render_seconds', 'Time to route and render one SMS.')
+_FORWARDED = metrics.counter('sms_forwarded_total', 'SMS handled by the pipeline.', ('result',))
 
 
 class SMSForwardingTask():
     LOGGING_FMT = '[%(asctime)s.%(msecs)-3d][%(levelname)8s] %(message)s'
     LOGGING_DATE_FMT = '%Y/%m/%d %H:%M:%S'
 
-    def __init__(self, log_level: int = logging.INFO) -> None:
+    def __init__(self, runtime: str = 'thread', log_level: int = logging.INFO) -> None:
         """Initialize
 
         Args:
+            runtime (str, optional): {thread | asyncio}. asyncio posts to Slack with AsyncWebClient (run by async_runtime.AsyncRuntime). Defaults to 'thread'.
             log_level (int, optional): Level of logging. Defaults to logging.INFO.
         """
         self._logger = Logger(name=__name__, level=log_level)
@@ -38,18 +48,109 @@ class SMSForwardingTask():
         with open('../token.json', 'r') as f:
             token = json.load(f)
 
-        self.client = WebClient(token=token['bot_token'])
+        self.runtime = runtime
+        self.outbox = Outbox(log_level=log_level)
+        sender_options = dict(rate_per_second=float(config.get('slack', 'rate_per_second', fallback='1')),
+                              burst=int(config.get('slack', 'burst', fallback='3')),
+                              coalesce_max_messages=int(config.get('slack', 'coalesce_max_messages', fallback='10')),
+                              coalesce_max_chars=int(config.get('slack', 'coalesce_max_chars', fallback='12000')),
+                              log_level=log_level)
+        if runtime == 'asyncio':
+            from slack_sdk.web.async_client import AsyncWebClient
+            from async_runtime import AsyncSlackSender
+
+            self.client = AsyncWebClient(token=token['bot_token'])
+            self.slack_sender = AsyncSlackSender(self.client, self.outbox, **sender_options)
+        else:
+            self.client = WebClient(token=token['bot_token'])
+            self.slack_sender = SlackSender(self.client, self.outbox, **sender_options)
 
-        self.port = config['serial']['port']
         self.slack_channel = config['setting']['slack_channel']
-        self.interval_seconds = int(config['setting']['polling_seconds'])
+        self.alert_channel = config.get('watchdog', 'alert_channel', fallback=self.slack_channel)
+
+        self.workers = self.create_workers(config, log_level)
+        self.exclusion_store = get_exclusion_store()
+        self.archive = SMSArchive(flush_seconds=float(config.get('archive', 'flush_seconds', fallback='10')),
+                                  compress=config.get('archive', 'compress', fallback='true').lower() == 'true',
+                                  log_level=log_level)
+        self.templates = TemplateRegistry(default=config.get('template', 'default', fallback='slack_message_template.txt'),
+                                          kind_templates={k: config.get('template', k)
+                                                          for k in (TemplateRegistry.KIND_OTP, TemplateRegistry.KIND_LONG, TemplateRegistry.KIND_UNKNOWN)
+                                                          if config.has_option('template', k)},
+                                          sender_templates=dict(config['template:sender']) if config.has_section('template:sender') else None,
+                                          log_level=log_level)
+
+        metrics.gauge('sms_outbox_depth', 'Messages waiting in the outbox.').set_function(self.outbox.depth)
+        self.metrics_server = None
+        if int(config.get('metrics', 'port', fallback='0')):
+            self.metrics_server = metrics.MetricsServer(host=config.get('metrics', 'host', fallback='127.0.0.1'),
+                                                        port=int(config.get('metrics', 'port')))
+
+        self.dedup = DedupIndex(max_entries=int(config.get('dedup', 'max_entries', fallback='10000')),
+                                ttl_seconds=float(config.get('dedup', 'ttl_hours', fallback='168')) * 3600,
+                                log_level=log_level)
+
+        self.router = Router.from_config(config, log_level=log_level)
+        self._logger.info('Loaded {} routing rules'.format(len(self.router)))
+
+        self._reassembly_lock = threading.Lock()
+        self.reassembly = ReassemblyBuffer(timeout_seconds=int(config['setting'].get('reassembly_timeout_seconds', '600')),
+                                           log_level=log_level)
 
     def __del__(self,):
         """
         """
-        pass
+        for worker in self.workers:
+            worker.close()
+
+    def create_workers(self, config: configparser.ConfigParser, log_level: int = logging.INFO) -> List[ModemWorker]:
+        """Create a worker for each modem
+        [modem:名前]セクションごとに1つ作る。なければ[serial]のモデム1つ。
+        ポート以外の設定は未指定なら[setting]の値を使う。
+
+        Args:
+            config (configparser.ConfigParser): Config
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+
+        Returns:
+            List[ModemWorker]: Workers
+        """
+        sections = [(s[len('modem:'):], config[s]) for s in config.sections() if s.startswith('modem:')]
+        if len(sections) == 0:
+            sections = [('', config['serial'])]
+
+        setting = config['setting']
+        watchdog = config['watchdog'] if config.has_section('watchdog') else {}
+        watchdog_options = dict(probe_seconds=float(watchdog.get('probe_seconds', '60')),
+                                probe_timeout=float(watchdog.get('probe_timeout', '1')),
+                                max_retry_seconds=float(watchdog.get('max_retry_seconds', '30')),
+                                reset_failures=int(watchdog.get('reset_failures', '3')),
+                                alert_failures=int(watchdog.get('alert_failures', '3')))
+        workers = []
+        for name, section in sections:
+            workers.append(ModemWorker(self, name, section['port'],
+                                       baudrate=int(section.get('baudrate', '460800')),
+                                       receive_mode=section.get('receive_mode', setting.get('receive_mode', 'polling')),  # {polling | urc}
+                                       interval_seconds=int(section.get('polling_seconds', setting['polling_seconds'])),
+                                       min_interval_seconds=int(section.get('polling_min_seconds', setting.get('polling_min_seconds', '5'))),
+                                       sweep_seconds=int(section.get('sweep_seconds', setting.get('sweep_seconds', '300'))),
+                                       capture_filename=section.get('capture'),
+                                       watchdog_options=watchdog_options,
+                                       message_storage=section.get('message_storage', setting.get('message_storage')),
+                                       drain_threshold=float(section.get('drain_threshold', setting.get('drain_threshold', '0.8'))),
+                                       log_level=log_level))
+        return workers
+
+    def alert(self, message: str) -> None:
+        """Send an alert to the alert channel (through the outbox)
+
+        Args:
+            message (str): Message
+        """
+        self.outbox.put(self.alert_channel, message)
+        self.slack_sender.notify()
 
-    def decode_pdu_message(self, msg: str) -> List[PDU]:
+    def decode_pdu_message(self, msg: str, modem: str = '') -> List[PDU]:
         """Decode PDU message
         ATコマンドで取得したPDUをデコード
 
@@ -59,14 +160,17 @@ class SMSForwardingTask():
 
         Args:
             msg (str): PDU message. ex) +CMGL: <index>,<stat>,[<alpha>],<length><CR><LF><pdu><CR><LF>
+            modem (str, optional): Modem name. Defaults to ''.
 
         Returns:
             List[PDU]: Decoded PDU list
         """
+        started_at = time.perf_counter()
         msg_list = msg.split('\n')
 
         cmgl_flag = False
-        pi_list = []
+        pdu_line_list = []
+        index_list = []
         for line in msg_list:
             line = line.strip()
 
@@ -77,19 +181,30 @@ class SMSForwardingTask():
                 break
 
             if '+CMGL:' in line:
-                # cmgl_line = line.split(',')
+                cmgl_line = line[len('+CMGL:'):].split(',')
+                index = int(cmgl_line[0])
+                stat = int(cmgl_line[1])
                 # pdu_length = int(cmgl_line[3], 16)
-                cmgl_flag = True
+                cmgl_flag = stat in (0, 1)  # 受信メッセージのみ(2, 3は送信メッセージ)
             elif cmgl_flag:
-                pdu = PDU(line)
-                pi_list.append(pdu)
+                pdu_line_list.append(line)
+                index_list.append(index)
 
                 cmgl_flag = False
 
-        return pi_list
+        pdu_list = decode_many(pdu_line_list)
+        for pdu, index in zip(pdu_list, index_list):
+            pdu.index = index
+            pdu.modem = modem
+        _DECODE_SECONDS.observe(time.perf_counter() - started_at)
+        return pdu_list
 
     def create_sms_list_from_pdu_list(self, pdu_list: List[PDU]) -> List[dict]:
         """Create SMS list from PDU list
+        分割SMSは再構成バッファに入れ、全て揃ったもの・タイムアウトしたものだけをリストに含める
+        デコードできないPDUはPDUの16進文字列をそのまま本文にして転送する(ストレージから削除されず毎回失敗し続けないように)
+        リストに含めた分割SMSはforward_sms()で送信キューに保存するまで再構成バッファ(チェックポイント)に残る
+        再構成バッファは全モデムで共有するため、各モデムのスレッドから呼ばれる
 
         Args:
             pdu_list (List[PDU]): PDU list
@@ -99,86 +214,158 @@ class SMSForwardingTask():
         """
         sms_list = []
 
-        mms_list = list(filter(lambda x: x.pdu['tp_ud']['udh'] is not None, pdu_list))
-        not_mms_list = list(filter(lambda x: x.pdu['tp_ud']['udh'] is None, pdu_list))
-
-        # IED
-        #     Octet1-2 8bit連結SM整理番号
-        #     Octet2   最大SM番号
-        #     Octet3   シーケンス番号
-        linking_number_list = list(set(list(map(lambda x: x.pdu['tp_ud']['udh'][0]['ied'][0:2], mms_list))))
+        with self._reassembly_lock:
+            for pdu in pdu_list:
+                try:
+                    if pdu.concat is None:
+                        sms_list.append(dict(timestamp=pdu.timestamp, message=pdu.message, from_number=pdu.from_number, partial=False,
+                                             indexes=[] if pdu.index is None else [pdu.index], modem=pdu.modem, received_at=pdu.received_at,
+                                             reference=None, reassembly_key=None))
+                        continue
+                    parts = self.reassembly.add(pdu)
+                except Exception as e:  # noqa
+                    sms_list.append(self.create_undecodable_sms(pdu, e))
+                    continue
 
-        for linking_number in linking_number_list:
-            linking_list = list(filter(lambda x: x.pdu['tp_ud']['udh'][0]['ied'][0:2] == linking_number, mms_list))
-            sorted_list = sorted(linking_list, key=lambda x: x.pdu['tp_ud']['udh'][0]['ied'][-1])
+                if parts is not None:
+                    sms_list.append(self.create_sms_from_parts(parts))
 
-            message = ''
-            for s in sorted_list:
-                message += s.message
-            sms_list.append(dict(timestamp=s.timestamp, message=message, from_number=s.from_number))
+            for parts in self.reassembly.pop_expired():
+                sms_list.append(self.create_sms_from_parts(parts))
 
-        for m in not_mms_list:
-            sms_list.append(dict(timestamp=m.timestamp, message=m.message, from_number=m.from_number))
+            # 未完成の分割SMSはストレージから削除する前に保存しておく
+            self.reassembly.save()
 
         return sms_list
 
-    def send_sms_to_slack(self,) -> None:
-        """Send SMS to Slack
-        SMSをATコマンドで取得からSlackに送信までの一連の動作
+    def create_sms_from_parts(self, parts: List[PDU]) -> dict:
+        """Create SMS from concatenated short message parts
+
+        Args:
+            parts (List[PDU]): Parts sorted by sequence number
+
+        Returns:
+            dict: SMS. partial is True if some parts are missing.
         """
-        # SMS(PDU)取得
-        at = AT(port=self.port)
-        msg = at.get_sms_pdu(state=0)
-        self._logger.debug(msg)
+        last = parts[-1]
+        message = ''.join([self.decode_message(p) for p in parts])
+        partial = len(parts) < last.concat[1]
+        indexes = [p.index for p in parts if p.index is not None]  # まだメッセージストレージに残っている部品
+        return dict(timestamp=last.timestamp, message=message, from_number=last.from_number, partial=partial, indexes=indexes,
+                    modem=last.modem, received_at=last.received_at, reference=last.concat[0],
+                    reassembly_key=ReassemblyBuffer.key(last))
 
-        # PDUパース
-        pdu_list = self.decode_pdu_message(msg)
+    def decode_message(self, pdu: PDU) -> str:
+        """Message of a PDU (raw PDU if it cannot be decoded)
 
-        # SMSリスト作成
-        sms_list = self.create_sms_list_from_pdu_list(pdu_list)
+        Args:
+            pdu (PDU): PDU
 
-        # 除外する電話番号取得
-        exclusion_number_list = get_exclusion_list()
+        Returns:
+            str: Message
+        """
+        try:
+            return pdu.message
+        except Exception as e:  # noqa
+            self._logger.error('Failed to decode PDU (index={}): {}: {}'.format(pdu.index, type(e).__name__, e))
+            return '(デコードできないSMS: {}) {}'.format(e, pdu.to_hex())
 
-        with open('../template/slack_message_template.txt', 'r') as f:
-            template = jinja2.Template(f.read())
+    def create_undecodable_sms(self, pdu: PDU, e: Exception) -> dict:
+        """Create SMS from a PDU that cannot be decoded (message is the raw PDU)
 
-        for sms in sms_list:
-            render_sms = template.render(from_number=sms['from_number'],
-                                         message=sms['message'],
-                                         timestamp=sms['timestamp'])
+        Args:
+            pdu (PDU): PDU
+            e (Exception): Decode error
 
-            # # Slackでカラーコードが表示されるのを防止 # FIXME: 暫定
-            # render_sms = re.sub(r'#([0-9]{6})', r'# \1', render_sms)
-            self._logger.debug(render_sms)
+        Returns:
+            dict: SMS
+        """
+        self._logger.error('Failed to decode PDU (index={}): {}: {}'.format(pdu.index, type(e).__name__, e))
+        try:
+            from_number = pdu.from_number
+        except Exception:  # noqa
+            from_number = ''
+        return dict(timestamp='', message='(デコードできないSMS: {}) {}'.format(e, pdu.to_hex()), from_number=from_number, partial=False,
+                    indexes=[] if pdu.index is None else [pdu.index], modem=pdu.modem, received_at=None, reference=None,
+                    reassembly_key=None)
+
+    def take_reassembly_indexes(self, modem: str = '') -> List[int]:
+        """Take message storage indexes of parts saved in the reassembly buffer
 
-            # 受信したSMSを保存
-            save_filename = '../data/receive_sms_{}.txt'.format(datetime.date.today().strftime('%Y%m%d'))
-            if not os.path.exists('../data'):
-                os.mkdir('../data')
-            with open(save_filename, 'a') as f:
-                f.write(render_sms + '\n')
+        Args:
+            modem (str, optional): Modem name. Defaults to ''.
 
-            if sms['from_number'] in exclusion_number_list:
-                self._logger.debug('exclude sms message from {}'.format(sms['from_number']))
-                continue
+        Returns:
+            List[int]: Message storage indexes of the modem
+        """
+        with self._reassembly_lock:
+            return self.reassembly.take_indexes(modem)
+
+    def release_reassembly(self, sms: dict) -> None:
+        """Remove a forwarded concatenated SMS from the reassembly buffer and its checkpoint
+
+        Args:
+            sms (dict): SMS
+        """
+        if sms.get('reassembly_key') is None:
+            return
+        with self._reassembly_lock:
+            self.reassembly.done(sms['reassembly_key'])
+            self.reassembly.save()
 
-            # Slackに送信
-            self.client.chat_postMessage(channel=self.slack_channel, text=render_sms)
+    def forward_sms(self, sms: dict) -> None:
+        """Forward SMS to Slack
+        転送済み(送信キューに保存済み)のSMSは再取得・再配信されても転送しない
+        分割SMSは送信キューに保存してから再構成バッファから消す
 
-        # メッセージストレージからメッセージを削除
-        self._logger.debug(at.check_message_storage())
-        at.delete_message()
-        self._logger.debug(at.check_message_storage())
+        Args:
+            sms (dict): SMS
+        """
+        fp = fingerprint(sms)
+        if self.dedup.seen(fp):
+            self._logger.debug('duplicate sms message from %s', sms['from_number'])
+            _FORWARDED.labels('duplicate').inc()
+            self.release_reassembly(sms)
+            return
+
+        started_at = time.perf_counter()
+        route = self.router.route(sms)
+        render_sms = self.templates.render(sms, route.template)
+        _RENDER_SECONDS.observe(time.perf_counter() - started_at)
+
+        # # Slackでカラーコードが表示されるのを防止 # FIXME: 暫定
+        # render_sms = re.sub(r'#([0-9]{6})', r'# \1', render_sms)
+        self._logger.debug(render_sms)
+
+        # 受信したSMSを保存
+        self.archive.write(sms, render_sms)
+
+        if self.exclusion_store.match(sms['from_number']):
+            self._logger.debug('exclude sms message from %s', sms['from_number'])
+            _FORWARDED.labels('excluded').inc()
+            self.dedup.add(fp)
+            self.release_reassembly(sms)
+            return
+
+        # 送信キューに追加(送信はSlackSenderが行う)
+        self.outbox.put(route.channel or self.slack_channel, render_sms, received_at=sms.get('received_at'))
+        self.dedup.add(fp)
+        self.release_reassembly(sms)
+        _FORWARDED.labels('queued').inc()
+        self.slack_sender.notify()
 
     def start(self,) -> None:
         """Start SMS Forwarding Task
         """
-        schedule.every(self.interval_seconds).seconds.do(self.send_sms_to_slack)
-
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.slack_sender.start()
+        self.archive.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            worker.join()
 
 
 if __name__ == "__main__":
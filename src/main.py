@@ -1,23 +1,33 @@
 import os
+import re
 import sys
 import pprint  # noqa
 import logging
 import argparse
 import json
+import asyncio
+import functools
 import threading
+import configparser
+from typing import Callable, Dict
 
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
 from forwarding_sms import SMSForwardingTask
-from exclusion_list import add_exclusion_list, delete_exclusion_list, get_exclusion_list
-from common.util import get_raspberry_pi_info
+from exclusion_list import add_exclusion_list, delete_exclusion_list, get_exclusion_list, import_exclusion_list
+from system_monitor import SystemMonitor
+from common.util import describe_throttled
+from common import metrics
 
 from common.log import Logger
 
 PROG = 'SMS Forwarding Bot'
 __version__ = '1.0.1'
 
+GET_EXCLUSION_MAX_ENTRIES = 100  # /get_exclusionで表示する最大件数
+SEARCH_SMS_MAX_RESULTS = 10  # /search_smsで表示する最大件数
+
 
 # トークン
 with open('../token.json', 'r') as f:
@@ -26,10 +36,58 @@ BOT_TOKEN = token['bot_token']
 APP_TOKEN = token['app_token']
 
 
-app = App(token=BOT_TOKEN)
+COMMANDS: Dict[str, Callable] = {}  # スラッシュコマンド -> リスナー
+
+sms_forwarding_task = None
+system_monitor = None
+
+
+def command(name: str):
+    """Register a slash command listener (for both App and AsyncApp)
+
+    Args:
+        name (str): Slash command. ex) /add_exclusion
+    """
+    def decorator(func):
+        COMMANDS[name] = func
+        return func
+    return decorator
 
 
-@app.command('/add_exclusion')
+def create_app() -> App:
+    """Create Bolt app
+    """
+    app = App(token=BOT_TOKEN)
+    for name, func in COMMANDS.items():
+        app.command(name)(func)
+    return app
+
+
+def create_async_app():
+    """Create Bolt app for the asyncio runtime
+    リスナーはexecutorで実行し、ack/sayの呼び出しを記録しておいてイベントループ上で送る
+    """
+    from slack_bolt.async_app import AsyncApp
+
+    def async_listener(func):
+        async def listener(ack, say, command, logger):
+            calls = []
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(func,
+                                        ack=lambda *args, **kwargs: calls.append((ack, args, kwargs)),
+                                        say=lambda *args, **kwargs: calls.append((say, args, kwargs)),
+                                        command=command, logger=logger))
+            for f, args, kwargs in calls:
+                await f(*args, **kwargs)
+        return listener
+
+    app = AsyncApp(token=BOT_TOKEN)
+    for name, func in COMMANDS.items():
+        app.command(name)(async_listener(func))
+    return app
+
+
+@command('/add_exclusion')
 def add_exclusion_list_command(ack, say, command, logger):
     number = command['text']
 
@@ -40,7 +98,7 @@ def add_exclusion_list_command(ack, say, command, logger):
     ack()
 
 
-@app.command('/delete_exclusion')
+@command('/delete_exclusion')
 def delete_exclusion_list_command(ack, say, command, logger):
     number = command['text']
 
@@ -56,31 +114,102 @@ def delete_exclusion_list_command(ack, say, command, logger):
         ack(message)
 
 
-@app.command('/get_exclusion')
+@command('/import_exclusion')
+def import_exclusion_list_command(ack, say, command, logger):
+    numbers = re.split(r'[,\s]+', command['text'])
+
+    count = import_exclusion_list(numbers)
+    message = f'除外リストに{count}件追加しました'
+    logger.debug(message)
+    say(message)
+    ack()
+
+
+@command('/get_exclusion')
 def get_exclusion_list_command(ack, say, command, logger):
     data = get_exclusion_list()
-    message = '除外リスト: ' + str(data)
+    if len(data) > GET_EXCLUSION_MAX_ENTRIES:
+        message = f'除外リスト({len(data)}件, 先頭{GET_EXCLUSION_MAX_ENTRIES}件): ' + str(data[:GET_EXCLUSION_MAX_ENTRIES])
+    else:
+        message = '除外リスト: ' + str(data)
+    logger.debug(message)
+    ack(message)
+
+
+@command('/search_sms')
+def search_sms_command(ack, say, command, logger):
+    query = command['text']
+
+    result = sms_forwarding_task.archive.search(query, limit=SEARCH_SMS_MAX_RESULTS) if sms_forwarding_task is not None else []
+    if len(result):
+        message = f'「{query}」の検索結果({len(result)}件)\n' + '\n'.join([f'{r["timestamp"]} {r["from_number"]}: {r["message"]}' for r in result])
+    else:
+        message = f'「{query}」に一致するSMSはありません'
+    logger.debug(message)
+    ack(message)
+
+
+@command('/get_metrics')
+def get_metrics_command(ack, say, command, logger):
+    summary = metrics.REGISTRY.summary()
+    message = f'```{summary}```' if summary else 'メトリクスはまだありません'
     logger.debug(message)
     ack(message)
 
 
-@app.command('/get_bot_info')
+def format_stats(stats: dict, field: str, fmt: str) -> str:
+    """min / avg / max of a field (ex. 12.0/20.5/48.0%)
+    """
+    if field not in stats:
+        return 'N/A'
+    s = stats[field]
+    return '/'.join([format(s[k], fmt) for k in ('min', 'avg', 'max')])
+
+
+@command('/get_bot_info')
 def get_bot_info(ack, say, command, logger):
-    raspi_info = get_raspberry_pi_info()
+    # サンプラーの記録から返すだけ(コマンドの実行を待たない)
+    stats = system_monitor.stats(minutes=system_monitor.window_minutes) if system_monitor is not None else {}
+    throttled = describe_throttled(stats['throttled']) if 'throttled' in stats else 'N/A'
+
+    queue_depth = sms_forwarding_task.slack_sender.queue_depth() if sms_forwarding_task is not None else {}
+    queue = ', '.join([f'{k}={v}' for k, v in queue_depth.items()]) or '0'
+
+    workers = sms_forwarding_task.workers if sms_forwarding_task is not None else []
+    storage = ', '.join([f'{w.name or w.port}={w.storage_used}/{w.storage_total}' for w in workers if w.storage_total]) or 'N/A'
 
+    window = system_monitor.window_minutes if system_monitor is not None else 0
     message = f'''{PROG}  ver {__version__}
 
-CPU: {raspi_info['cpu']}, Mem: {raspi_info['mem']}, Dsk: {raspi_info['dsk']}
-Temp: {raspi_info['temp']}, Volt: {raspi_info['volt']}'''
+min/avg/max (last {window:g} min)
+CPU: {format_stats(stats, 'cpu', '.1f')}%, Mem: {format_stats(stats, 'mem', '.1f')}%, Dsk: {format_stats(stats, 'dsk', '.1f')}%
+Temp: {format_stats(stats, 'temp', '.1f')}'C, Volt: {format_stats(stats, 'volt', '.2f')}V
+Throttled: {throttled}
+Queue: {queue}
+Storage: {storage}'''
     logger.debug(message)
     ack(message)
 
 
 def command_task():
-    handler = SocketModeHandler(app, APP_TOKEN)
+    handler = SocketModeHandler(create_app(), APP_TOKEN)
     handler.start()
 
 
+async def async_main() -> bool:
+    """Run everything on one event loop (runtime = asyncio)
+
+    Returns:
+        bool: False if stopped by a failed task
+    """
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+    from async_runtime import AsyncRuntime
+
+    handler = AsyncSocketModeHandler(create_async_app(), APP_TOKEN)
+    runtime = AsyncRuntime(sms_forwarding_task, socket_handler=handler, system_monitor=system_monitor, log_level=log_level)
+    return await runtime.run()
+
+
 def main():
     """
     """
@@ -92,9 +221,27 @@ def main():
             with open('../config/exclude_number.txt', 'w') as f:
                 f.write('')
 
-        sms_fowarding_task = SMSForwardingTask(log_level=log_level)
+        config = configparser.ConfigParser()
+        config.read('../config/config.ini')
+
+        global system_monitor
+        system_monitor = SystemMonitor(sample_seconds=float(config.get('system_monitor', 'sample_seconds', fallback='10')),
+                                       window_minutes=float(config.get('system_monitor', 'window_minutes', fallback='10')),
+                                       log_level=log_level)
+
+        runtime = config.get('setting', 'runtime', fallback='thread')
+
+        global sms_forwarding_task
+        sms_forwarding_task = SMSForwardingTask(runtime=runtime, log_level=log_level)
+
+        if runtime == 'asyncio':
+            if not asyncio.run(async_main()):
+                sys.exit(1)
+            return
+
+        system_monitor.start()
 
-        thread1 = threading.Thread(target=sms_fowarding_task.start)
+        thread1 = threading.Thread(target=sms_forwarding_task.start)
         thread2 = threading.Thread(target=command_task)
         thread1.start()
         thread2.start()
@@ -0,0 +1,223 @@
+"""Modem health watchdog."""
+import os
+import time
+import logging
+from typing import Callable, Union
+
+import serial
+
+from at import ATError, ModemSession
+
+from common.log import Logger
+from common import metrics
+
+_MODEM_UP = metrics.gauge('modem_up', 'Whether the modem answers AT commands (1) or not (0).', ('modem',))
+_RECOVERIES = metrics.counter('modem_recovery_actions_total', 'Recovery actions taken by the modem watchdog.', ('modem', 'action'))
+_DOWNTIME_SECONDS = metrics.histogram('modem_downtime_seconds', 'Time from the first failure to the next successful AT command.',
+                                      buckets=metrics.DELIVERY_BUCKETS)
+
+
+class ModemWatchdog():
+    """Modem health watchdog
+    一定時間ATコマンドが成功していなければ'AT'で生存確認し、連続失敗回数に応じて段階的に復旧を試みる。
+    1. ポートを開き直す
+    2. モデムをソフトリセット(AT+CFUN=1,1)する(reset_failures回ごと)
+    3. /dev/serial/by-idにデバイスが再び現れるのを待ち、ttyUSB*の番号が変わっていればそちらを開く
+    alert_failures回失敗したら通知し、復旧したら停止時間を通知する。
+    """
+
+    ACTION_REOPEN = 'reopen'
+    ACTION_RESET = 'reset'
+    ACTION_WAIT_DEVICE = 'wait_device'
+
+    BY_ID_DIR = '/dev/serial/by-id'
+    DEVICE_POLL_SECONDS = 0.5
+
+    def __init__(self, session: ModemSession, name: str = '', probe_seconds: float = 60, probe_timeout: float = 1,
+                 retry_seconds: float = 2, max_retry_seconds: float = 30, reset_failures: int = 3, alert_failures: int = 3,
+                 alert: Union[Callable[[str], None], None] = None, log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            session (ModemSession): Modem session
+            name (str, optional): Modem name (for alerts and metrics). Defaults to ''.
+            probe_seconds (float, optional): Probe if no AT command succeeded for this long. Defaults to 60.
+            probe_timeout (float, optional): Deadline of the probe. Defaults to 1.
+            retry_seconds (float, optional): First retry delay after a failure (doubled each time). Defaults to 2.
+            max_retry_seconds (float, optional): Maximum retry delay. Defaults to 30.
+            reset_failures (int, optional): Soft reset the modem every this many consecutive failures. Defaults to 3.
+            alert_failures (int, optional): Alert after this many consecutive failures. Defaults to 3.
+            alert (Union[Callable[[str], None], None], optional): Function sending an alert message. Defaults to None.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.session = session
+        self.name = name or session.port
+        self.probe_seconds = probe_seconds
+        self.probe_timeout = probe_timeout
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.reset_failures = reset_failures
+        self.alert_failures = alert_failures
+        self.alert = alert
+
+        self.failures = 0
+        self.down_since = None  # 最初に失敗した時刻(time.monotonic())
+        self.alerted = False
+        self.next_probe_at = time.monotonic() + probe_seconds
+
+        # ポートがttyUSB*で指定されていても、再接続後に番号が変わったら追えるようにby-idの名前を覚えておく
+        self.by_id = self.find_by_id(session.port)
+        _MODEM_UP.labels(self.name).set(1)
+
+    @property
+    def is_down(self,) -> bool:
+        return self.down_since is not None
+
+    def remaining(self, now: Union[float, None] = None) -> float:
+        """Seconds until the next probe (0 if due)
+
+        Args:
+            now (Union[float, None], optional): Current time (time.monotonic()). Defaults to None.
+        """
+        return max(0.0, self.next_probe_at - (time.monotonic() if now is None else now))
+
+    def probe(self,) -> bool:
+        """Check that the modem answers within probe_timeout
+
+        Returns:
+            bool: True if alive
+        """
+        try:
+            with self.session as at:
+                at.ping(self.probe_timeout)
+        except (ATError, serial.SerialException, OSError) as e:
+            self.failed(e)
+            return False
+        self.alive()
+        return True
+
+    def alive(self, now: Union[float, None] = None) -> None:
+        """Record that an AT command succeeded
+
+        Args:
+            now (Union[float, None], optional): Current time (time.monotonic()). Defaults to None.
+        """
+        now = time.monotonic() if now is None else now
+        self.next_probe_at = now + self.probe_seconds
+        if self.down_since is None:
+            return
+
+        downtime = now - self.down_since
+        _DOWNTIME_SECONDS.observe(downtime)
+        _MODEM_UP.labels(self.name).set(1)
+        self._logger.info('Modem {} recovered after {:.1f}s ({} failures)'.format(self.name, downtime, self.failures))
+        if self.alerted:
+            self.send_alert(':white_check_mark: モデム({})が復旧しました(停止時間 {:.0f}秒)'.format(self.name, downtime))
+
+        self.failures = 0
+        self.down_since = None
+        self.alerted = False
+
+    def failed(self, e: Exception, now: Union[float, None] = None) -> None:
+        """Record a failure and try to recover
+
+        Args:
+            e (Exception): Error
+            now (Union[float, None], optional): Current time (time.monotonic()). Defaults to None.
+        """
+        now = time.monotonic() if now is None else now
+        if self.down_since is None:
+            self.down_since = now
+            _MODEM_UP.labels(self.name).set(0)
+        self.failures += 1
+        self._logger.warn('Modem {} failure #{}: {}: {}'.format(self.name, self.failures, type(e).__name__, e))
+
+        if self.failures >= self.alert_failures and not self.alerted:
+            self.alerted = True
+            self.send_alert(':warning: モデム({})が応答しません({}回連続): {}'.format(self.name, self.failures, e))
+
+        delay = min(self.max_retry_seconds, self.retry_seconds * (2 ** (self.failures - 1)))
+        self.recover(delay)
+        self.next_probe_at = time.monotonic() + delay
+
+    def recover(self, wait_seconds: float) -> str:
+        """Take the next recovery action for the current number of failures
+
+        Args:
+            wait_seconds (float): Maximum seconds to wait for the device node
+
+        Returns:
+            str: Action taken
+        """
+        if self.failures % self.reset_failures == 0:
+            action = self.ACTION_RESET
+            try:
+                self.session.get().soft_reset()
+            except (ATError, serial.SerialException, OSError) as e:
+                self._logger.debug(e)
+        elif self.failures > self.reset_failures:
+            action = self.ACTION_WAIT_DEVICE
+            self.wait_device(wait_seconds)
+        else:
+            action = self.ACTION_REOPEN
+        self.session.invalidate()  # 次に使うときに開き直す
+
+        _RECOVERIES.labels(self.name, action).inc()
+        self._logger.info('Modem {}: {}'.format(self.name, action))
+        return action
+
+    def wait_device(self, timeout: float) -> bool:
+        """Wait for the device node to reappear and follow it if the tty name changed
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            bool: True if the device node exists
+        """
+        path = self.by_id or self.session.port
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(path):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.DEVICE_POLL_SECONDS)
+
+        if self.by_id is not None and self.session.port != self.by_id:
+            port = os.path.realpath(self.by_id)
+            if port != self.session.port:
+                self._logger.info('Modem {} moved: {} -> {}'.format(self.name, self.session.port, port))
+                self.session.port = port
+        return True
+
+    def send_alert(self, message: str) -> None:
+        if self.alert is None:
+            return
+        try:
+            self.alert(message)
+        except Exception as e:  # noqa
+            self._logger.error('Failed to send alert: {}'.format(e))
+
+    @classmethod
+    def find_by_id(cls, port: str) -> Union[str, None]:
+        """Find /dev/serial/by-id link of a port
+
+        Args:
+            port (str): Serial port
+
+        Returns:
+            Union[str, None]: by-id path (None if not found)
+        """
+        if port.startswith(cls.BY_ID_DIR + '/'):
+            return port
+        try:
+            names = sorted(os.listdir(cls.BY_ID_DIR))
+        except OSError:
+            return None
+        real_port = os.path.realpath(port)
+        for name in names:
+            path = os.path.join(cls.BY_ID_DIR, name)
+            if os.path.realpath(path) == real_port:
+                return path
+        return None
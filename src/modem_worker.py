@@ -0,0 +1,326 @@
+"""Worker reading SMS from one modem."""
+import sqlite3
+import threading
+import logging
+from typing import List, Union
+
+import serial
+import jinja2
+
+from at import AT, ATError, ATTimeoutError, ModemSession
+from sms_pdu import PDU
+from poll_scheduler import PollScheduler
+from modem_watchdog import ModemWatchdog
+
+from common.log import Logger
+from common import metrics
+
+_CMGL_MESSAGES = metrics.histogram('sms_cmgl_messages', 'Messages listed by one AT+CMGL.', buckets=metrics.SIZE_BUCKETS)
+_CMGL_BYTES = metrics.histogram('sms_cmgl_bytes', 'Size of one AT+CMGL response.', buckets=metrics.SIZE_BUCKETS)
+_POLLS = metrics.counter('sms_poll_cycles_total', 'Polling cycles, skipped when AT+CPMS? reports an empty storage.', ('result',))
+_POLL_INTERVAL = metrics.gauge('sms_poll_interval_seconds', 'Current polling interval of each modem.', ('modem',))
+_STORAGE_USED = metrics.gauge('sms_storage_used', 'Messages in the modem message storage (AT+CPMS <used1>).', ('modem',))
+_STORAGE_TOTAL = metrics.gauge('sms_storage_total', 'Capacity of the modem message storage (AT+CPMS <total1>).', ('modem',))
+_DRAINS = metrics.counter('sms_storage_drains_total', 'Immediate drains because the message storage was filling up.', ('modem',))
+
+
+class ModemWorker():
+    """Worker reading SMS from one modem
+    モデム(シリアルポート)ごとに1スレッドでSMSを取得し、デコード以降は共有のSMSForwardingTaskに渡す。
+    メッセージストレージからの削除はSlackの送信キューに保存できたものだけ行う。
+    """
+
+    def __init__(self, task, name: str, port: str, baudrate: int = 460800, receive_mode: str = 'polling',
+                 interval_seconds: int = 30, min_interval_seconds: int = 5, sweep_seconds: int = 300,
+                 capture_filename: Union[str, None] = None, watchdog_options: Union[dict, None] = None,
+                 message_storage: Union[str, None] = None, drain_threshold: float = 0.8,
+                 log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            task (SMSForwardingTask): Shared pipeline
+            name (str): Modem name (config.ini [modem:name]). '' for [serial].
+            port (str): Serial port
+            baudrate (int, optional): Baudrate. Defaults to 460800.
+            receive_mode (str, optional): {polling | urc}. Defaults to 'polling'.
+            interval_seconds (int, optional): Polling interval when idle. Defaults to 30.
+            min_interval_seconds (int, optional): Polling interval right after traffic. Defaults to 5.
+            sweep_seconds (int, optional): Polling interval in urc mode. Defaults to 300.
+            capture_filename (Union[str, None], optional): Record serial traffic to this file (JSONL). Defaults to None.
+            watchdog_options (Union[dict, None], optional): Arguments of ModemWatchdog. Defaults to None.
+            message_storage (Union[str, None], optional): Preferred message storage (SM, ME, MT, ...). None to keep the modem setting. Defaults to None.
+            drain_threshold (float, optional): Drain right away when the storage is filled to this ratio. Defaults to 0.8.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.task = task
+        self.name = name
+        self.port = port
+        self.receive_mode = receive_mode
+        self.interval_seconds = interval_seconds
+        self.min_interval_seconds = min_interval_seconds
+        self.sweep_seconds = sweep_seconds
+        self.message_storage = message_storage
+        self.drain_threshold = drain_threshold
+
+        self.session = ModemSession(port=port, baudrate=baudrate, capture_filename=capture_filename, log_level=log_level)
+        if receive_mode == 'urc':  # 新着通知があるので取りこぼし確認は固定間隔
+            self.scheduler = PollScheduler(sweep_seconds, sweep_seconds)
+        else:
+            self.scheduler = PollScheduler(min_interval_seconds, interval_seconds)
+        self.watchdog = ModemWatchdog(self.session, name=name, alert=getattr(task, 'alert', None), log_level=log_level,
+                                      **(watchdog_options or {}))
+
+        self.recover = True
+        self.pending_sms_list = []
+        self.storage_used = None
+        self.storage_total = None
+        self.drain_requested = False
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __repr__(self,) -> str:
+        return 'ModemWorker({}, {})'.format(self.name or '-', self.port)
+
+    def close(self,) -> None:
+        """Close modem
+        """
+        self.session.close()
+
+    def send_sms_to_slack(self,) -> bool:
+        """Send SMS to Slack
+        SMSをATコマンドで取得からSlackに送信までの一連の動作
+
+        Returns:
+            bool: True if any message was received
+        """
+        with self.session as at:
+            return self._send_sms_to_slack(at)
+
+    def _send_sms_to_slack(self, at: AT, probe: bool = True) -> bool:
+        """Send SMS to Slack using an opened modem
+
+        Args:
+            at (AT): AT instance
+            probe (bool, optional): Skip AT+CMGL if AT+CPMS? reports an empty storage. Defaults to True.
+
+        Returns:
+            bool: True if any message was received
+        """
+        self.drain_requested = False
+        if self.message_storage is not None:
+            at.set_message_storage(self.message_storage)
+
+        # 前回転送に失敗したSMSを再送
+        if len(self.pending_sms_list):
+            sms_list, self.pending_sms_list = self.pending_sms_list, []
+            self.forward_sms_list(sms_list, at)
+
+        # ストレージが空なら一覧は取得しない(再構成バッファのタイムアウトだけ確認する)
+        if probe and not self.recover:
+            self.update_storage(*at.get_message_count())
+            if self.storage_used == 0:
+                _POLLS.labels('skipped').inc()
+                self.forward_pdu_list([], at)
+                return False
+        _POLLS.labels('listed').inc()
+
+        # SMS(PDU)取得
+        # 起動直後・ストレージが埋まりかけているときは既読のまま残っているもの(前回転送できなかったもの)も取得する
+        drain = self.recover or self.storage_filling()
+        msg = at.get_sms_pdu(state=4 if drain else 0)
+        self._logger.debug(msg)
+        self.recover = False
+
+        # PDUパース
+        pdu_list = self.task.decode_pdu_message(msg, modem=self.name)
+        _CMGL_MESSAGES.observe(len(pdu_list))
+        _CMGL_BYTES.observe(len(msg))
+
+        self.forward_pdu_list(pdu_list, at)
+
+        # 削除後も埋まりかけていれば次の周期を待たずに既読のものも含めて取得する
+        if len(pdu_list):
+            self.update_storage(*at.get_message_count())
+            if self.storage_filling():
+                if drain:
+                    self._logger.warn('{}: message storage is still {}/{} after draining'.format(self, self.storage_used, self.storage_total))
+                else:
+                    self.drain_requested = True
+                    _DRAINS.labels(self.name or self.port).inc()
+        return len(pdu_list) > 0
+
+    def update_storage(self, used: int, total: int) -> None:
+        """Record message storage occupancy
+
+        Args:
+            used (int): Messages in the storage
+            total (int): Capacity of the storage
+        """
+        self.storage_used = used
+        self.storage_total = total
+        _STORAGE_USED.labels(self.name or self.port).set(used)
+        _STORAGE_TOTAL.labels(self.name or self.port).set(total)
+
+    def storage_filling(self,) -> bool:
+        """Whether the message storage is filled to drain_threshold (False if unknown)
+        """
+        if not self.storage_total:
+            return False
+        return self.storage_used >= self.storage_total * self.drain_threshold
+
+    def forward_pdu_list(self, pdu_list: List[PDU], at: Union[AT, None] = None) -> None:
+        """Forward PDU list to Slack
+
+        Args:
+            pdu_list (List[PDU]): PDU list
+            at (Union[AT, None], optional): AT instance to delete forwarded messages from message storage. Defaults to None.
+        """
+        for pdu in pdu_list:
+            pdu.modem = self.name
+
+        # SMSリスト作成
+        sms_list = self.task.create_sms_list_from_pdu_list(pdu_list)
+
+        # 再構成バッファに保存済みの部品はメッセージストレージから削除
+        indexes = self.task.take_reassembly_indexes(self.name)
+        if at is not None and len(indexes):
+            try:
+                at.delete_messages(indexes)
+            except Exception:
+                self.pending_sms_list.extend(sms_list)
+                raise
+
+        self.forward_sms_list(sms_list, at)
+
+    def forward_sms_list(self, sms_list: List[dict], at: Union[AT, None] = None) -> None:
+        """Forward SMS list to Slack
+        送信キューに保存できたSMSから順にメッセージストレージから削除する。失敗したSMSは次回再試行する。
+        削除に失敗した場合も残りのSMSは次回再試行する(削除できなかったものは次回全件取得したときに重複として削除する)。
+
+        Args:
+            sms_list (List[dict]): SMS list
+            at (Union[AT, None], optional): AT instance to delete forwarded messages from message storage. Defaults to None.
+        """
+        for i, sms in enumerate(sms_list):
+            try:
+                self.task.forward_sms(sms)
+            except (sqlite3.Error, OSError, jinja2.TemplateError) as e:
+                self._logger.error('Failed to queue message: {}'.format(e))
+                self.pending_sms_list.extend(sms_list[i:])
+                break
+
+            # メッセージストレージから削除(再構成タイムアウトした他のモデムの部品はindexを持たない)
+            if at is not None and len(sms['indexes']):
+                try:
+                    at.delete_messages(sms['indexes'])
+                except Exception:
+                    self.pending_sms_list.extend(sms_list[i + 1:])
+                    raise
+
+    def wait_new_message(self, timeout: float) -> None:
+        """Wait for new message indication and forward it
+        +CMTIを受けたらストレージから取得して転送、+CMTはそのまま転送
+
+        Args:
+            timeout (float): Seconds to wait
+        """
+        with self.session as at:
+            at.set_new_message_indication(mode=2, mt=1)
+
+            urc = at.read_urc(timeout)
+            if urc is None:
+                return
+            line, pdu = urc
+
+            if line.startswith('+CMTI:'):
+                self._send_sms_to_slack(at, probe=False)
+                if self.drain_requested:
+                    self.scheduler.expedite()
+            elif line.startswith('+CMT:') and pdu:
+                self.forward_pdu_list([PDU(pdu)], at)
+
+    def run_safely(self, func, *args, **kwargs):
+        """Run one cycle, logging modem errors instead of stopping the worker
+        ATコマンドの異常応答・予期しない例外で転送スレッドが止まらないようにする。応答なし・ポートの異常だけをウォッチドッグに渡す。
+        失敗した周期で既読にしたSMSを取りこぼさないよう、次回は既読のものも含めて取得する。
+
+        Args:
+            func (Callable): Function to run
+
+        Returns:
+            Any: Return value of func (None on error)
+        """
+        try:
+            return func(*args, **kwargs)
+        except (ATTimeoutError, serial.SerialException, OSError) as e:
+            self._logger.error('{}: {}: {}'.format(self, type(e).__name__, e))
+            self.watchdog.failed(e)
+        except ATError as e:  # 応答はあるのでモデムは生きている(+CMS ERROR, 想定外の応答)
+            self._logger.error('{}: {}: {}'.format(self, type(e).__name__, e))
+        except Exception as e:  # noqa
+            self._logger.critical('{}: unexpected {}: {}'.format(self, type(e).__name__, e))
+        self.recover = True
+        return None
+
+    def start(self,) -> None:
+        """Start worker thread
+        """
+        self._thread = threading.Thread(target=self.run, name='modem:{}'.format(self.name or self.port), daemon=True)
+        self._thread.start()
+
+    def stop(self,) -> None:
+        """Stop worker loop (after the current cycle)
+        """
+        self._stop.set()
+
+    def join(self,) -> None:
+        """Wait for worker thread
+        """
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self,) -> None:
+        """Worker loop
+        """
+        if self.receive_mode == 'urc':
+            # 新着通知で即時転送し、ポーリングは取りこぼし対策として低頻度で行う
+            # 次のポーリングまでは新着通知を待ってブロックする
+            while not self._stop.is_set():
+                self.step()
+                if self.watchdog.is_down:
+                    self._stop.wait(self.next_wait())
+                else:
+                    self.run_safely(self.wait_new_message, timeout=self.next_wait())
+        else:
+            while not self._stop.wait(self.next_wait()):
+                self.step()
+
+    def next_wait(self,) -> float:
+        """Seconds until the next poll or liveness probe
+        応答がない間はポーリングせず、ウォッチドッグの再試行だけ行う
+        """
+        if self.watchdog.is_down:
+            return self.watchdog.remaining()
+        return min(self.scheduler.remaining(), self.watchdog.remaining())
+
+    def step(self,) -> None:
+        """Run the liveness probe and the poll if due
+        """
+        if self.watchdog.remaining() == 0:
+            self.watchdog.probe()
+        if not self.watchdog.is_down and self.scheduler.remaining() == 0:
+            self.poll()
+
+    def poll(self,) -> None:
+        """Run one polling cycle and schedule the next one
+        """
+        traffic = self.run_safely(self.send_sms_to_slack)
+        if traffic is not None:
+            self.watchdog.alive()
+        interval = self.scheduler.done(bool(traffic))
+        if self.drain_requested:
+            self.scheduler.expedite()
+        _POLL_INTERVAL.labels(self.name or self.port).set(interval)
@@ -0,0 +1,203 @@
+"""Persistent outbox of Slack messages."""
+import os
+import time
+import sqlite3
+import threading
+import logging
+from typing import Dict, List, Union
+
+from common.log import Logger
+
+
+class Outbox():
+    """Persistent outbox of Slack messages
+    転送するメッセージを先にSQLiteに書き込み、送信スレッドがチャンネルごとに古い順に送る
+    再送しても送れないもの(チャンネルがない等)はdeadテーブルに移し、後続の送信を止めないようにする
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel TEXT NOT NULL,
+        text TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        received_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS outbox_channel ON outbox (channel, id);
+    CREATE TABLE IF NOT EXISTS dead (
+        id INTEGER PRIMARY KEY,
+        channel TEXT NOT NULL,
+        text TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        attempts INTEGER NOT NULL,
+        received_at REAL,
+        error TEXT NOT NULL,
+        failed_at REAL NOT NULL
+    );
+    '''
+
+    def __init__(self, filename: str = '../data/outbox.sqlite3', log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            filename (str, optional): SQLite database filename. Defaults to '../data/outbox.sqlite3'.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')  # コミット後はSIMから削除するので確実に書き込む
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self,) -> None:
+        """Close database
+        """
+        with self._lock:
+            self._conn.close()
+
+    def put(self, channel: str, text: str, received_at: Union[float, None] = None) -> int:
+        """Append a message
+
+        Args:
+            channel (str): Slack channel
+            text (str): Message text
+            received_at (Union[float, None], optional): Time the SMS was received by the service centre (for metrics). Defaults to None.
+
+        Returns:
+            int: Message id
+        """
+        with self._lock:
+            cur = self._conn.execute('INSERT INTO outbox (channel, text, created_at, received_at) VALUES (?, ?, ?, ?)',
+                                     (channel, text, time.time(), received_at))
+            return cur.lastrowid
+
+    def heads(self, now: Union[float, None] = None) -> List[sqlite3.Row]:
+        """Get the oldest message of each channel that is due
+        チャンネル内の順序を守るため、先頭が再送待ちのチャンネルは後続も送らない
+
+        Args:
+            now (Union[float, None], optional): Current time (time.time()). Defaults to None.
+
+        Returns:
+            List[sqlite3.Row]: Messages (id, channel, text, created_at, attempts, next_attempt_at, received_at)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._conn.execute('SELECT * FROM outbox WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY channel) '
+                                      'AND next_attempt_at <= ? ORDER BY id', (now,)).fetchall()
+
+    def done(self, id: int) -> None:
+        """Remove a sent message
+
+        Args:
+            id (int): Message id
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM outbox WHERE id = ?', (id,))
+
+    def peek(self, channel: str, limit: int) -> List[sqlite3.Row]:
+        """Get the oldest messages of a channel
+
+        Args:
+            channel (str): Slack channel
+            limit (int): Maximum number of messages
+
+        Returns:
+            List[sqlite3.Row]: Messages in FIFO order
+        """
+        with self._lock:
+            return self._conn.execute('SELECT * FROM outbox WHERE channel = ? ORDER BY id LIMIT ?', (channel, limit)).fetchall()
+
+    def done_many(self, ids: List[int]) -> None:
+        """Remove sent messages
+
+        Args:
+            ids (List[int]): Message ids
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM outbox WHERE id IN ({})'.format(','.join('?' * len(ids))), ids)
+
+    def retry_later(self, id: int, delay: float) -> None:
+        """Postpone a message
+
+        Args:
+            id (int): Message id
+            delay (float): Seconds to wait
+        """
+        with self._lock:
+            self._conn.execute('UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?',
+                               (time.time() + delay, id))
+
+    def dead(self, id: int, error: str) -> None:
+        """Move a message that can never be sent to the dead table
+
+        Args:
+            id (int): Message id
+            error (str): Error
+        """
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.execute('INSERT INTO dead (id, channel, text, created_at, attempts, received_at, error, failed_at) '
+                                   'SELECT id, channel, text, created_at, attempts + 1, received_at, ?, ? FROM outbox WHERE id = ?',
+                                   (error, time.time(), id))
+                self._conn.execute('DELETE FROM outbox WHERE id = ?', (id,))
+            except sqlite3.Error:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def dead_count(self,) -> int:
+        """Number of messages moved to the dead table
+
+        Returns:
+            int: Number of messages
+        """
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM dead').fetchone()[0]
+
+    def next_attempt_at(self,) -> Union[float, None]:
+        """Earliest time a message is due
+
+        Returns:
+            Union[float, None]: time.time() based time. None if empty.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(next_attempt_at) FROM outbox WHERE id IN '
+                                     '(SELECT MIN(id) FROM outbox GROUP BY channel)').fetchone()
+        return row[0]
+
+    def depth_by_channel(self,) -> Dict[str, int]:
+        """Number of messages waiting for each channel
+
+        Returns:
+            Dict[str, int]: {channel: number of messages}
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT channel, COUNT(*) FROM outbox GROUP BY channel').fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def depth(self, channel: Union[str, None] = None) -> int:
+        """Number of messages waiting
+
+        Args:
+            channel (Union[str, None], optional): Slack channel. Defaults to None (all channels).
+
+        Returns:
+            int: Number of messages
+        """
+        with self._lock:
+            if channel is None:
+                row = self._conn.execute('SELECT COUNT(*) FROM outbox').fetchone()
+            else:
+                row = self._conn.execute('SELECT COUNT(*) FROM outbox WHERE channel = ?', (channel,)).fetchone()
+        return row[0]
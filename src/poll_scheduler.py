@@ -0,0 +1,56 @@
+"""Adaptive polling scheduler."""
+import time
+from typing import Union
+
+
+class PollScheduler():
+    """Polling scheduler on the monotonic clock
+    次回の実行時刻をtime.monotonic()で保持し、ワーカーはremaining()の間ブロックして待つ(1秒毎に起きて確認しない)。
+    受信があった直後は分割SMSの残りが続いて届くことが多いので最短間隔で、受信がなければ間隔をbackoff倍ずつmax_secondsまで延ばす。
+    min_seconds == max_secondsなら固定間隔。
+    """
+
+    def __init__(self, min_seconds: float, max_seconds: float, backoff: float = 2.0) -> None:
+        """Initialize
+
+        Args:
+            min_seconds (float): Interval right after traffic
+            max_seconds (float): Interval when idle
+            backoff (float, optional): Factor to lengthen the interval on each idle cycle. Defaults to 2.0.
+        """
+        self.min_seconds = min(min_seconds, max_seconds)
+        self.max_seconds = max_seconds
+        self.backoff = backoff
+
+        self.interval = self.min_seconds
+        self.next_at = time.monotonic()  # 初回はすぐ実行
+
+    def remaining(self, now: Union[float, None] = None) -> float:
+        """Seconds until the next run (0 if due)
+
+        Args:
+            now (Union[float, None], optional): Current time (time.monotonic()). Defaults to None.
+        """
+        return max(0.0, self.next_at - (time.monotonic() if now is None else now))
+
+    def expedite(self,) -> None:
+        """Run the next cycle right away
+        """
+        self.next_at = time.monotonic()
+
+    def done(self, traffic: bool, now: Union[float, None] = None) -> float:
+        """Schedule the next run after a cycle
+
+        Args:
+            traffic (bool): Whether the cycle found messages
+            now (Union[float, None], optional): Current time (time.monotonic()). Defaults to None.
+
+        Returns:
+            float: Interval until the next run
+        """
+        if traffic:
+            self.interval = self.min_seconds
+        else:
+            self.interval = min(self.max_seconds, self.interval * self.backoff)
+        self.next_at = (time.monotonic() if now is None else now) + self.interval
+        return self.interval
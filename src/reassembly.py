@@ -0,0 +1,186 @@
+"""Reassembly of concatenated short messages."""
+import os
+import json
+import time
+import logging
+from typing import Dict, List, Tuple, Union
+
+from sms_pdu import PDU
+
+from common.log import Logger
+from common import metrics
+
+_WAIT_SECONDS = metrics.histogram('sms_reassembly_wait_seconds', 'Time from the first part of a concatenated SMS until it is complete or timed out.',
+                                  ('result',), buckets=metrics.DELIVERY_BUCKETS)
+
+
+class ReassemblyBuffer():
+    """Reassembly buffer of concatenated short messages
+    分割SMSを(モデム, 送信元, 整理番号, 最大SM番号)ごとに保持し、揃ったら返す。
+    未完成のものはチェックポイントファイルに保存し、再起動後も引き継ぐ。
+    返したものも送信キューに保存されてdone()が呼ばれるまではチェックポイントに残し、部品もメッセージストレージから削除させない。
+    """
+
+    def __init__(self, timeout_seconds: int = 600, checkpoint_filename: str = '../data/reassembly.json', log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            timeout_seconds (int, optional): Seconds to wait for missing parts. Defaults to 600.
+            checkpoint_filename (str, optional): Checkpoint filename. Defaults to '../data/reassembly.json'.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.timeout_seconds = timeout_seconds
+        self.checkpoint_filename = checkpoint_filename
+
+        # key: (modem, from_number, reference number, maximum number)
+        # value: dict(first_seen=float, parts={sequence number: PDU}, pending=bool (returned and waiting for done()))
+        self._groups: Dict[Tuple[str, str, int, int], dict] = {}
+        self._dirty = False
+
+        self.load()
+
+    def __len__(self,) -> int:
+        return len(self._groups)
+
+    @staticmethod
+    def key(pdu: PDU) -> Tuple[str, str, int, int]:
+        """Group key of a part
+
+        Args:
+            pdu (PDU): Concatenated short message part
+
+        Returns:
+            Tuple[str, str, int, int]: (modem, from_number, reference number, maximum number)
+        """
+        reference, total, _ = pdu.concat
+        return (pdu.modem, pdu.from_number, reference, total)
+
+    def add(self, pdu: PDU, now: Union[float, None] = None) -> Union[List[PDU], None]:
+        """Add a part
+
+        Args:
+            pdu (PDU): Concatenated short message part
+            now (Union[float, None], optional): Current time (time.time()). Defaults to None.
+
+        Returns:
+            Union[List[PDU], None]: Parts sorted by sequence number if complete, otherwise None
+        """
+        key = self.key(pdu)
+
+        group = self._groups.get(key)
+        if group is None:
+            group = dict(first_seen=time.time() if now is None else now, parts={}, pending=False)
+            self._groups[key] = group
+        if group['pending']:  # 転送待ちの部品を再取得した
+            return None
+        group['parts'][pdu.concat[2]] = pdu
+        self._dirty = True
+
+        if len(group['parts']) < key[3]:
+            return None
+
+        group['pending'] = True
+        _WAIT_SECONDS.labels('complete').observe((time.time() if now is None else now) - group['first_seen'])
+        return [group['parts'][k] for k in sorted(group['parts'])]
+
+    def pop_expired(self, now: Union[float, None] = None) -> List[List[PDU]]:
+        """Pop incomplete messages older than timeout (and complete messages restored from the checkpoint)
+
+        Args:
+            now (Union[float, None], optional): Current time (time.time()). Defaults to None.
+
+        Returns:
+            List[List[PDU]]: Parts sorted by sequence number for each message
+        """
+        now = time.time() if now is None else now
+
+        out = []
+        for key, group in self._groups.items():
+            if group['pending']:
+                continue
+            if len(group['parts']) >= key[3]:
+                result = 'complete'
+            elif now - group['first_seen'] >= self.timeout_seconds:
+                result = 'timeout'
+                self._logger.warn('Reassembly timeout: {} ({}/{} parts)'.format(key, len(group['parts']), key[3]))
+            else:
+                continue
+            group['pending'] = True
+            _WAIT_SECONDS.labels(result).observe(now - group['first_seen'])
+            out.append([group['parts'][k] for k in sorted(group['parts'])])
+        return out
+
+    def done(self, key: Tuple[str, str, int, int]) -> None:
+        """Forget a returned message after it was saved to the outbox
+
+        Args:
+            key (Tuple[str, str, int, int]): Group key
+        """
+        if self._groups.pop(key, None) is not None:
+            self._dirty = True
+
+    def take_indexes(self, modem: str = '') -> List[int]:
+        """Take message storage indexes of buffered parts
+        保存済みの部品はメッセージストレージから削除してよいので、indexを返して忘れる
+        転送待ちのものは送信キューに保存してから削除するので除く
+
+        Args:
+            modem (str, optional): Modem name. Defaults to ''.
+
+        Returns:
+            List[int]: Message storage indexes of the modem
+        """
+        out = []
+        for key, group in self._groups.items():
+            if key[0] != modem or group['pending']:
+                continue
+            for pdu in group['parts'].values():
+                if pdu.index is not None:
+                    out.append(pdu.index)
+                    pdu.index = None
+        return out
+
+    def save(self,) -> None:
+        """Save buffered messages to checkpoint file (only if changed)
+        """
+        if not self._dirty:
+            return
+
+        data = [dict(modem=k[0], first_seen=g['first_seen'], parts=[p.to_hex() for p in g['parts'].values()])
+                for k, g in self._groups.items()]
+
+        dirname = os.path.dirname(self.checkpoint_filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_filename = self.checkpoint_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.checkpoint_filename)
+        self._dirty = False
+
+    def load(self,) -> None:
+        """Load buffered messages from checkpoint file
+        揃っているもの(送信キューに保存する前に停止したもの)は次のpop_expired()で返す
+        """
+        if not os.path.isfile(self.checkpoint_filename):
+            return
+
+        try:
+            with open(self.checkpoint_filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self._logger.error('Failed to load {}: {}'.format(self.checkpoint_filename, e))
+            return
+
+        for g in data:
+            for line in g['parts']:
+                pdu = PDU(line)
+                pdu.modem = g.get('modem', '')
+                group = self._groups.setdefault(self.key(pdu), dict(first_seen=g['first_seen'], parts={}, pending=False))
+                group['parts'][pdu.concat[2]] = pdu
+        self._dirty = False
+        self._logger.debug('Loaded %d buffered messages', len(self._groups))
@@ -0,0 +1,169 @@
+"""Routing of SMS to Slack channels."""
+import re
+import configparser
+import logging
+from typing import Dict, List, Union
+
+from common.phone_number import DEFAULT_COUNTRY_CODE, PrefixTrie, normalize_number
+from common.log import Logger
+
+
+class Route():
+    """Routing rule
+    指定された条件(送信元, 送信元プレフィックス, モデム, 本文の正規表現)を全て満たすSMSを、channelにtemplateで送る
+    """
+
+    def __init__(self, name: str, channel: Union[str, None] = None, template: Union[str, None] = None, priority: int = 0,
+                 senders: Union[List[str], None] = None, prefixes: Union[List[str], None] = None,
+                 modem: Union[str, None] = None, regex: Union[str, None] = None) -> None:
+        """Initialize
+
+        Args:
+            name (str): Rule name
+            channel (Union[str, None], optional): Slack channel. Defaults to None (default channel).
+            template (Union[str, None], optional): Template filename. Defaults to None (chosen by TemplateRegistry).
+            priority (int, optional): Larger is preferred. Defaults to 0.
+            senders (Union[List[str], None], optional): Sender numbers or names. Defaults to None (any).
+            prefixes (Union[List[str], None], optional): Sender number prefixes. Defaults to None (any).
+            modem (Union[str, None], optional): Modem name. Defaults to None (any).
+            regex (Union[str, None], optional): Regular expression searched in the message. Defaults to None (any).
+        """
+        self.name = name
+        self.channel = channel
+        self.template = template
+        self.priority = priority
+        self.senders = senders or []
+        self.prefixes = prefixes or []
+        self.modem = modem
+        self.regex = re.compile(regex) if regex else None
+
+    def __repr__(self,) -> str:
+        return 'Route({})'.format(self.name)
+
+
+class Router():
+    """Routing table
+    読み込み時にインデックスを作り、送信元の完全一致(dict) → プレフィックス(trie) → その他の順に候補を集め、
+    優先度の高い候補から順にモデム・正規表現を確認する(正規表現は候補にしか評価しない)。
+    どのルールにも一致しなければdefaultを返す。
+    """
+
+    def __init__(self, routes: List[Route], default: Route, country_code: str = DEFAULT_COUNTRY_CODE, log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            routes (List[Route]): Routing rules
+            default (Route): Route used when no rule matches
+            country_code (str, optional): Country code used for national numbers. Defaults to DEFAULT_COUNTRY_CODE.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.routes = routes
+        self.default = default
+        self.country_code = country_code
+
+        self._exact: Dict[str, List[Route]] = {}
+        self._prefix_rules: Dict[str, List[Route]] = {}
+        self._prefixes = PrefixTrie()  # 値は(プレフィックスの長さ, self._prefix_rulesのリスト)
+        self._others: List[Route] = []
+        self._order: Dict[int, int] = {}  # id(route): 定義順
+
+        for i, route in enumerate(routes):
+            self._order[id(route)] = i
+            for sender in route.senders:
+                self._exact.setdefault(self.sender_key(sender), []).append(route)
+            for prefix in route.prefixes:
+                key = self.sender_key(prefix)
+                if key not in self._prefix_rules:
+                    self._prefix_rules[key] = []
+                    self._prefixes.add(key, (len(key), self._prefix_rules[key]))
+                self._prefix_rules[key].append(route)
+            if len(route.senders) == 0 and len(route.prefixes) == 0:
+                self._others.append(route)
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser, log_level: int = logging.INFO) -> 'Router':
+        """Create from [route:name] sections
+
+        Args:
+            config (configparser.ConfigParser): Config
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+
+        Returns:
+            Router: Routing table
+        """
+        def split(value: Union[str, None]) -> List[str]:
+            return [v.strip() for v in (value or '').split(',') if len(v.strip())]
+
+        routes = []
+        for section in config.sections():
+            if not section.startswith('route:'):
+                continue
+            c = config[section]  # 正規表現の%を補間しないようにrawで読む
+            routes.append(Route(section[len('route:'):],
+                                channel=c.get('channel', raw=True),
+                                template=c.get('template', raw=True),
+                                priority=int(c.get('priority', '0', raw=True)),
+                                senders=split(c.get('sender', raw=True)),
+                                prefixes=split(c.get('prefix', raw=True)),
+                                modem=c.get('modem', raw=True),
+                                regex=c.get('regex', raw=True)))
+
+        default = Route('default', channel=config['setting']['slack_channel'])
+        return cls(routes, default, log_level=log_level)
+
+    def __len__(self,) -> int:
+        return len(self.routes)
+
+    def sender_key(self, sender: str) -> str:
+        """Key of sender index
+
+        Args:
+            sender (str): Sender number or name
+
+        Returns:
+            str: Normalized number (names are lower-cased)
+        """
+        return normalize_number(sender, self.country_code).lower()
+
+    def candidates(self, sender: str) -> List[Route]:
+        """Rules whose sender conditions match
+
+        Args:
+            sender (str): Sender number or name
+
+        Returns:
+            List[Route]: Rules in order of preference (priority, then exact sender > longer prefix > others, then definition order)
+        """
+        key = self.sender_key(sender)
+
+        found = {}  # id(route): (並び順, route)
+        for route in self._exact.get(key, []):
+            found.setdefault(id(route), ((-route.priority, 0, 0, self._order[id(route)]), route))
+        for length, rules in reversed(self._prefixes.match_all(key)):  # 長いプレフィックスから
+            for route in rules:
+                found.setdefault(id(route), ((-route.priority, 1, -length, self._order[id(route)]), route))
+        for route in self._others:
+            found.setdefault(id(route), ((-route.priority, 2, 0, self._order[id(route)]), route))
+
+        return [route for _, route in sorted(found.values(), key=lambda v: v[0])]
+
+    def route(self, sms: dict) -> Route:
+        """Find route of SMS
+
+        Args:
+            sms (dict): SMS
+
+        Returns:
+            Route: Matched rule (default if none matches)
+        """
+        modem = sms.get('modem', '')
+        for route in self.candidates(sms['from_number']):
+            if route.modem is not None and route.modem != modem:
+                continue
+            if route.regex is not None and route.regex.search(sms['message']) is None:
+                continue
+            self._logger.debug('%s -> %s', sms['from_number'], route)
+            return route
+        return self.default
@@ -0,0 +1,396 @@
+"""Slack sender worker draining the outbox."""
+import time
+import threading
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from outbox import Outbox
+
+from common.log import Logger
+from common import metrics
+
+_POST_SECONDS = metrics.histogram('sms_slack_post_seconds', 'Slack chat.postMessage latency.')
+_POSTS = metrics.counter('sms_slack_posts_total', 'Slack chat.postMessage calls by HTTP status code.', ('status',))
+_PAUSED = metrics.gauge('sms_slack_sender_paused', 'Whether posting is paused by an account level Slack error (1) or not (0).')
+_DEAD_MESSAGES = metrics.counter('sms_slack_dead_messages_total', 'Messages dropped from the outbox because of a permanent Slack error.',
+                                 ('error',))
+_POSTED_MESSAGES = metrics.counter('sms_slack_posted_messages_total', 'SMS posted to Slack (several SMS may share one post).')
+_DELIVERY_SECONDS = metrics.histogram('sms_delivery_seconds', 'Time from the SMS service centre time stamp to the Slack ack.',
+                                      buckets=metrics.DELIVERY_BUCKETS)
+
+
+class TokenBucket():
+    """Token bucket rate limiter
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """Initialize
+
+        Args:
+            rate (float): Tokens added per second
+            capacity (float): Maximum tokens (burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def acquire(self, now: float = None) -> float:
+        """Take one token if available
+
+        Args:
+            now (float, optional): time.monotonic(). Defaults to None.
+
+        Returns:
+            float: 0 if acquired, otherwise seconds until a token is available
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self, now: float = None) -> None:
+        """Drop all tokens (after being rate limited by the server)
+
+        Args:
+            now (float, optional): time.monotonic(). Defaults to None.
+        """
+        self.tokens = 0
+        self.updated_at = time.monotonic() if now is None else now
+
+
+class SlackSender():
+    """Slack sender worker
+    Outboxを別スレッドで送信する。失敗したら指数バックオフ(429はRetry-After)で再送する。
+    再送しても成功しないエラーは範囲に応じて扱う。
+    - ACCOUNT_ERRORS: トークン・ワークスペースの問題なので、メッセージはOutboxに残したまま送信をACCOUNT_RETRY_SECONDS止める
+    - CHANNEL_ERRORS: そのチャンネルには送れないので、Outboxのdeadテーブルに移してチャンネルの後続を止めない
+    - MESSAGE_ERRORS: まとめたメッセージなら1件ずつ送り直し、1件でも失敗するものはdeadテーブルに移す
+    チャンネルごとにトークンバケットで送信間隔を制限し、溜まっている場合は複数のSMSを1つのメッセージにまとめる。
+    """
+
+    IDLE_WAIT_SECONDS = 60  # 送るものがないときの最大待ち時間
+    SECTION_TEXT_LIMIT = 3000  # Block Kit section textの最大文字数
+    MAX_BLOCKS = 50  # 1メッセージの最大ブロック数
+    ACCOUNT_ERRORS = ('invalid_auth', 'not_authed', 'token_revoked', 'token_expired', 'account_inactive')
+    CHANNEL_ERRORS = ('channel_not_found', 'not_in_channel', 'is_archived')
+    MESSAGE_ERRORS = ('msg_too_long', 'invalid_blocks')
+    ACCOUNT_RETRY_SECONDS = 600  # アカウントのエラーで送信を止める時間(トークンを直して再起動するまで定期的に試す)
+
+    def __init__(self, client: WebClient, outbox: Outbox, base_backoff_seconds: float = 1, max_backoff_seconds: float = 300,
+                 rate_per_second: float = 1, burst: int = 3, coalesce_max_messages: int = 10, coalesce_max_chars: int = 12000,
+                 log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            client (WebClient): Slack client
+            outbox (Outbox): Outbox
+            base_backoff_seconds (float, optional): First retry delay. Defaults to 1.
+            max_backoff_seconds (float, optional): Maximum retry delay. Defaults to 300.
+            rate_per_second (float, optional): Messages per second per channel. Defaults to 1 (chat.postMessage special tier).
+            burst (int, optional): Burst size per channel. Defaults to 3.
+            coalesce_max_messages (int, optional): Maximum SMS merged into one message. Defaults to 10.
+            coalesce_max_chars (int, optional): Maximum characters of a merged message. Defaults to 12000.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.client = client
+        self.outbox = outbox
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.coalesce_max_messages = min(coalesce_max_messages, (self.MAX_BLOCKS + 1) // 2)  # section + divider
+        self.coalesce_max_chars = coalesce_max_chars
+
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._rate_wait = None  # トークン待ちの最短時間
+        self._paused_until = None  # アカウントのエラーで送信を止めている期限(time.monotonic())
+        self._unmerged = set()  # まとめずに1件ずつ送るメッセージのid
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self,) -> None:
+        """Notify that messages were added to the outbox
+        """
+        self._wakeup.set()
+
+    def start(self,) -> None:
+        """Start sender thread
+        """
+        self._thread = threading.Thread(target=self.run, name='slack_sender', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop sender thread
+
+        Args:
+            timeout (float, optional): Seconds to wait for the thread. Defaults to 10.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def queue_depth(self,) -> Dict[str, int]:
+        """Number of messages waiting for each channel
+
+        Returns:
+            Dict[str, int]: {channel: number of messages}
+        """
+        return self.outbox.depth_by_channel()
+
+    def run(self,) -> None:
+        """Sender loop
+        """
+        while not self._stop.is_set():
+            try:
+                self.send_once()
+            except Exception as e:  # noqa
+                self._logger.error('Slack sender error: {}'.format(e))
+
+            self._wakeup.wait(self.next_wait())
+            self._wakeup.clear()
+
+    def next_wait(self,) -> float:
+        """Seconds until the next message is due or a token is available
+
+        Returns:
+            float: Seconds to wait (IDLE_WAIT_SECONDS at most)
+        """
+        if self.paused:
+            return min(self._paused_until - time.monotonic(), self.IDLE_WAIT_SECONDS)
+        next_attempt_at = self.outbox.next_attempt_at()
+        timeout = self.IDLE_WAIT_SECONDS if next_attempt_at is None else max(0, next_attempt_at - time.time())
+        if self._rate_wait is not None:
+            timeout = min(timeout, self._rate_wait)
+        return min(timeout, self.IDLE_WAIT_SECONDS)
+
+    def due_batches(self,) -> Iterator[Tuple[str, TokenBucket, list]]:
+        """Batches of the channels that are due and not rate limited (one per channel)
+
+        Yields:
+            Tuple[str, TokenBucket, list]: (channel, token bucket of the channel, messages merged into one post)
+        """
+        self._rate_wait = None
+        if self.paused:
+            return
+        for head in self.outbox.heads():
+            channel = head['channel']
+            bucket = self._buckets.setdefault(channel, TokenBucket(self.rate_per_second, self.burst))
+
+            wait = bucket.acquire()
+            if wait > 0:  # このチャンネルは次のトークンまで待つ
+                self._rate_wait = wait if self._rate_wait is None else min(self._rate_wait, wait)
+                continue
+
+            yield channel, bucket, self.select_batch(self.outbox.peek(channel, self.coalesce_max_messages))
+
+    def send_once(self,) -> int:
+        """Send the head messages of each channel that is due and not rate limited
+
+        Returns:
+            int: Number of sent SMS
+        """
+        sent = 0
+        while not self._stop.is_set():
+            progressed = False
+
+            for channel, bucket, rows in self.due_batches():
+                if self.post(channel, rows):
+                    sent += len(rows)
+                    progressed = True
+                else:
+                    bucket.drain()
+
+            if not progressed:
+                break
+        return sent
+
+    def select_batch(self, rows: list) -> list:
+        """Select messages merged into one post
+
+        Args:
+            rows (list): Oldest messages of a channel (sqlite3.Row)
+
+        Returns:
+            list: Messages from the head whose total length is within the limit (at least one)
+        """
+        batch = rows[:1]
+        if len(rows[0]['text']) > self.SECTION_TEXT_LIMIT or rows[0]['id'] in self._unmerged:  # 単独でtextとして送る
+            return batch
+        length = len(rows[0]['text'])
+        for row in rows[1:]:
+            length += len(row['text'])
+            if length > self.coalesce_max_chars or len(row['text']) > self.SECTION_TEXT_LIMIT or row['id'] in self._unmerged:
+                break
+            batch.append(row)
+        return batch
+
+    def post(self, channel: str, rows: list) -> bool:
+        """Post messages (merged into Block Kit sections if more than one)
+
+        Args:
+            channel (str): Slack channel
+            rows (list): Outbox messages (sqlite3.Row)
+
+        Returns:
+            bool: True if sent
+        """
+        started_at = time.monotonic()
+        try:
+            self.client.chat_postMessage(**self.create_message(channel, rows))
+        except (SlackApiError, OSError) as e:
+            self.failed(rows, e, started_at)
+            return False
+
+        self.sent(rows, started_at)
+        return True
+
+    def create_message(self, channel: str, rows: list) -> dict:
+        """Arguments of chat.postMessage
+
+        Args:
+            channel (str): Slack channel
+            rows (list): Outbox messages (sqlite3.Row)
+
+        Returns:
+            dict: Arguments of chat_postMessage
+        """
+        if len(rows) == 1:
+            return dict(channel=channel, text=rows[0]['text'])
+
+        self._logger.debug('Merged %d messages into one post', len(rows))
+        return dict(channel=channel,
+                    text='\n\n'.join([row['text'] for row in rows]),
+                    blocks=self.create_blocks([row['text'] for row in rows]))
+
+    @property
+    def paused(self,) -> bool:
+        """Whether posting is paused by an account level error
+        """
+        return self._paused_until is not None and time.monotonic() < self._paused_until
+
+    def failed(self, rows: list, e: Exception, started_at: float) -> None:
+        """Handle a failed post (schedule a retry of the head message, pause, or drop messages that can never be sent)
+
+        Args:
+            rows (list): Outbox messages of the post (sqlite3.Row)
+            e (Exception): SlackApiError or connection error
+            started_at (float): time.monotonic() when the post started
+        """
+        head = rows[0]
+        delay = self.backoff(head['attempts'])
+        if isinstance(e, SlackApiError):
+            _POST_SECONDS.observe(time.monotonic() - started_at)
+            _POSTS.labels(str(e.response.status_code)).inc()
+            if e.response.status_code == 429:
+                delay = self.retry_after(e.response.headers, delay)
+            error = e.response.get('error')
+            if error in self.ACCOUNT_ERRORS:  # 全てのメッセージが送れないのでOutboxに残して止める
+                self._paused_until = time.monotonic() + self.ACCOUNT_RETRY_SECONDS
+                _PAUSED.set(1)
+                self._logger.critical('Slack rejected the token ({}), posting paused for {}s'.format(error, self.ACCOUNT_RETRY_SECONDS))
+                return
+            if error in self.MESSAGE_ERRORS and len(rows) > 1:  # どのメッセージが原因か分からないので1件ずつ送り直す
+                self._unmerged.update([row['id'] for row in rows])
+                self._logger.warn('Failed to post {} merged messages, retry one by one: {}'.format(len(rows), error))
+                return
+            if error in self.CHANNEL_ERRORS or error in self.MESSAGE_ERRORS:
+                self.dead(rows, error)
+                return
+        else:
+            _POSTS.labels('error').inc()
+            error = e
+        self._logger.warn('Failed to post message (id={}), retry in {}s: {}'.format(head['id'], delay, error))
+        self.outbox.retry_later(head['id'], delay)
+
+    def dead(self, rows: list, error: str) -> None:
+        """Move messages that can never be sent to the dead table of the outbox
+
+        Args:
+            rows (list): Outbox messages (sqlite3.Row)
+            error (str): Slack error
+        """
+        for row in rows:
+            _DEAD_MESSAGES.labels(error).inc()
+            self._logger.error('Failed to post message (id={}) to {}, moved to dead: {}'.format(row['id'], row['channel'], error))
+            self.outbox.dead(row['id'], error)
+            self._unmerged.discard(row['id'])
+
+    def sent(self, rows: list, started_at: float) -> None:
+        """Record a successful post and remove the messages from the outbox
+
+        Args:
+            rows (list): Outbox messages (sqlite3.Row)
+            started_at (float): time.monotonic() when the post started
+        """
+        _POST_SECONDS.observe(time.monotonic() - started_at)
+        _POSTS.labels('200').inc()
+        _POSTED_MESSAGES.inc(len(rows))
+        now = time.time()
+        for row in rows:
+            if row['received_at'] is not None:
+                _DELIVERY_SECONDS.observe(now - row['received_at'])
+
+        self.outbox.done_many([row['id'] for row in rows])
+        self._unmerged.difference_update([row['id'] for row in rows])
+        if self._paused_until is not None:
+            self._paused_until = None
+            _PAUSED.set(0)
+            self._logger.info('Slack posting resumed')
+
+    def create_blocks(self, text_list: List[str]) -> List[dict]:
+        """Create Block Kit blocks (one section per SMS)
+
+        Args:
+            text_list (List[str]): Message texts
+
+        Returns:
+            List[dict]: Blocks
+        """
+        blocks = []
+        for text in text_list:
+            if len(blocks):
+                blocks.append(dict(type='divider'))
+            blocks.append(dict(type='section', text=dict(type='mrkdwn', text=text[:self.SECTION_TEXT_LIMIT])))
+        return blocks
+
+    def retry_after(self, headers: dict, default: float) -> float:
+        """Retry-After header value
+
+        Args:
+            headers (dict): Response headers
+            default (float): Value if not available
+
+        Returns:
+            float: Seconds to wait
+        """
+        for key, value in headers.items():
+            if key.lower() == 'retry-after':
+                try:
+                    return float(value[0] if isinstance(value, list) else value)
+                except ValueError:
+                    break
+        return default
+
+    def backoff(self, attempts: int) -> float:
+        """Retry delay
+
+        Args:
+            attempts (int): Number of failed attempts so far
+
+        Returns:
+            float: Seconds to wait
+        """
+        return min(self.max_backoff_seconds, self.base_backoff_seconds * (2 ** attempts))
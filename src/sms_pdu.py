@@ -1,100 +1,200 @@
 import sys
 import binascii
-import io
 import datetime
 import pprint  # noqa
 import logging
+from typing import List, Tuple, Union
 
 import gsm0338  # noqa
 
 from common.log import Logger
 
 
+_logger: Union[Logger, None] = None  # 初回の警告で作る(importしただけでハンドラ・出力スレッドを設定しない)
+
+_NOT_DECODED = object()  # 未デコードを表す番兵
+
+_SWAPPED_HEX = tuple('{:x}{:x}'.format(b & 0x0F, b >> 4) for b in range(256))  # semioctet変換表
+
+
 class PDU():
-    LOGGING_FMT = '[%(asctime)s.%(msecs)-3d][%(levelname)8s] %(message)s'
-    LOGGING_DATE_FMT = '%Y/%m/%d %H:%M:%S'
+    """SMS-DELIVER PDU
+    1つのバッファ上のオフセットだけを保持し、各フィールドは初回アクセス時にデコードしてキャッシュする
+    """
+
+    __slots__ = ('_data', '_smsc_length', '_sms_type', '_address_length', '_toa', '_sender_offset', '_tp_offset', '_udl',
+                 '_ud_offset', '_udhl', '_timestamp', '_from_number', '_message', '_udh', 'index', 'modem', '__weakref__')
 
     def __init__(self, line=None, log_level=logging.INFO):
         """
+        log_level is kept for compatibility (PDU no longer owns a logger).
         """
-        self._logger = Logger(name=__name__, level=log_level)
+        self._timestamp = _NOT_DECODED
+        self._from_number = _NOT_DECODED
+        self._message = _NOT_DECODED
+        self._udh = _NOT_DECODED
 
-        self.pdu = {}
+        self.index = None  # メッセージストレージ上のindex(+CMGL)
+        self.modem = ''  # 受信したモデム(config.iniの[modem:名前])
 
         if line is not None:
             self.parse_pdu(line)
 
-    def __del__(self,):
-        """
-        """
-        pass
-
     @property
     def timestamp(self,) -> str:
-        return self.convert_timestamp_from_bytes_to_str(self.pdu['tp_scts'])
+        if self._timestamp is _NOT_DECODED:
+            self._timestamp = self.convert_timestamp_from_bytes_to_str(self.tp_scts)
+        return self._timestamp
 
     @property
     def from_number(self,) -> str:
+        if self._from_number is not _NOT_DECODED:
+            return self._from_number
+
         number = ''
-        type_of_number = self.pdu['type_of_address']['type_of_number']
+        type_of_number = (self._toa & 0b01110000) >> 4
         if type_of_number == 0b000:
-            number = self.convert_from_number_from_bytes_to_str(self.pdu['sender_number'])
-        elif type_of_number == 0b101:
-            number = self.convert_from_8bit_to_7bit(self.pdu['sender_number']).decode('gsm03.38')
+            number = self.convert_from_number_from_bytes_to_str(self.sender_number)
+        elif type_of_number == 0b101:  # Alphanumeric
+            number = self.convert_from_8bit_to_7bit(self.sender_number, self._address_length * 4 // 7).decode('gsm03.38')
         else:
-            self._logger.warn('Unimplemented. "type of number": {}'.format(bin(type_of_number)))
-            number = self.convert_from_number_from_bytes_to_str(self.pdu['sender_number'])
+            get_logger().warn('Unimplemented. "type of number": %s', bin(type_of_number))
+            number = self.convert_from_number_from_bytes_to_str(self.sender_number)
             # raise Exception('Unimplemented "type of number": {}'.format(bin(type_of_number)))
+        self._from_number = number
         return number
 
     @property
     def message(self,) -> str:
+        if self._message is not _NOT_DECODED:
+            return self._message
+
         message = ''
-        if self.pdu['tp_dcs'] == 0x00:  # 8-bit reference number
-            message = self.convert_from_8bit_to_7bit(self.pdu['tp_ud']['ud']).decode('gsm03.38')
-        elif self.pdu['tp_dcs'] == 0x08:  # 0x08: 16-bit reference number
-            message = self.pdu['tp_ud']['ud'].decode('utf-16-be')
+        tp_dcs = self.tp_dcs
+        if tp_dcs == 0x00:  # 8-bit reference number
+            if self._udhl is None:
+                message = self.convert_from_8bit_to_7bit(self.ud, self._udl).decode('gsm03.38')
+            else:  # UDHの後ろは7bit境界から始まる
+                skip = ((self._udhl + 1) * 8 + 6) // 7
+                ud = self._data[self._ud_offset:]
+                message = self.convert_from_8bit_to_7bit(ud, self._udl, skip).decode('gsm03.38')
+        elif tp_dcs == 0x08:  # 0x08: 16-bit reference number
+            message = str(self.ud, 'utf-16-be')
         else:
-            raise Exception('Unimplemented DCS: {}'.format(hex(self.pdu['tp_dcs'])))
+            raise Exception('Unimplemented DCS: {}'.format(hex(tp_dcs)))
+        self._message = message
         return message
 
     @property
     def mms(self,) -> bool:
-        return False if self.pdu['sms_type'] & 0b00000100 else True  # More Message to Send # 後続データの有無
+        return False if self._sms_type & 0b00000100 else True  # More Message to Send # 後続データの有無
+
+    @property
+    def concat(self,) -> Union[Tuple[int, int, int], None]:
+        """Concatenated short message info (None if not concatenated)
+
+        [9.2.3.24.1 Concatenated Short Messages] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_20/5_Appendix/Rel9/23/23040-930.pdf
+
+        Returns:
+            Union[Tuple[int, int, int], None]: (reference number, maximum number, sequence number)
+        """
+        for ie in self.udh or ():
+            ied = ie['ied']
+            if ie['iei'] == 0x00 and len(ied) == 3:  # 8-bit reference number
+                return ied[0], ied[1], ied[2]
+            if ie['iei'] == 0x08 and len(ied) == 4:  # 16-bit reference number
+                return (ied[0] << 8) | ied[1], ied[2], ied[3]
+        return None
+
+    def to_hex(self,) -> str:
+        """PDU as hex string
+        """
+        return self._data.hex().upper()
+
+    @property
+    def sender_number(self,) -> memoryview:
+        return self._data[self._sender_offset:self._tp_offset]
+
+    @property
+    def tp_pid(self,) -> int:
+        return self._data[self._tp_offset]  # Protocol identifier
+
+    @property
+    def tp_dcs(self,) -> int:
+        return self._data[self._tp_offset + 1]  # Data coding scheme
+
+    @property
+    def tp_scts(self,) -> memoryview:
+        return self._data[self._tp_offset + 2:self._tp_offset + 9]  # Timestamp # NOTE: semioctet
+
+    @property
+    def received_at(self,) -> float:
+        """Service centre time stamp as UNIX time (including the time zone)
+        """
+        v = self.semioctet(self.tp_scts)
+        tz = int(v[12], 16)
+        quarters = (tz & 0b0111) * 10 + int(v[13])  # 15分単位, 先頭桁のbit3が負号
+        offset = datetime.timedelta(minutes=15 * quarters) * (-1 if tz & 0b1000 else 1)
+        timestamp = datetime.datetime(2000 + int(v[:2]), int(v[2:4]), int(v[4:6]), int(v[6:8]), int(v[8:10]), int(v[10:12]),
+                                      tzinfo=datetime.timezone(offset))
+        return timestamp.timestamp()
+
+    @property
+    def udh(self,) -> Union[list, None]:
+        """User data header (None if not present)
+        """
+        if self._udh is _NOT_DECODED:
+            if self._udhl is None:
+                self._udh = None
+            else:
+                offset = self._ud_offset + 1
+                self._udh = self.parse_user_data_header(self._data[offset:offset + self._udhl])
+        return self._udh
 
-    def parse_user_data_header(self, udh: bytearray) -> list:
-        # [9.2.3.24.8 Concatenated Short Messages, 16-bit reference number ] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_20/5_Appendix/Rel9/23/23040-930.pdf
+    @property
+    def ud(self,) -> memoryview:
+        """User data (without user data header)
+        """
+        offset = self._ud_offset
+        if self._udhl is not None:
+            offset += 1 + self._udhl
+        return self._data[offset:self._ud_offset + self._udl]
+
+    @property
+    def pdu(self,) -> dict:
+        """Decoded fields as dict (for compatibility)
+        """
+        out = {}
+        out['smsc_length'] = self._smsc_length
+        if self._smsc_length > 0:
+            out['service_center_number'] = bytes(self._data[2:1 + self._smsc_length])
+        out['sms_type'] = self._sms_type
+        out['address_length'] = self._address_length
+        out['type_of_address'] = self.parse_type_of_number(self._toa)
+        out['sender_number'] = bytes(self.sender_number)
+        out['tp_pid'] = self.tp_pid
+        out['tp_dcs'] = self.tp_dcs
+        out['tp_scts'] = bytes(self.tp_scts)
+        out['tp_udl'] = self._udl
+        out['tp_ud'] = dict(udhl=self._udhl, udh=self.udh, ud=bytes(self.ud))
+        return out
+
+    def parse_user_data_header(self, udh: memoryview) -> list:
+        # [9.2.3.24.8 Concatenated Short Messages, 16-bit reference number ]
+        # https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_20/5_Appendix/Rel9/23/23040-930.pdf
         # https://www.au.com/content/dam/au-com/okinawa_cellular/common/pdf/corporate/disclosure/setsuzoku_yakkan/gijutsu.pdf
         out = []
-        tmp = dict(iei=None, iedl=None, ied=None)
-        d = io.BytesIO(udh)
-
-        while True:
-            iei = d.read(1)
-            if len(iei) == 0:
-                break
-            tmp['iei'] = iei[0]  # Information Element Identifier
-            tmp['iedl'] = d.read(1)[0]  # Information Element Data Length
-            tmp['ied'] = d.read(tmp['iedl'])  # Information Element Data
+        i = 0
+        while i < len(udh):
+            iei = udh[i]  # Information Element Identifier
+            iedl = udh[i + 1]  # Information Element Data Length
+            ied = bytes(udh[i + 2:i + 2 + iedl])  # Information Element Data
             # IED
             #     Octet1-2 8bit連結SM整理番号
             #     Octet3   最大SM番号
             #     Octet4   シーケンス番号
-            out.append(tmp)
-        return out
-
-    def parse_user_data(self, ud: bytearray) -> dict:
-        out = dict(udhl=None, udh=None, ud=None)
-        d = io.BytesIO(ud)
-
-        sms_type = self.pdu['sms_type']
-        udhi = sms_type & 0b01000000  # User Data Header Indicate # UDHの有無
-
-        if udhi:
-            out['udhl'] = d.read(1)[0]
-            out['udh'] = self.parse_user_data_header(d.read(out['udhl']))
-
-        out['ud'] = d.read()
+            out.append(dict(iei=iei, iedl=iedl, ied=ied))
+            i += 2 + iedl
         return out
 
     def parse_type_of_number(self, t: int):
@@ -107,93 +207,119 @@ class PDU():
 
     def parse_pdu(self, line: str):
         # www.gsm-modem.de/sms-pdu-mode.html
-        # tp_pid                tp-protocol-identifier
-        # tp_dcs                tp-data-coding-scheme
-        # tp_scts  (bytearray)  tp-service-center-time-stamp
-        # tp_udl   (int)        tp-user-data-length
-        # tp_ud    (dict)       tp-user-data
-        #     udhl (int)
-        #     udh  (list)
-        #     ud   (bytearray)
-
-        data = binascii.unhexlify(line)
-        d = io.BytesIO(data)
+        # SMSC length, [SMSC], sms type, address length, type of address, sender number,
+        # tp_pid, tp_dcs, tp_scts(7), tp_udl, tp_ud([udhl, udh], ud)
+        # 値はデコードせずオフセットのみ記録する
+        self.parse_buffer(memoryview(binascii.unhexlify(line)))
+
+    def parse_buffer(self, data: memoryview):
+        """Parse PDU from binary buffer (not copied)
+
+        Args:
+            data (memoryview): PDU binary
+        """
+        self._data = data
 
         # SMSC: ShotMessage ServiceCenter
-        self.pdu['smsc_length'] = d.read(1)[0]
-        if self.pdu['smsc_length'] > 0:
-            self.pdu['type_of_address'] = d.read(1)[0]
-            self.pdu['service_center_number'] = d.read(self.pdu['smsc_length'] - 1)  # NOTE: semioctet, With an "f" at the end.
+        self._smsc_length = data[0]
+        i = 1 + self._smsc_length  # NOTE: type of address + semioctet service center number
 
-        self.pdu['sms_type'] = d.read(1)[0]
-        self.pdu['address_length'] = d.read(1)[0]
-        self.pdu['type_of_address'] = self.parse_type_of_number(d.read(1)[0])
-        self.pdu['sender_number'] = d.read(int((self.pdu['address_length'] + 1) / 2))  # NOTE: semioctet, With an "f" at the end.
+        self._sms_type = data[i]
+        self._address_length = data[i + 1]
+        self._toa = data[i + 2]
+        self._sender_offset = i + 3
+        self._tp_offset = self._sender_offset + (self._address_length + 1) // 2  # NOTE: semioctet, With an "f" at the end.
 
         # TP: Transport Protocol
-        self.pdu['tp_pid'] = d.read(1)[0]  # Protocol identifier
-        self.pdu['tp_dcs'] = d.read(1)[0]  # Data coding scheme
-        self.pdu['tp_scts'] = d.read(7)  # Timestamp # NOTE: semioctet
-        self.pdu['tp_udl'] = d.read(1)[0]  # User data length
-        self.pdu['tp_ud'] = self.parse_user_data(d.read(self.pdu['tp_udl']))  # User data
-
-    def semioctet(self, x: bytearray) -> str:
-        hex_str_list = list(binascii.hexlify(x).decode('utf-8'))
-        out = ''
-        while len(hex_str_list):
-            out += hex_str_list.pop(1)
-            out += hex_str_list.pop(0)
-        return out
+        self._udl = data[self._tp_offset + 9]  # User data length
+        self._ud_offset = self._tp_offset + 10
+
+        udhi = self._sms_type & 0b01000000  # User Data Header Indicate # UDHの有無
+        self._udhl = data[self._ud_offset] if udhi else None
+
+    def semioctet(self, x: bytes) -> str:
+        return ''.join(map(_SWAPPED_HEX.__getitem__, x))
 
-    def convert_timestamp_from_bytes_to_str(self, bs: bytearray) -> str:
+    def convert_timestamp_from_bytes_to_str(self, bs: bytes) -> str:
         # [9.2.3.11 TP-Service-Center-Time-Stamp(TP-SCTS)] https://www.arib.or.jp/english/html/overview/doc/STD-T63v9_20/5_Appendix/Rel9/23/23040-930.pdf
         v = self.semioctet(bs)
         timestamp = datetime.datetime(2000 + int(v[:2]), int(v[2:4]), int(v[4:6]),
                                       int(v[6:8]), int(v[8:10]), int(v[10:12]))
         return timestamp.strftime('%Y-%m-%d %H:%M:%S')  # + f'{v[12:14]}'
 
-    def convert_from_number_from_bytes_to_str(self, bs: bytearray) -> str:
+    def convert_from_number_from_bytes_to_str(self, bs: bytes) -> str:
         return self.semioctet(bs).replace('f', '')
 
-    def convert_from_8bit_to_7bit(self, bs: bytearray) -> bytearray:
+    def convert_from_8bit_to_7bit(self, bs: bytes, septets: Union[int, None] = None, skip: int = 0) -> bytes:
         """Convert from 8bit to 7bit(GSM03.38)
 
         Args:
-            bs (bytearray): 8bit user data
+            bs (bytes): 8bit user data
+            septets (Union[int, None], optional): Number of septets in bs. Defaults to None (as many as fit).
+            skip (int, optional): Number of leading septets to skip (UDH). Defaults to 0.
 
         Returns:
-            bytearray: 7bit(GSM03.38)
+            bytes: 7bit(GSM03.38)
         """
-        # https://www.codeproject.com/Tips/470755/Encoding-Decoding-7-bit-User-Data-for-SMS-PDU-PDU
-        out = bytearray()
-        pc = 0  # previous carry
-        pc_len = 0  # pc length
-        i = 0
-        count = 0
-        while True:
-            s = i % 8 + 1  # 1 ~ 8
+        return unpack_septets(bs, septets, skip)
 
-            if s == 8:
-                c = 0
-                sept = 0
-            else:
-                octet = bs[count]
-                c = octet >> (8 - s)
-                sept = octet & (0xFF >> s)
 
-                count += 1
+def get_logger() -> Logger:
+    """Logger of this module (created on first use)
 
-            sept = (sept << pc_len) | pc
-            out.append(sept)
+    Returns:
+        Logger: Logger
+    """
+    global _logger
+    if _logger is None:
+        _logger = Logger(name=__name__)
+    return _logger
 
-            pc = c
-            pc_len = s % 8
 
-            i += 1
+def unpack_septets(bs: bytes, septets: Union[int, None] = None, skip: int = 0) -> bytes:
+    """Unpack GSM 7-bit packed data
+    ユーザーデータ全体を1つの整数として扱い、7bitずつ取り出す
 
-            if count >= len(bs):
-                break
-        return out
+    [参]
+    - [6.1.2.1 SMS Packing] https://www.etsi.org/deliver/etsi_ts/123000_123099/123038/16.00.00_60/ts_123038v160000p.pdf
+
+    Args:
+        bs (bytes): 8bit packed data
+        septets (Union[int, None], optional): Number of septets in bs. Defaults to None (as many as fit).
+        skip (int, optional): Number of leading septets to skip. Defaults to 0.
+
+    Returns:
+        bytes: Septets (one per byte)
+    """
+    if septets is None:
+        septets = len(bs) * 8 // 7
+        if len(bs) % 7 == 0 and septets and (bs[-1] >> 1) == 0:  # 末尾7bitは埋め草
+            septets -= 1
+    n = int.from_bytes(bs, 'little')
+    return bytes([(n >> shift) & 0x7F for shift in range(7 * skip, 7 * septets, 7)])
+
+
+def decode_many(lines: List[str]) -> List[PDU]:
+    """Decode PDU hex strings in one call
+    16進文字列をまとめて1回で変換し、各PDUは自分の分だけをコピーして持つ(再構成バッファに残る部品が+CMGLの応答全体を保持しないように)
+
+    Args:
+        lines (List[str]): PDU hex strings
+
+    Returns:
+        List[PDU]: PDU list
+    """
+    data = binascii.unhexlify(''.join(lines))
+
+    out = []
+    offset = 0
+    for line in lines:
+        length = len(line) // 2
+        pdu = PDU()
+        pdu.parse_buffer(memoryview(data[offset:offset + length]))  # bytesのスライスはコピー
+        out.append(pdu)
+        offset += length
+    return out
 
 
 if __name__ == "__main__":
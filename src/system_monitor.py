@@ -0,0 +1,136 @@
+"""Background sampler of system resources."""
+import time
+import threading
+import collections
+import logging
+from typing import Dict, List, Union
+
+import psutil
+
+from common.log import Logger
+from common.util import read_soc_temperature, read_core_volts, read_throttled
+from common import metrics
+
+
+class SystemMonitor():
+    """Background sampler of system resources
+    CPU・メモリ・ディスク・SoC温度・電圧・スロットリング状態をsample_seconds毎に記録し、固定長のリングバッファに保持する。
+    /get_bot_infoはバッファから直近window_minutes分の最小・平均・最大を返すだけで、コマンドの実行やCPU使用率の計測を待たない。
+    """
+
+    FIELDS = ('cpu', 'mem', 'dsk', 'temp', 'volt')
+
+    def __init__(self, sample_seconds: float = 10, window_minutes: float = 10, disk_path: str = '/', log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            sample_seconds (float, optional): Sampling interval. Defaults to 10.
+            window_minutes (float, optional): Period to keep. Defaults to 10.
+            disk_path (str, optional): Path of the disk to watch. Defaults to '/'.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.sample_seconds = sample_seconds
+        self.window_minutes = window_minutes
+        self.disk_path = disk_path
+
+        self._samples = collections.deque(maxlen=max(1, int(window_minutes * 60 / sample_seconds)))
+        self._lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        psutil.cpu_percent()  # 初回は0.0を返すので、次のサンプルまでの平均になるよう基準点を作る
+
+        # 最新値をメトリクスとして公開
+        for field, name, help in [('cpu', 'system_cpu_percent', 'CPU usage.'),
+                                  ('mem', 'system_memory_percent', 'Memory usage.'),
+                                  ('temp', 'system_soc_temperature_celsius', 'SoC temperature.'),
+                                  ('throttled', 'system_throttled', 'vcgencmd get_throttled bits.')]:
+            metrics.gauge(name, help).set_function(lambda field=field: self.latest(field) or 0)
+
+    def sample(self,) -> Dict[str, Union[float, int, None]]:
+        """Take one sample
+
+        Returns:
+            Dict[str, Union[float, int, None]]: Sample (temp, volt, throttled are None if unavailable)
+        """
+        mem = psutil.virtual_memory()
+        s = dict(time=time.time(),
+                 cpu=psutil.cpu_percent(),  # 前回のサンプルからの平均
+                 mem=mem.used / mem.total * 100,
+                 dsk=psutil.disk_usage(self.disk_path).percent,
+                 temp=read_soc_temperature(),
+                 volt=read_core_volts(),
+                 throttled=read_throttled())
+        with self._lock:
+            self._samples.append(s)
+        return s
+
+    def samples(self, minutes: Union[float, None] = None) -> List[dict]:
+        """Samples of the last minutes
+
+        Args:
+            minutes (Union[float, None], optional): Period. Defaults to None (all).
+
+        Returns:
+            List[dict]: Samples (oldest first)
+        """
+        with self._lock:
+            samples = list(self._samples)
+        if minutes is not None:
+            since = time.time() - minutes * 60
+            samples = [s for s in samples if s['time'] >= since]
+        return samples
+
+    def latest(self, field: str) -> Union[float, int, None]:
+        with self._lock:
+            return self._samples[-1][field] if len(self._samples) else None
+
+    def stats(self, minutes: Union[float, None] = None) -> Dict[str, Dict[str, float]]:
+        """Min / avg / max of each field
+
+        Args:
+            minutes (Union[float, None], optional): Period. Defaults to None (all).
+
+        Returns:
+            Dict[str, Dict[str, float]]: {field: {min, avg, max, last}} and {throttled: bits ORed over the period}
+        """
+        samples = self.samples(minutes)
+        result = {}
+        for field in self.FIELDS:
+            values = [s[field] for s in samples if s[field] is not None]
+            if len(values):
+                result[field] = dict(min=min(values), avg=sum(values) / len(values), max=max(values), last=values[-1])
+        throttled = [s['throttled'] for s in samples if s['throttled'] is not None]
+        if len(throttled):
+            bits = 0
+            for b in throttled:
+                bits |= b
+            result['throttled'] = bits
+        return result
+
+    def start(self,) -> None:
+        """Start sampling thread
+        """
+        self._thread = threading.Thread(target=self.run, name='system_monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self,) -> None:
+        """Stop sampling thread
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self,) -> None:
+        """Sampling loop
+        """
+        while True:
+            try:
+                self.sample()
+            except OSError as e:
+                self._logger.error('Failed to sample system info: {}'.format(e))
+            if self._stop.wait(self.sample_seconds):
+                break
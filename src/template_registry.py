@@ -0,0 +1,115 @@
+"""Registry of Slack message templates."""
+import re
+import logging
+from typing import Dict, Union
+
+import jinja2
+
+from common.phone_number import DEFAULT_COUNTRY_CODE, normalize_number
+from common.log import Logger
+
+
+class TemplateRegistry():
+    """Registry of Slack message templates
+    jinja2.Environmentを1つだけ作り、コンパイル済みテンプレートをキャッシュする(ファイルの更新日時が変わったときだけ再コンパイル)。
+    送信元・メッセージの種類(OTP, 長文, その他)ごとにテンプレートを選ぶ。
+    """
+
+    KIND_OTP = 'otp'
+    KIND_LONG = 'long'
+    KIND_UNKNOWN = 'unknown'
+
+    OTP_RE = re.compile(r'(?<![0-9])[0-9]{4,8}(?![0-9])')  # 認証コード(4~8桁の数字)
+    OTP_MAX_LENGTH = 160
+    LONG_MIN_LENGTH = 300
+
+    def __init__(self, template_dir: str = '../template', default: str = 'slack_message_template.txt',
+                 kind_templates: Union[Dict[str, str], None] = None, sender_templates: Union[Dict[str, str], None] = None,
+                 country_code: str = DEFAULT_COUNTRY_CODE, log_level: int = logging.INFO) -> None:
+        """Initialize
+
+        Args:
+            template_dir (str, optional): Template directory. Defaults to '../template'.
+            default (str, optional): Default template filename. Defaults to 'slack_message_template.txt'.
+            kind_templates (Union[Dict[str, str], None], optional): {kind: template filename}. Defaults to None.
+            sender_templates (Union[Dict[str, str], None], optional): {sender: template filename}. Defaults to None.
+            country_code (str, optional): Country code used for national numbers. Defaults to DEFAULT_COUNTRY_CODE.
+            log_level (int, optional): Level of logging. Defaults to logging.INFO.
+        """
+        self._logger = Logger(name=__name__, level=log_level)
+
+        self.env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), auto_reload=True)
+
+        self.default = default
+        self.country_code = country_code
+        self.kind_templates = dict(kind_templates or {})
+        self.sender_templates = {self.sender_key(k): v for k, v in (sender_templates or {}).items()}
+
+    def sender_key(self, sender: str) -> str:
+        """Key of sender_templates
+
+        Args:
+            sender (str): Sender number or name
+
+        Returns:
+            str: Normalized number (names are lower-cased)
+        """
+        return normalize_number(sender, self.country_code).lower()
+
+    def classify(self, sms: dict) -> str:
+        """Classify SMS
+
+        Args:
+            sms (dict): SMS
+
+        Returns:
+            str: {otp | long | unknown}
+        """
+        message = sms['message']
+        if len(message) >= self.LONG_MIN_LENGTH or sms.get('partial'):
+            return self.KIND_LONG
+        if len(message) <= self.OTP_MAX_LENGTH and self.OTP_RE.search(message):
+            return self.KIND_OTP
+        return self.KIND_UNKNOWN
+
+    def get_template_name(self, sms: dict) -> str:
+        """Template filename for SMS (sender > kind > default)
+
+        Args:
+            sms (dict): SMS
+
+        Returns:
+            str: Template filename
+        """
+        name = self.sender_templates.get(self.sender_key(sms['from_number']))
+        if name is None:
+            name = self.kind_templates.get(self.classify(sms), self.default)
+        return name
+
+    def get_template(self, name: Union[str, None] = None) -> jinja2.Template:
+        """Get compiled template
+
+        Args:
+            name (Union[str, None], optional): Template filename. Defaults to None (default template).
+
+        Returns:
+            jinja2.Template: Template
+        """
+        return self.env.get_template(name or self.default)
+
+    def render(self, sms: dict, name: Union[str, None] = None) -> str:
+        """Render SMS
+
+        Args:
+            sms (dict): SMS
+            name (Union[str, None], optional): Template filename. Defaults to None (chosen by get_template_name()).
+
+        Returns:
+            str: Rendered message
+        """
+        template = self.get_template(name or self.get_template_name(sms))
+        return template.render(from_number=sms['from_number'],
+                               message=sms['message'],
+                               timestamp=sms['timestamp'],
+                               partial=sms['partial'],
+                               modem=sms.get('modem', ''))
@@ -0,0 +1,15 @@
+"""Test configuration.
+
+Modules under src/ import each other by module name and read ../config, ../data relative to src/,
+so tests put src/ and bench/ (fake_modem) on sys.path and replace serial.Serial with FakeSerial.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+import fake_modem  # noqa: E402
+
+fake_modem.install()
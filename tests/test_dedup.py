@@ -0,0 +1,41 @@
+import time
+
+from dedup import DedupIndex, fingerprint
+
+
+def sms(message: str, **kwargs) -> dict:
+    return dict(dict(from_number='09012345678', message=message, received_at=1000.0, reference=None, modem=''), **kwargs)
+
+
+def test_fingerprint():
+    assert fingerprint(sms('hello')) == fingerprint(sms('hello'))
+    assert fingerprint(sms('hello')) != fingerprint(sms('hello', received_at=1001.0))
+    assert fingerprint(sms('hello')) != fingerprint(sms('hello', modem='modem2'))
+
+
+def test_lru_eviction_and_reload(tmp_path):
+    filename = str(tmp_path / 'dedup.sqlite3')
+    index = DedupIndex(filename=filename, max_entries=3)
+    now = time.time()
+    for i, fp in enumerate(['a', 'b', 'c']):
+        index.add(fp, now=now + i)
+    assert index.seen('a', now=now + 10)  # 使われたものは新しくなる
+
+    index.add('d', now=now + 4)  # 最も使われていないbが溢れる
+    assert len(index) == 3
+    assert not index.seen('b', now=now + 10)
+    assert index.seen('a', now=now + 10)
+    index.close()
+
+    # 再起動後はSQLiteから引き継ぐ(溢れたものはSQLiteからも消えている)
+    reloaded = DedupIndex(filename=filename, max_entries=3)
+    assert len(reloaded) == 3
+    assert not reloaded.seen('b')
+    assert all(reloaded.seen(fp) for fp in ('a', 'c', 'd'))
+
+
+def test_ttl(tmp_path):
+    index = DedupIndex(filename=str(tmp_path / 'dedup.sqlite3'), ttl_seconds=60)
+    index.add('a', now=1000.0)
+    assert index.seen('a', now=1059.0)
+    assert not index.seen('a', now=1060.0)
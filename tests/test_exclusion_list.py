@@ -0,0 +1,90 @@
+import os
+import threading
+
+from exclusion_list import ExclusionStore
+
+from common.phone_number import PrefixTrie, normalize_number
+
+
+def test_match_during_reload(tmp_path):
+    filename = str(tmp_path / 'exclude_number.txt')
+    store = ExclusionStore(filename=filename, journal_filename=str(tmp_path / 'exclude_number.journal'))
+
+    # 除外する番号は常に末尾にあるので、読み込み途中の状態が見えるとmatch()がFalseになる
+    snapshots = [''.join(['0{:09d}\n'.format(i) for i in range(n)]) + '09012345678\n' for n in (2000, 2001)]
+    with open(filename, 'w') as f:
+        f.write(snapshots[0])
+    assert store.match('+819012345678')
+
+    stop = threading.Event()
+    missed = []
+
+    def reader():
+        while not stop.is_set():
+            if not store.match('09012345678'):
+                missed.append(True)
+                return
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for i in range(200):
+        with open(filename + '.tmp', 'w') as f:  # 大きさが変わるので再読み込みされる
+            f.write(snapshots[(i + 1) % 2])
+        os.replace(filename + '.tmp', filename)
+        store.reload_if_changed()
+    stop.set()
+    for t in threads:
+        t.join()
+
+    assert missed == []
+    assert len(store.entries) == 2001
+
+
+def test_normalize_number():
+    assert normalize_number('090-1234-5678') == '+819012345678'
+    assert normalize_number('+81 90 1234 5678') == '+819012345678'
+    assert normalize_number('819012345678') == '+819012345678'
+    assert normalize_number('NTT DOCOMO') == 'NTT DOCOMO'  # 英数字の送信元はそのまま
+    assert normalize_number('110') == '110'  # 短縮番号はそのまま
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    trie.add('+81120', 'short')
+    trie.add('+81120111', 'long')
+    assert trie.match('+81120111222') == 'long'  # 最長一致
+    assert trie.match('+81120999999') == 'short'
+    assert trie.match_all('+81120111222') == ['short', 'long']
+    assert trie.match('+819012345678') is None
+
+    assert trie.remove('+81120111')
+    assert not trie.remove('+81120111')
+    assert trie.match('+81120111222') == 'short'
+    assert len(trie) == 1
+
+
+def test_store_matches_numbers_prefixes_and_names(tmp_path):
+    store = ExclusionStore(filename=str(tmp_path / 'exclude_number.txt'), journal_filename=str(tmp_path / 'exclude_number.journal'))
+    assert store.add(['090-1234-5678', '0120*', 'Spam Sender', '090-1234-5678']) == 3
+
+    assert store.match('+819012345678')  # +81と0は同じ番号
+    assert not store.match('09012345679')
+    assert store.match('0120111222')  # プレフィックス
+    assert store.match('+81120111222')
+    assert not store.match('0312345678')
+    assert store.match('Spam Sender')  # 英数字の送信元は完全一致
+    assert not store.match('Spam')
+
+    # 同じ番号の完全一致とプレフィックスはそれぞれ削除できる
+    store.add(['0120111222'])
+    assert store.delete('0120*')
+    assert store.match('0120111222')
+    assert not store.match('0120999999')
+    assert store.delete('0120111222')
+    assert not store.match('0120111222')
+    assert not store.delete('0120111222')
+
+    # ジャーナルから同じ状態を読み込む
+    reloaded = ExclusionStore(filename=store.filename, journal_filename=store.journal_filename)
+    assert reloaded.entries == ['090-1234-5678', 'Spam Sender']
@@ -0,0 +1,36 @@
+import queue
+import logging
+
+from common.log import _QueueHandler
+
+
+def make_record(msg, *args):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+
+
+def test_arguments_are_formatted_on_the_calling_thread():
+    q = queue.SimpleQueue()
+    handler = _QueueHandler(q)
+
+    items = [1]
+    handler.emit(make_record('items %s', items))
+    items.append(2)  # 出力スレッドが整形する前に変更される
+
+    record = q.get_nowait()
+    assert record.getMessage() == 'items [1]'
+    assert record.args is None
+
+
+def test_bad_argument_fails_on_the_calling_thread(monkeypatch):
+    class Broken():
+        def __str__(self):
+            raise ValueError('broken')
+
+    q = queue.SimpleQueue()
+    handler = _QueueHandler(q)
+    errors = []
+    monkeypatch.setattr(handler, 'handleError', errors.append)
+
+    handler.emit(make_record('value %s', Broken()))
+    assert len(errors) == 1
+    assert q.empty()
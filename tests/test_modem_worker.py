@@ -0,0 +1,149 @@
+import binascii
+import threading
+
+from fake_modem import FakeModem, FakeSerial, make_pdu
+from forwarding_sms import SMSForwardingTask
+from modem_worker import ModemWorker
+from reassembly import ReassemblyBuffer
+from sms_pdu import PDU
+
+from common.log import Logger
+
+
+class FakeTask():
+    """Pipeline stub recording forwarded SMS (skips SMS already forwarded like DedupIndex)
+    """
+
+    def __init__(self,) -> None:
+        self.forwarded = []
+
+    def decode_pdu_message(self, msg, modem=''):
+        lines = msg.split('\n')
+        pdu_list = []
+        for i, line in enumerate(lines):
+            if line.startswith('+CMGL:'):
+                pdu = PDU(lines[i + 1].strip())
+                pdu.index = int(line[len('+CMGL:'):].split(',')[0])
+                pdu_list.append(pdu)
+        return pdu_list
+
+    def create_sms_list_from_pdu_list(self, pdu_list):
+        return [dict(from_number=p.from_number, message=p.message, indexes=[p.index]) for p in pdu_list]
+
+    def take_reassembly_indexes(self, modem=''):
+        return []
+
+    def forward_sms(self, sms):
+        if sms['message'] not in self.forwarded:
+            self.forwarded.append(sms['message'])
+
+
+class PipelineTask(SMSForwardingTask):
+    """SMSForwardingTask decoding and reassembling like the real pipeline, recording forwarded SMS
+    """
+
+    def __init__(self, checkpoint_filename: str) -> None:
+        self._logger = Logger(name=__name__)
+        self._reassembly_lock = threading.Lock()
+        self.reassembly = ReassemblyBuffer(checkpoint_filename=checkpoint_filename)
+        self.workers = []
+        self.forwarded = []
+
+    def forward_sms(self, sms):
+        self.forwarded.append(sms['message'])
+
+
+def create_worker(port: str, task=None):
+    modem = FakeSerial.modems[port] = FakeModem()
+    task = FakeTask() if task is None else task
+    worker = ModemWorker(task, '', port, receive_mode='polling')
+    worker.session.timeout = 0.2
+    worker.recover = False
+    return worker, task, modem
+
+
+def test_failed_delete_is_retried():
+    worker, task, modem = create_worker('test_failed_delete')
+    for i in range(3):
+        modem.deliver(make_pdu('09012345678', 'message {}'.format(i)))
+
+    # +CMGDに応答しない(応答なしでタイムアウト)
+    handle = modem.handle
+    modem.handle = lambda line: '' if 'CMGD' in line.upper() else handle(line)
+    assert worker.run_safely(worker.send_sms_to_slack) is None
+    assert worker.recover
+    assert len(worker.pending_sms_list) == 2
+    assert all(stat == 1 for stat, _ in modem.store.values())  # 既読になっている
+
+    modem.handle = handle
+    for _ in range(3):
+        worker.run_safely(worker.send_sms_to_slack)
+
+    assert task.forwarded == ['message 0', 'message 1', 'message 2']
+    assert len(modem.store) == 0
+    assert len(worker.pending_sms_list) == 0
+
+
+def test_rejected_delete_is_retried():
+    worker, task, modem = create_worker('test_rejected_delete')
+    for i in range(3):
+        modem.deliver(make_pdu('09012345678', 'message {}'.format(i)))
+
+    # 最初の+CMGDだけERRORを返す
+    handle = modem.handle
+    rejected = []
+
+    def reject_once(line):
+        if 'CMGD' in line.upper() and not rejected:
+            rejected.append(line)
+            return '\r\nERROR\r\n'
+        return handle(line)
+
+    modem.handle = reject_once
+    assert worker.run_safely(worker.send_sms_to_slack) is None
+    assert worker.recover
+    assert worker.watchdog.failures == 0  # モデムは応答している
+
+    for _ in range(3):
+        worker.run_safely(worker.send_sms_to_slack)
+
+    assert task.forwarded == ['message 0', 'message 1', 'message 2']
+    assert len(modem.store) == 0
+    assert len(worker.pending_sms_list) == 0
+
+
+def test_unexpected_response_is_not_a_watchdog_failure():
+    worker, task, modem = create_worker('test_unexpected_response')
+    modem.deliver(make_pdu('09012345678', 'message'))
+    worker.recover = False
+
+    # AT+CPMS?に+CPMSを含まない応答を返す(モデムは応答している)
+    handle = modem.handle
+    modem.handle = lambda line: '\r\nOK\r\n' if line.upper().startswith('AT+CPMS?') else handle(line)
+    assert worker.run_safely(worker.send_sms_to_slack) is None
+    assert worker.watchdog.failures == 0
+    assert not worker.watchdog.is_down
+
+    # 応答なしはウォッチドッグに渡す
+    modem.handle = lambda line: ''
+    assert worker.run_safely(worker.send_sms_to_slack) is None
+    assert worker.watchdog.failures == 1
+
+
+def test_undecodable_pdu_does_not_block_forwarding(tmp_path):
+    task = PipelineTask(str(tmp_path / 'reassembly.json'))
+    worker, task, modem = create_worker('test_undecodable_pdu', task)
+
+    # DCS 0x04 (8bitデータ)はデコードできない
+    data = bytearray(binascii.unhexlify(make_pdu('09012345678', 'binary')))
+    data[PDU(data.hex())._tp_offset + 1] = 0x04
+    modem.deliver(make_pdu('09012345678', 'message 0'))
+    modem.deliver(data.hex().upper())
+    modem.deliver(make_pdu('09012345678', 'message 2'))
+
+    assert worker.run_safely(worker.send_sms_to_slack) is not None
+    assert not worker.recover
+    assert task.forwarded[0] == 'message 0'
+    assert task.forwarded[1].startswith('(デコードできないSMS')
+    assert task.forwarded[2] == 'message 2'
+    assert len(modem.store) == 0
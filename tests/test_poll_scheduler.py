@@ -0,0 +1,33 @@
+from poll_scheduler import PollScheduler
+
+
+def test_backoff_and_traffic():
+    scheduler = PollScheduler(5, 60)
+    assert scheduler.remaining() == 0  # 初回はすぐ実行
+
+    assert scheduler.done(False, now=100) == 10
+    assert scheduler.remaining(now=100) == 10
+    assert scheduler.done(False, now=110) == 20
+    assert scheduler.done(False, now=130) == 40
+    assert scheduler.done(False, now=170) == 60  # max_secondsまで
+    assert scheduler.done(False, now=230) == 60
+
+    assert scheduler.done(True, now=290) == 5  # 受信があったら最短間隔に戻る
+    assert scheduler.remaining(now=292) == 3
+    assert scheduler.remaining(now=300) == 0
+
+
+def test_expedite():
+    scheduler = PollScheduler(5, 60)
+    scheduler.done(False)
+    assert scheduler.remaining() > 0
+    scheduler.expedite()
+    assert scheduler.remaining() == 0
+    assert scheduler.interval == 10  # 間隔はそのまま
+
+
+def test_fixed_interval():
+    scheduler = PollScheduler(300, 300)
+    assert scheduler.done(False, now=0) == 300
+    assert scheduler.done(True, now=300) == 300
+    assert PollScheduler(60, 5).min_seconds == 5
@@ -0,0 +1,29 @@
+from fake_modem import make_message_pdus
+from reassembly import ReassemblyBuffer
+from sms_pdu import PDU
+
+
+def test_complete_message_kept_until_done(tmp_path):
+    checkpoint = str(tmp_path / 'reassembly.json')
+    buffer = ReassemblyBuffer(checkpoint_filename=checkpoint)
+
+    first, second = [PDU(line) for line in make_message_pdus('09012345678', 'あ' * 100, ucs2=True, reference=7)]
+    first.index, second.index = 1, 2
+    assert buffer.add(first) is None
+    assert buffer.take_indexes() == [1]  # 未完成の部品は保存してから削除してよい
+    buffer.save()
+
+    parts = buffer.add(second)
+    assert [p.concat[2] for p in parts] == [1, 2]
+    assert buffer.take_indexes() == []  # 送信キューに保存するまで削除させない
+    buffer.save()
+
+    # 送信キューに保存する前に停止しても、再起動後に返す
+    restored = ReassemblyBuffer(checkpoint_filename=checkpoint)
+    parts = restored.pop_expired()
+    assert len(parts) == 1 and len(parts[0]) == 2
+    assert restored.pop_expired() == []
+
+    restored.done(ReassemblyBuffer.key(parts[0][-1]))
+    restored.save()
+    assert len(ReassemblyBuffer(checkpoint_filename=checkpoint)) == 0
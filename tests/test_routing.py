@@ -0,0 +1,67 @@
+import configparser
+
+from routing import Router
+
+CONFIG = '''
+[setting]
+slack_channel = #sms
+
+[route:bank]
+channel = #bank
+sender = 0120111222
+priority = 10
+
+[route:bank_otp]
+channel = #bank-otp
+sender = 0120111222
+regex = 認証コード
+
+[route:toll_free]
+channel = #toll-free
+prefix = 0120
+
+[route:toll_free_long]
+channel = #toll-free-long
+prefix = 0120111
+
+[route:modem2]
+channel = #modem2
+modem = modem2
+
+[route:discount]
+channel = #discount
+regex = \\d+%OFF
+'''
+
+
+def create_router() -> Router:
+    config = configparser.ConfigParser()
+    config.read_string(CONFIG)
+    return Router.from_config(config)
+
+
+def route(router: Router, from_number: str, message: str = 'hello', modem: str = '') -> str:
+    return router.route(dict(from_number=from_number, message=message, modem=modem)).channel
+
+
+def test_priority_and_exact_sender():
+    router = create_router()
+    assert len(router) == 6
+    # 優先度が高いものが正規表現に一致するルールより先
+    assert route(router, '0120111222', '認証コード 1234') == '#bank'
+    # +81と0は同じ送信元
+    assert route(router, '+81120111222') == '#bank'
+
+
+def test_prefix_prefers_longer_match():
+    router = create_router()
+    assert route(router, '0120111333') == '#toll-free-long'
+    assert route(router, '0120999999') == '#toll-free'
+
+
+def test_modem_regex_and_default():
+    router = create_router()
+    assert route(router, '09012345678', modem='modem2') == '#modem2'
+    assert route(router, '09012345678', '本日限り50%OFF') == '#discount'  # %を含む正規表現
+    assert route(router, '09012345678') == '#sms'
+    assert router.route(dict(from_number='09012345678', message='hello')) is router.default
@@ -0,0 +1,110 @@
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from outbox import Outbox
+from slack_sender import SlackSender
+
+
+class FakeResponse(dict):
+    def __init__(self, error: str, status_code: int = 200) -> None:
+        super().__init__(ok=False, error=error)
+        self.status_code = status_code
+        self.headers = {}
+
+
+def send_all(sender: SlackSender, cycles: int = 10) -> None:
+    """Run the sender loop a few cycles (失敗するとトークンバケットが空になるので次のトークンを待つ)
+    """
+    for _ in range(cycles):
+        sender.send_once()
+        time.sleep(0.01)
+
+
+class FakeClient():
+    """chat.postMessage stub failing for the given channels (or posts containing the given texts)
+    """
+
+    def __init__(self, errors: dict) -> None:
+        self.errors = errors
+        self.posted = []
+        self.blocks = []
+
+    def chat_postMessage(self, channel, text, **kwargs):
+        for key, error in self.errors.items():
+            if key == channel or key in text:
+                raise SlackApiError('failed', FakeResponse(error))
+        self.posted.append((channel, text))
+        self.blocks.append(kwargs.get('blocks'))
+
+
+def test_permanent_error_does_not_block_channel(tmp_path):
+    outbox = Outbox(filename=str(tmp_path / 'outbox.sqlite3'))
+    client = FakeClient({'#gone': 'channel_not_found', '#busy': 'internal_error'})
+    sender = SlackSender(client, outbox, coalesce_max_messages=1)
+
+    outbox.put('#gone', 'lost')
+    outbox.put('#busy', 'later')
+    outbox.put('#sms', 'sent')
+    sender.send_once()
+
+    assert client.posted == [('#sms', 'sent')]
+    assert outbox.depth_by_channel() == {'#busy': 1}  # 一時的なエラーは再送する
+    assert outbox.dead_count() == 1
+
+    # deadに移したチャンネルの後続はすぐ送る
+    outbox.put('#gone', 'next')
+    assert [row['text'] for row in outbox.heads()] == ['next']  # #busyは再送待ち
+
+
+def test_long_head_is_posted_alone(tmp_path):
+    outbox = Outbox(filename=str(tmp_path / 'outbox.sqlite3'))
+    client = FakeClient({})
+    sender = SlackSender(client, outbox)
+
+    long_text = 'あ' * (SlackSender.SECTION_TEXT_LIMIT + 500)  # 長い分割SMS
+    outbox.put('#sms', long_text)
+    outbox.put('#sms', 'short 1')
+    outbox.put('#sms', 'short 2')
+    sender.send_once()
+
+    assert client.posted[0] == ('#sms', long_text)  # 切り詰めない
+    assert client.blocks[0] is None
+    assert client.posted[1] == ('#sms', 'short 1\n\nshort 2')
+    assert outbox.depth() == 0
+
+
+def test_account_error_pauses_and_keeps_messages(tmp_path):
+    outbox = Outbox(filename=str(tmp_path / 'outbox.sqlite3'))
+    client = FakeClient({'#sms': 'invalid_auth'})
+    sender = SlackSender(client, outbox, rate_per_second=1000, coalesce_max_messages=1)
+
+    outbox.put('#sms', 'first')
+    outbox.put('#sms', 'second')
+    sender.send_once()
+
+    assert sender.paused
+    assert outbox.depth() == 2  # トークンを直せば送れるので残す
+    assert outbox.dead_count() == 0
+    assert sender.next_wait() > 0
+
+    # 期限が過ぎたら再開する
+    client.errors.clear()
+    sender._paused_until = 0
+    send_all(sender)
+    assert not sender.paused
+    assert [text for _, text in client.posted] == ['first', 'second']
+
+
+def test_rejected_merged_post_is_retried_one_by_one(tmp_path):
+    outbox = Outbox(filename=str(tmp_path / 'outbox.sqlite3'))
+    client = FakeClient({'broken': 'invalid_blocks'})
+    sender = SlackSender(client, outbox, rate_per_second=1000, burst=10)
+
+    for text in ('ok 1', 'broken', 'ok 2'):
+        outbox.put('#sms', text)
+    send_all(sender)
+
+    assert [text for _, text in client.posted] == ['ok 1', 'ok 2']
+    assert outbox.depth() == 0
+    assert outbox.dead_count() == 1  # 単独でも送れなかったものだけ
@@ -0,0 +1,14 @@
+from fake_modem import make_message_pdus, make_pdu
+from sms_pdu import PDU, decode_many
+
+
+def test_decode_many_matches_per_line_decoding():
+    lines = [make_pdu('09012345678', 'hello'), make_pdu('0120123456', 'こんにちは', ucs2=True)]
+    lines += make_message_pdus('09011112222', 'あ' * 100, ucs2=True, reference=3)
+
+    for pdu, line in zip(decode_many(lines), lines):
+        expected = PDU(line)
+        assert (pdu.from_number, pdu.message, pdu.timestamp, pdu.concat) == \
+            (expected.from_number, expected.message, expected.timestamp, expected.concat)
+        assert pdu.to_hex() == line
+        assert len(pdu._data.obj) == len(line) // 2  # +CMGLの応答全体ではなく自分の分だけを持つ